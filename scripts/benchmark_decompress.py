@@ -0,0 +1,123 @@
+"""
+Compares decompressing large gzip and bzip2 files with the gzip and bzip2 commands, as the
+decompress endpoint used to, against the in process extractor with one thread and with a
+thread budget.
+
+Run from the root of the repo:
+
+    python -m scripts.benchmark_decompress --size-mb 512 --threads 8
+
+The files are generated in a temporary folder, which is removed afterwards. Plain gzip and
+single stream bzip2 files only use more than one thread if pigz or lbzip2 is installed.
+"""
+import argparse
+import bz2
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+
+from staging_service import extraction
+from staging_service.decompress_jobs import Progress
+from staging_service.utils import Path
+
+_BGZF_BLOCK_SIZE = 65280
+
+
+def _fastq(size):
+    # fastq like text that compresses at about the usual ratio
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        seq = "".join("ACGT"[(i * 7 + j * 13 + (i >> 3) * j) % 4] for j in range(100))
+        record = f"@read{i} len=100\n{seq}\n+\n{'I' * 60}{'#' * 40}\n".encode()
+        lines.append(record)
+        total += len(record)
+        i += 1
+    return b"".join(lines)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _bgzf(data):
+    blocks = []
+    chunks = [data[i:i + _BGZF_BLOCK_SIZE] for i in range(0, len(data), _BGZF_BLOCK_SIZE)]
+    for chunk in chunks + [b""]:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        blocks.append(
+            b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+            + (len(deflated) + 25).to_bytes(2, "little")
+            + deflated
+            + zlib.crc32(chunk).to_bytes(4, "little")
+            + len(chunk).to_bytes(4, "little")
+        )
+    return b"".join(blocks)
+
+
+def _bz2_streams(data):
+    # as pbzip2 writes
+    return b"".join(bz2.compress(data[i:i + 900000]) for i in range(0, len(data), 900000))
+
+
+def _time(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _run(name, compressed, suffix, threads, root):
+    archive = Path.from_full_path(os.path.join(root, "user", "bench" + suffix))
+    command = ["gzip" if suffix == ".gz" else "bzip2", "-d", archive.full_path]
+    methods = [
+        (" ".join(command[:2]), lambda: subprocess.run(command, check=True)),
+        ("extract, 1 thread", lambda: extraction.extract(archive, Progress(), 1)),
+        (f"extract, {threads} threads",
+         lambda: extraction.extract(archive, Progress(), threads)),
+    ]
+    for method, func in methods:
+        with open(archive.full_path, "wb") as f:
+            f.write(compressed)
+        seconds = _time(func)
+        output = archive.full_path[: -len(suffix)]
+        size = os.path.getsize(output)
+        os.remove(output)
+        print(f"{name:<22} {method:<22} {seconds:8.2f}s {size / seconds / 2 ** 20:8.1f} MiB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256,
+                        help="the size of the decompressed files")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                        help="the thread budget of a job")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        Path._DATA_DIR = root
+        Path._META_DIR = os.path.join(root, "metadata")
+        os.makedirs(os.path.join(root, "user"))
+        data = _fastq(args.size_mb * 2 ** 20)
+        files = [
+            ("gzip", _gzip, ".gz"),
+            ("BGZF", _bgzf, ".gz"),
+            ("bzip2", bz2.compress, ".bz2"),
+            ("bzip2 streams", _bz2_streams, ".bz2"),
+        ]
+        print(f"{args.size_mb} MiB, {args.threads} threads, "
+              + f"pigz: {bool(shutil.which('pigz'))}, lbzip2: {bool(shutil.which('lbzip2'))}")
+        for name, compress, suffix in files:
+            _run(name, compress(data), suffix, args.threads, root)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Copies the metadata sidecar files under META_DIR into the SQLite metadata store.
+
+Run from the root of the repo, before or after switching the service to
+METADATA_STORE = sqlite:
+
+    python -m scripts.migrate_metadata --meta-dir /kb/deployment/lib/src/data/metadata/
+
+The time each sidecar file was written is kept, so metadata that was up to date stays up to
+date. Metadata already in the store that was written after the sidecar file is kept, so the
+migration can be run again, for example to pick up files written by a service still using the
+sidecar store. Sidecar files that can't be decoded are reported and skipped. The sidecar files
+are only removed if --remove is given.
+"""
+import argparse
+import json
+import os
+import sys
+
+from staging_service.metadata_store import SQLiteStore
+from staging_service.utils import Path
+
+# the number of files imported in each transaction
+_BATCH_SIZE = 1000
+
+
+def _sidecars(user_dir: str):
+    for dirpath, dirnames, filenames in os.walk(user_dir):
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+
+
+def migrate_user(store: SQLiteStore, meta_dir: str, username: str, remove: bool) -> tuple:
+    """
+    Copy the sidecar files of one user into the store.
+    :return: the number of files imported and the number that couldn't be decoded.
+    """
+    imported = 0
+    failed = 0
+    batch = []
+    migrated = []
+
+    def flush():
+        store.import_many(username, batch)
+        if remove:
+            for sidecar in migrated:
+                os.remove(sidecar)
+        batch.clear()
+        migrated.clear()
+
+    for sidecar in _sidecars(os.path.join(meta_dir, username)):
+        try:
+            with open(sidecar) as f:
+                written = os.fstat(f.fileno()).st_mtime
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as e:
+            print(f"Skipping {sidecar}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        user_path = os.path.relpath(sidecar, meta_dir)
+        batch.append((user_path, data, written))
+        migrated.append(sidecar)
+        imported += 1
+        if len(batch) >= _BATCH_SIZE:
+            flush()
+    flush()
+    if remove:
+        # remove the emptied folders, deepest first
+        for dirpath, _, _ in sorted(os.walk(os.path.join(meta_dir, username)), reverse=True):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+    return imported, failed
+
+
+def migrate(meta_dir: str, remove: bool = False) -> tuple:
+    """
+    Copy the sidecar files of every user into the store.
+    :return: the number of files imported and the number that couldn't be decoded.
+    """
+    Path._META_DIR = meta_dir
+    store = SQLiteStore()
+    imported = failed = 0
+    for username in sorted(os.listdir(meta_dir)):
+        # the folders starting with a '.' hold the service's own state, not users' metadata
+        if username.startswith(".") or not os.path.isdir(os.path.join(meta_dir, username)):
+            continue
+        user_imported, user_failed = migrate_user(store, meta_dir, username, remove)
+        print(f"{username}: imported {user_imported}, skipped {user_failed}")
+        imported += user_imported
+        failed += user_failed
+    return imported, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--meta-dir", required=True, help="the META_DIR of the service")
+    parser.add_argument("--remove", action="store_true",
+                        help="remove the sidecar files once they are imported")
+    args = parser.parse_args()
+    imported, failed = migrate(os.path.abspath(args.meta_dir), args.remove)
+    print(f"Imported {imported} files, skipped {failed}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,185 @@
 This class is in charge of determining possible importers by determining the suffix of the filepath pulled in,
 and by looking up the appropriate mappings in the supported_apps_w_extensions.json file
 """
-from typing import Optional, Tuple, Dict
+import hashlib
+import json
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from json.encoder import encode_basestring_ascii
+from typing import Callable, Optional, Tuple, Dict
+
+# the number of recently seen filenames whose matching suffix is cached
+_SUFFIX_CACHE_SIZE = 10000
+# marks the end of a suffix in a trie node, mapped to the suffix
+_END = None
+
+
+def _compile_suffix_trie(types: dict) -> dict:
+    """
+    Build a trie of the suffixes in the types mapping, split on '.' and reversed, so the longest
+    suffix of a filename can be found by walking the parts of the filename backwards once. Each
+    node maps a part to the next node, and _END to the suffix if a suffix ends there.
+    Suffixes that aren't lower case can never match, as filenames are lower cased to match.
+    """
+    trie = {}
+    for suffix in types:
+        if suffix != suffix.lower():
+            continue
+        node = trie
+        for part in reversed(suffix.split(".")):
+            node = node.setdefault(part, {})
+        node[_END] = suffix
+    return trie
+
+
+def _longest_suffix(trie: dict, filename: str) -> Optional[Tuple[int, str]]:
+    """
+    Find the longest suffix of a filename, following a '.', that is in a suffix trie.
+    :return: the index of the '.' and the suffix as it appears in the types mapping, or None.
+    """
+    parts = filename.split(".")
+    node = trie
+    match = None
+    suffix_len = 0
+    # the first part is never a suffix
+    for part in reversed(parts[1:]):
+        node = node.get(part.lower())
+        if node is None:
+            break
+        suffix_len += len(part) + 1
+        if _END in node:
+            match = len(filename) - suffix_len, node[_END]
+    return match
+
+
+def _datatype_mappings(types: dict) -> dict:
+    datatypes = defaultdict(set)
+    extensions = defaultdict(set)
+    for fileext, val in types.items():
+        # if we start using the file ext type array for anything else this might need changes
+        filetype = val["file_ext_type"][0]
+        extensions[filetype].add(fileext)
+        for m in val['mappings']:
+            datatypes[m['id']].add(filetype)
+    return {
+        "datatype_to_filetype": {k: sorted(datatypes[k]) for k in datatypes},
+        "filetype_to_extensions": {k: sorted(extensions[k]) for k in extensions},
+    }
+
+
+@dataclass(frozen=True, eq=False)
+class MappingsSnapshot:
+    """
+    A set of file extension mappings and the lookup structures built from them. Nothing in a
+    snapshot is modified once it is built; when the mappings change a new snapshot replaces
+    the old one, so a request that uses one snapshot throughout sees consistent mappings.
+
+    mappings - the contents of the supported_apps_w_extensions.json file.
+    version - identifies the mappings, and changes when they change.
+    longest_suffix - finds the longest suffix of a filename in the mappings, with a cache of
+        recently seen filenames. See _longest_suffix.
+    encoded_types - suffix -> the JSON of its mappings and of its file_ext_type.
+    datatype_mappings - the datatype to filetype and filetype to extensions indexes.
+    datatype_mappings_json - datatype_mappings encoded as JSON.
+    """
+    mappings: dict
+    version: str
+    longest_suffix: Callable[[str], Optional[Tuple[int, str]]]
+    encoded_types: Dict[str, Tuple[str, str]]
+    datatype_mappings: dict
+    datatype_mappings_json: bytes
+
+    @staticmethod
+    def build(mappings: dict) -> "MappingsSnapshot":
+        types = mappings["types"]
+        datatype_mappings = _datatype_mappings(types)
+        return MappingsSnapshot(
+            mappings=mappings,
+            version=hashlib.md5(json.dumps(mappings, sort_keys=True).encode()).hexdigest(),
+            longest_suffix=lru_cache(maxsize=_SUFFIX_CACHE_SIZE)(
+                partial(_longest_suffix, _compile_suffix_trie(types))),
+            encoded_types={
+                suffix: (json.dumps(val["mappings"]), json.dumps(val["file_ext_type"]))
+                for suffix, val in types.items()
+            },
+            datatype_mappings=datatype_mappings,
+            datatype_mappings_json=json.dumps(datatype_mappings).encode(),
+        )
+
+
+def _file_signature(path: str) -> tuple:
+    # a file that is replaced or rewritten changes at least one of these
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
 
 
 class AutoDetectUtils:
     _MAPPINGS = None  # expects to be set by config
+    # the current snapshot, which is replaced as a whole when the mappings change
+    _SNAPSHOT: MappingsSnapshot = None
+    # the file the mappings were loaded from and its signature when it was last loaded
+    _MAPPINGS_FILE = None
+    _MAPPINGS_FILE_SIGNATURE = None
+
+    @staticmethod
+    def set_mappings(mappings: dict):
+        """
+        Set the file extension mappings and build the lookup structures built from them. The
+        new mappings replace the old ones in a single step.
+        :param mappings: the contents of the supported_apps_w_extensions.json file.
+        """
+        AutoDetectUtils._SNAPSHOT = MappingsSnapshot.build(mappings)
+        AutoDetectUtils._MAPPINGS = mappings
+
+    @staticmethod
+    def load_mappings(path: str):
+        """
+        Load the file extension mappings from a supported_apps_w_extensions.json file, which is
+        reloaded by reload_mappings_if_changed when it changes.
+        """
+        signature = _file_signature(path)
+        with open(path) as f:
+            mappings = json.load(f)
+        AutoDetectUtils.set_mappings(mappings)
+        AutoDetectUtils._MAPPINGS_FILE = path
+        AutoDetectUtils._MAPPINGS_FILE_SIGNATURE = signature
+
+    @staticmethod
+    def reload_mappings_if_changed() -> bool:
+        """
+        Reload the file extension mappings if the file they were loaded from has changed since
+        it was last loaded. If the file can't be loaded the current mappings are kept, and it
+        isn't loaded again until it changes again.
+        :return: True if the mappings were reloaded.
+        """
+        path = AutoDetectUtils._MAPPINGS_FILE
+        if path is None:
+            return False
+        signature = _file_signature(path)
+        if signature == AutoDetectUtils._MAPPINGS_FILE_SIGNATURE:
+            return False
+        AutoDetectUtils._MAPPINGS_FILE_SIGNATURE = signature
+        with open(path) as f:
+            mappings = json.load(f)
+        AutoDetectUtils.set_mappings(mappings)
+        return True
+
+    @staticmethod
+    def get_snapshot() -> MappingsSnapshot:
+        """
+        Get the current mappings and their lookup structures. Use the same snapshot throughout
+        a request so it isn't affected by the mappings being reloaded.
+        """
+        return AutoDetectUtils._SNAPSHOT
+
+    @staticmethod
+    def get_mappings_version() -> str:
+        """
+        Get a string that identifies the current mappings, which changes when they change.
+        """
+        return AutoDetectUtils._SNAPSHOT.version
 
     @staticmethod
     def determine_possible_importers(filename: str) -> Tuple[Optional[list], Dict[str, object]]:
@@ -18,25 +192,27 @@ class AutoDetectUtils:
             The fileinfo dict, containing:
                 the file prefix
                 the file suffix, if a suffix matched a mapping
-                the file types, if a suffix matched a mapping, otherwise an empty list 
-        """
-        dotcount = filename.count(".")
-        if dotcount:
-            # preferentially choose the most specific suffix (e.g. longest)
-            # to get file type mappings
-            m = AutoDetectUtils._MAPPINGS
-            for i in range(1, dotcount + 1):
-                parts = filename.split(".", i)
-                suffix = parts[-1].lower()
-                if suffix in m["types"]:
-                    prefix = ".".join(parts[0:i])
-                    return (
-                        m["types"][suffix]["mappings"],
-                        {"prefix": prefix,
-                         "suffix": parts[-1],
-                         "file_ext_type": m["types"][suffix]["file_ext_type"],
-                        }
-                    )
+                the file types, if a suffix matched a mapping, otherwise an empty list
+        """
+        return AutoDetectUtils._determine_possible_importers(AutoDetectUtils._SNAPSHOT, filename)
+
+    @staticmethod
+    def _determine_possible_importers(
+        snapshot: MappingsSnapshot, filename: str
+    ) -> Tuple[Optional[list], Dict[str, object]]:
+        # preferentially choose the most specific suffix (e.g. longest)
+        # to get file type mappings
+        match = snapshot.longest_suffix(filename)
+        if match:
+            dot, suffix = match
+            m = snapshot.mappings
+            return (
+                m["types"][suffix]["mappings"],
+                {"prefix": filename[:dot],
+                 "suffix": filename[dot + 1:],
+                 "file_ext_type": m["types"][suffix]["file_ext_type"],
+                }
+            )
         return None, {"prefix": filename, "suffix": None, "file_ext_type": []}
 
     @staticmethod
@@ -48,10 +224,11 @@ class AutoDetectUtils:
             and information about each file, currently the file prefix and the suffix used to
             determine the mappings and a list of file types.
         """
+        snapshot = AutoDetectUtils._SNAPSHOT
         mappings = []
         fileinfo = []
         for filename in file_list:
-            typemaps, fi = AutoDetectUtils.determine_possible_importers(filename)
+            typemaps, fi = AutoDetectUtils._determine_possible_importers(snapshot, filename)
             mappings.append(typemaps)
             fileinfo.append(fi)
         rv = {
@@ -59,3 +236,35 @@ class AutoDetectUtils:
             "fileinfo": fileinfo,
         }
         return rv
+
+    @staticmethod
+    def get_mappings_json(file_list: list, snapshot: MappingsSnapshot = None) -> bytes:
+        """
+        Get the same result as get_mappings, encoded as JSON. The JSON of the mappings of each
+        suffix is encoded once when the mappings are set and spliced into the result.
+        :param file_list: A list of files
+        :param snapshot: the mappings to use, by default the current mappings.
+        :return: the JSON encoded result.
+        """
+        snapshot = snapshot or AutoDetectUtils._SNAPSHOT
+        mappings = []
+        fileinfo = []
+        for filename in file_list:
+            match = snapshot.longest_suffix(filename)
+            if match:
+                dot, suffix = match
+                typemaps, file_ext_type = snapshot.encoded_types[suffix]
+                prefix = encode_basestring_ascii(filename[:dot])
+                suffix_json = encode_basestring_ascii(filename[dot + 1:])
+            else:
+                typemaps, file_ext_type = "null", "[]"
+                prefix = encode_basestring_ascii(filename)
+                suffix_json = "null"
+            mappings.append(typemaps)
+            fileinfo.append(
+                f'{{"prefix": {prefix}, "suffix": {suffix_json}, "file_ext_type": {file_ext_type}}}'
+            )
+        return (
+            '{"mappings": [' + ", ".join(mappings)
+            + '], "fileinfo": [' + ", ".join(fileinfo) + "]}"
+        ).encode()
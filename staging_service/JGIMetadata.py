@@ -1,3 +1,4 @@
+from .blocking_io import run_blocking
 from .utils import Path
 from json import JSONDecoder
 import aiofiles
@@ -8,7 +9,7 @@ decoder = JSONDecoder()
 
 
 async def read_metadata_for(path: Path):
-    if os.path.exists(path.jgi_metadata) and os.path.isfile(path.jgi_metadata):
+    if await run_blocking(os.path.isfile, path.jgi_metadata):
         async with aiofiles.open(path.jgi_metadata, mode="r") as json:
             data = await json.read()
             return decoder.decode(data)
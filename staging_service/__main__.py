@@ -1,5 +1,5 @@
 from .app import app_factory
-from aiohttp import web
+from . import prefork
 import asyncio
 import os
 import uvloop
@@ -9,4 +9,12 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # for speed of event lo
 
 config = configparser.ConfigParser()
 config.read(os.environ["KB_DEPLOYMENT_CONFIG"])
-web.run_app(app_factory(config), port=3000)
+# 0 starts a worker per CPU
+workers = int(config["staging_service"].get("WORKERS", 1)) or os.cpu_count()
+prefork.serve(
+    lambda worker_index: app_factory(config, worker_index),
+    workers,
+    3000,
+    float(config["staging_service"].get(
+        "WORKER_SHUTDOWN_TIMEOUT_SEC", prefork.DEFAULT_SHUTDOWN_TIMEOUT_SEC)),
+)
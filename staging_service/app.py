@@ -1,11 +1,15 @@
+import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
 import shutil
 import sys
-from collections import defaultdict
+import time
 from urllib.parse import parse_qs
 from pathlib import Path as PathPy
+from typing import Callable, Optional
 
 import aiohttp_cors
 from aiohttp import web
@@ -13,10 +17,37 @@ from aiohttp import web
 from .app_error_formatter import format_import_spec_errors
 from .AutoDetectUtils import AutoDetectUtils
 from .JGIMetadata import read_metadata_for
-from .auth2Client import KBaseAuth2
-from .globus import assert_globusid_exists, is_globusid
-from .metadata import some_metadata, dir_info, add_upa, similar
-from .utils import Path, run_command, AclManager
+from .auth2Client import KBaseAuth2, token_cache_from_config
+from .blocking_io import run_blocking
+from . import blocking_io
+from . import decompress_jobs
+from . import dir_index
+from . import http_client
+from . import download
+from . import extraction
+from . import upload_sessions
+from .globus import assert_globusid_exists, forget_user, is_globusid
+from . import globus
+from .metadata import (
+    some_metadata,
+    write_metadata,
+    FileDigest,
+    PartsDigest,
+    md5_file,
+    dir_info,
+    dir_page,
+    iter_dir_info,
+    add_upa,
+    similar,
+    update_index,
+    remove_from_index,
+    move_in_index,
+    flush_sources,
+    remove_metadata,
+    move_metadata,
+)
+from . import metadata_store
+from .utils import Path, AclManager
 from .import_specifications.file_parser import (
     ErrorType,
     FileTypeResolution,
@@ -34,12 +65,32 @@ from .autodetect.Mappings import CSV, TSV, EXCEL
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 routes = web.RouteTableDef()
-VERSION = "1.3.6"
+VERSION = "1.4.0"
 
-_DATATYPE_MAPPINGS = None
+_DEFAULT_MAPPINGS_POLL_SEC = 10
+_DEFAULT_SOURCE_FLUSH_SEC = 5
 
 _APP_JSON = "application/json"
 
+# the formats of streamed listings and their content types
+_STREAM_FORMATS = {"ndjson": "application/x-ndjson", "json": _APP_JSON}
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+# how many levels of folders /list returns when no depth is given, or None for all of them
+_list_default_depth = None
+
+_UPLOAD_WRITE_SIZE = 1024 * 1024
+_UPLOAD_SOURCE = "KBase upload"
+
+_DEFAULT_UPLOAD_SESSION_TTL_SEC = 24 * 60 * 60
+_upload_session_ttl_sec = _DEFAULT_UPLOAD_SESSION_TTL_SEC
+# session ID -> (bytes digested, FileDigest, time last used) for resumable uploads received by
+# this process
+_upload_session_digests = {}
+
+_DECOMPRESS_JOB_TTL_SEC = 7 * 24 * 60 * 60
+_decompress_jobs = None
+
 _IMPSPEC_FILE_TO_PARSER = {
     CSV: parse_csv,
     TSV: parse_tsv,
@@ -62,9 +113,26 @@ async def importer_filetypes(request: web.Request) -> web.json_response:
     * filetype_to_extensions, which maps file types (e.g. FASTA) to their extensions (e.g.
       *.fa, *.fasta, *.fa.gz, etc.)
 
-    This information is currently static over the life of the server.
+    This information changes when the mappings file is changed.
+    """
+    snapshot = AutoDetectUtils.get_snapshot()
+    return _encoded_json_response(
+        request, f'"{snapshot.version}"', lambda: snapshot.datatype_mappings_json)
+
+
+def _encoded_json_response(
+    request: web.Request, etag: str, encode: Callable[[], bytes]
+) -> web.Response:
     """
-    return web.json_response(data=_DATATYPE_MAPPINGS)
+    Returns 304 if the client's cached copy of the response is current, otherwise the JSON
+    returned by encode.
+    """
+    # clients may cache the response but must revalidate it, as the mappings can change
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if "If-None-Match" in request.headers and download.not_modified(request.headers, etag, 0):
+        return web.Response(status=304, headers=headers)
+    return web.Response(
+        body=encode(), content_type=_APP_JSON, charset="utf-8", headers=headers)
 
 
 @routes.get("/importer_mappings/{query:.*}")
@@ -82,8 +150,12 @@ async def importer_mappings(request: web.Request) -> web.json_response:
             text=f"must provide file_list field. Your provided qs: {request.query_string}",
             )
 
-    mappings = AutoDetectUtils.get_mappings(file_list)
-    return web.json_response(data=mappings)
+    # the response only depends on the files and the mappings
+    snapshot = AutoDetectUtils.get_snapshot()
+    etag = '"{}-{}"'.format(
+        snapshot.version, hashlib.md5(json.dumps(file_list).encode()).hexdigest())
+    return _encoded_json_response(
+        request, etag, lambda: AutoDetectUtils.get_mappings_json(file_list, snapshot))
 
 
 def _file_type_resolver(path: PathPy) -> FileTypeResolution:
@@ -116,7 +188,8 @@ async def bulk_specification(request: web.Request) -> web.json_response:
         p = Path.validate_path(username, f)
         paths[PathPy(p.full_path)] = PathPy(p.user_path)
     # list(dict) returns a list of the dict keys in insertion order (py3.7+)
-    res = parse_import_specifications(
+    res = await run_blocking(
+        parse_import_specifications,
         tuple(list(paths)),
         _file_type_resolver,
         lambda e: logging.error("Unexpected error while parsing import specs", exc_info=e))
@@ -185,12 +258,14 @@ async def write_bulk_specification(request: web.Request) -> web.json_response:
     if not writer:
         return _createJSONErrorResponse(f"Invalid output_file_type: {type_}")
     folder = Path.validate_path(username, folder)
-    os.makedirs(folder.full_path, exist_ok=True)
+    await run_blocking(os.makedirs, folder.full_path, exist_ok=True)
     try:
-        files = writer(PathPy(folder.full_path), data.get("types"))
+        files = await run_blocking(writer, PathPy(folder.full_path), data.get("types"))
     except ImportSpecWriteException as e:
         return _createJSONErrorResponse(e.args[0])
     new_files = {ty: str(PathPy(folder.user_path) / files[ty]) for ty in files}
+    for f in set(files.values()):
+        await update_index(Path.from_full_path(os.path.join(folder.full_path, f)))
     return web.json_response({"output_file_type": type_, "files_created": new_files})
 
 
@@ -204,9 +279,9 @@ async def add_acl_concierge(request: web.Request):
     username = await authorize_request(request)
     user_dir = Path.validate_path(username).full_path
     concierge_path = f"{Path._CONCIERGE_PATH}/{username}/"
-    aclm = AclManager()
-    result = aclm.add_acl_concierge(
-        shared_directory=user_dir, concierge_path=concierge_path
+    aclm = await run_blocking(AclManager)
+    result = await run_blocking(
+        aclm.add_acl_concierge, shared_directory=user_dir, concierge_path=concierge_path
     )
     result[
         "msg"
@@ -221,7 +296,8 @@ async def add_acl_concierge(request: web.Request):
 async def add_acl(request: web.Request):
     username = await authorize_request(request)
     user_dir = Path.validate_path(username).full_path
-    result = AclManager().add_acl(user_dir)
+    aclm = await run_blocking(AclManager)
+    result = await run_blocking(aclm.add_acl, user_dir)
     return web.json_response(result)
 
 
@@ -229,7 +305,8 @@ async def add_acl(request: web.Request):
 async def remove_acl(request: web.Request):
     username = await authorize_request(request)
     user_dir = Path.validate_path(username).full_path
-    result = AclManager().remove_acl(user_dir)
+    aclm = await run_blocking(AclManager)
+    result = await run_blocking(aclm.remove_acl, user_dir)
     return web.json_response(result)
 
 
@@ -238,6 +315,25 @@ async def test_service(request: web.Request):
     return web.Response(text="staging service version: {}".format(VERSION))
 
 
+@routes.get("/blocking-io-stats")
+async def blocking_io_stats(request: web.Request):
+    """
+    Returns the statistics for the pool of threads that runs blocking file system work. A
+    queue that is often non-empty means the pool should be larger.
+    """
+    await authorize_request(request)
+    return web.json_response(blocking_io.get_executor().stats())
+
+
+@routes.get("/token-cache-stats")
+async def token_cache_stats(request: web.Request):
+    """
+    Returns the size of the auth token cache and its hit, miss and eviction counts.
+    """
+    await authorize_request(request)
+    return web.json_response(await auth_client.cache_stats())
+
+
 @routes.get("/test-auth")
 async def test_auth(request: web.Request):
     username = await authorize_request(request)
@@ -275,6 +371,136 @@ async def file_exists(request: web.Request):
     return web.json_response({"exists": exists, "isFolder": isFolder})
 
 
+def _positive_int_query(request: web.Request, name: str) -> Optional[int]:
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise web.HTTPBadRequest(text=f"{name} must be a positive integer")
+    return value
+
+
+def _depth_query(request: web.Request, default: Optional[int]) -> Optional[int]:
+    value = request.query.get("depth")
+    if value is None:
+        return default
+    try:
+        depth = int(value)
+    except ValueError:
+        depth = -1
+    if depth < 0:
+        raise web.HTTPBadRequest(text="depth must be a non-negative integer")
+    # 0 lists every level
+    return depth or None
+
+
+def _encode_cursor(sort: str, key: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort, key]).encode()).decode()
+
+
+def _decode_cursor(cursor: str, sort: str) -> list:
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        path = key if cursor_sort == "path" else key[1]
+        valid = (
+            cursor_sort == sort
+            and isinstance(path, list) and all(isinstance(p, str) for p in path)
+            and (cursor_sort == "path" or (len(key) == 2 and type(key[0]) is int))
+        )
+    except (ValueError, TypeError, IndexError):
+        valid = False
+    if not valid:
+        raise web.HTTPBadRequest(text="invalid cursor")
+    return key
+
+
+async def _listing_response(
+    request: web.Request,
+    path: Path,
+    show_hidden: bool,
+    query: str,
+    default_sort: str,
+    default_depth: Optional[int] = None,
+) -> web.Response:
+    """
+    Returns the entries below a folder, or a page of them if the limit query parameter is
+    given. The X-Next-Cursor header of a page that isn't the last is the cursor query
+    parameter that gets the next page. The sort and depth query parameters set the order of
+    the entries and how many levels of folders below the folder are included, where a depth
+    of 0 includes every level. If the stream query parameter is given, every entry is streamed
+    instead, see _stream_listing.
+    """
+    sort = request.query.get("sort", default_sort)
+    if sort not in dir_index.SORTS:
+        raise web.HTTPBadRequest(text=f"sort must be one of {', '.join(dir_index.SORTS)}")
+    limit = _positive_int_query(request, "limit")
+    depth = _depth_query(request, default_depth)
+    cursor = request.query.get("cursor")
+    stream = request.query.get("stream")
+    if stream is not None:
+        if stream not in _STREAM_FORMATS:
+            raise web.HTTPBadRequest(
+                text=f"stream must be one of {', '.join(_STREAM_FORMATS)}")
+        if limit is not None or cursor:
+            raise web.HTTPBadRequest(text="stream can't be used with limit or cursor")
+        return await _stream_listing(
+            request, stream, iter_dir_info(path, show_hidden, query, depth, sort))
+    after = _decode_cursor(cursor, sort) if cursor else None
+    entries, next_key = await dir_page(path, show_hidden, query, depth, sort, limit, after)
+    headers = {}
+    if next_key is not None:
+        headers["X-Next-Cursor"] = _encode_cursor(sort, next_key)
+    return web.json_response(entries, headers=headers)
+
+
+async def _stream_listing(
+    request: web.Request, fmt: str, entries
+) -> web.StreamResponse:
+    """
+    Streams the entries below a folder as they are read, either as newline delimited JSON
+    (ndjson) or as a JSON array (json). The headers, and the start of the array, are sent
+    before the folder is read, so memory use doesn't grow with the size of the listing.
+    """
+    try:
+        response = web.StreamResponse(headers={"Content-Type": _STREAM_FORMATS[fmt]})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        if request.method == "HEAD":
+            await response.write_eof()
+            return response
+        if fmt == "json":
+            await response.write(b"[")
+        # an error once the headers have been sent drops the connection, so the client sees
+        # the listing is incomplete; a JSON array won't have its closing bracket
+        chunk = []
+        size = 0
+        separator = ""
+        async for entry in entries:
+            if fmt == "ndjson":
+                text = json.dumps(entry) + "\n"
+            else:
+                text = separator + json.dumps(entry)
+                separator = ","
+            chunk.append(text)
+            size += len(text)
+            if size >= _STREAM_CHUNK_SIZE:
+                await response.write("".join(chunk).encode())
+                chunk = []
+                size = 0
+        if fmt == "json":
+            chunk.append("]")
+        if chunk:
+            await response.write("".join(chunk).encode())
+        await response.write_eof()
+        return response
+    finally:
+        await entries.aclose()
+
+
 @routes.get("/list/{path:.*}")
 @routes.get("/list")
 async def list_files(request: web.Request):
@@ -283,11 +509,11 @@ async def list_files(request: web.Request):
     """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info.get("path", ""))
-    if not os.path.exists(path.full_path):
+    if not await run_blocking(os.path.exists, path.full_path):
         raise web.HTTPNotFound(
             text="path {path} does not exist".format(path=path.user_path)
         )
-    elif os.path.isfile(path.full_path):
+    elif await run_blocking(os.path.isfile, path.full_path):
         raise web.HTTPBadRequest(
             text="{path} is a file not a directory".format(path=path.full_path)
         )
@@ -299,28 +525,99 @@ async def list_files(request: web.Request):
             show_hidden = False
     except KeyError as no_query:
         show_hidden = False
-    data = await dir_info(path, show_hidden, recurse=True)
-    return web.json_response(data)
+    return await _listing_response(
+        request, path, show_hidden, "", "path", _list_default_depth)
 
 
 @routes.get("/download/{path:.*}")
 async def download_files(request: web.Request):
     """
     download a file
+    supports conditional requests with If-None-Match and If-Modified-Since, and single or
+    multiple byte ranges with Range and If-Range
     """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info.get("path", ""))
-    if not os.path.exists(path.full_path):
+    if not await run_blocking(os.path.exists, path.full_path):
         raise web.HTTPNotFound(
             text="path {path} does not exist".format(path=path.user_path)
         )
-    elif not os.path.isfile(path.full_path):
+    elif not await run_blocking(os.path.isfile, path.full_path):
         raise web.HTTPBadRequest(
             text="{path} is a directory not a file".format(path=path.full_path)
         )
-    # hard coding the mime type to force download
-    return web.FileResponse(
-        path.full_path, headers={"content-type": "application/octet-stream"}
+    f = await run_blocking(open, path.full_path, "rb")
+    try:
+        # stat the open file so the validators match the data that is sent
+        st = await run_blocking(os.fstat, f.fileno())
+        etag = download.etag(st)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": download.last_modified(st),
+            "Accept-Ranges": "bytes",
+        }
+        if download.not_modified(request.headers, etag, st.st_mtime):
+            return web.Response(status=304, headers=headers)
+        ranges = None
+        if "Range" in request.headers and download.if_range_matches(
+            request.headers, etag, st.st_mtime
+        ):
+            try:
+                ranges = download.parse_range(request.headers["Range"], st.st_size)
+            except download.RangeNotSatisfiableException:
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={"Content-Range": f"bytes */{st.st_size}"}
+                )
+        # the mime type is hard coded to force download
+        return await download.send_file(request, f.fileno(), st.st_size, ranges, headers)
+    finally:
+        await run_blocking(f.close)
+
+
+@routes.get("/download-archive/{path:.*}")
+async def download_archive(request: web.Request):
+    """
+    download a folder, or a selection of files and folders, as an archive that is written
+    as it is sent
+    query parameters:
+        format - zip (the default), tar or tar.gz.
+        files - a comma separated list of files and folders to include, relative to the path.
+            If not provided, the path itself is included.
+        showHidden - whether to include files and folders starting with a '.' that are inside
+            included folders.
+    """
+    username = await authorize_request(request)
+    path = Path.validate_path(username, request.match_info.get("path", ""))
+    fmt = request.query.get("format", "zip")
+    if fmt not in download.ARCHIVE_FORMATS:
+        raise web.HTTPBadRequest(
+            text=f"format must be one of {', '.join(download.ARCHIVE_FORMATS)}"
+        )
+    show_hidden = request.query.get("showHidden", "").lower() == "true"
+    files = [f.strip() for f in request.query.get("files", "").split(",") if f.strip()]
+    base = path.user_path.rstrip("/")
+    if files:
+        selections = []
+        for f in files:
+            selected = Path.validate_path(
+                username, os.path.join(request.match_info.get("path", ""), f))
+            name = selected.user_path[len(base) + 1:]
+            if not selected.user_path.startswith(base + "/") or not name:
+                raise web.HTTPBadRequest(text=f"{f} is not within {path.user_path}")
+            selections.append((selected, name))
+    else:
+        selections = [(path, os.path.basename(base))]
+    for selected, _ in selections:
+        if not await run_blocking(os.path.exists, selected.full_path):
+            raise web.HTTPNotFound(
+                text="path {path} does not exist".format(path=selected.user_path)
+            )
+    return await download.send_archive(
+        request,
+        fmt,
+        [(selected.full_path, name) for selected, name in selections],
+        show_hidden,
+        f"{os.path.basename(base)}.{fmt}",
     )
 
 
@@ -331,11 +628,11 @@ async def similar_files(request: web.Request):
     """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info["path"])
-    if not os.path.exists(path.full_path):
+    if not await run_blocking(os.path.exists, path.full_path):
         raise web.HTTPNotFound(
             text="path {path} does not exist".format(path=path.user_path)
         )
-    elif os.path.isdir(path.full_path):
+    elif await run_blocking(os.path.isdir, path.full_path):
         raise web.HTTPBadRequest(
             text="{path} is a directory not a file".format(path=path.full_path)
         )
@@ -372,9 +669,7 @@ async def search(request: web.Request):
             show_hidden = False
     except KeyError as no_query:
         show_hidden = False
-    results = await dir_info(user_dir, show_hidden, query)
-    results.sort(key=lambda x: x["mtime"], reverse=True)
-    return web.json_response(results)
+    return await _listing_response(request, user_dir, show_hidden, query, "mtime")
 
 
 @routes.get("/metadata/{path:.*}")
@@ -385,7 +680,7 @@ async def get_metadata(request: web.Request):
     """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info["path"])
-    if not os.path.exists(path.full_path):
+    if not await run_blocking(os.path.exists, path.full_path):
         raise web.HTTPNotFound(
             text="path {path} does not exist".format(path=path.user_path)
         )
@@ -402,6 +697,28 @@ async def get_jgi_metadata(request: web.Request):
     return web.json_response(await read_metadata_for(path))
 
 
+def _check_upload_filename(filename: str):
+    if filename.lstrip() != filename:
+        raise web.HTTPForbidden(  # forbidden isn't really the right code, should be 400
+            text="cannot upload file with name beginning with space"
+        )
+    if "," in filename:
+        raise web.HTTPForbidden(  # for consistency we use 403 again
+            text="cannot upload file with ',' in name"
+        )
+    # may want to make this configurable if we ever decide to add a hidden files toggle to
+    # the staging area UI
+    if filename.startswith("."):
+        raise web.HTTPForbidden(  # for consistency we use 403 again
+            text="cannot upload file with name beginning with '.'"
+        )
+
+
+def _write_and_digest(f, digest: FileDigest, data: bytes):
+    f.write(data)
+    digest.update(data)
+
+
 @routes.post("/upload")
 async def upload_files_chunked(request: web.Request):
     """
@@ -434,47 +751,450 @@ async def upload_files_chunked(request: web.Request):
         raise web.HTTPBadRequest(text="must provide destPath and uploads in body")
 
     filename: str = user_file.filename
-    if filename.lstrip() != filename:
-        raise web.HTTPForbidden(  # forbidden isn't really the right code, should be 400
-            text="cannot upload file with name beginning with space"
-        )
-    if "," in filename:
-        raise web.HTTPForbidden(  # for consistency we use 403 again
-            text="cannot upload file with ',' in name"
-        )
-    # may want to make this configurable if we ever decide to add a hidden files toggle to
-    # the staging area UI
-    if filename.startswith("."):
-        raise web.HTTPForbidden(  # for consistency we use 403 again
-            text="cannot upload file with name beginning with '.'"
-        )
+    _check_upload_filename(filename)
 
     size = 0
     destPath = os.path.join(destPath, filename)
     path = Path.validate_path(username, destPath)
-    os.makedirs(os.path.dirname(path.full_path), exist_ok=True)
-    with open(path.full_path, "wb") as f:  # TODO should we handle partial file uploads?
+    await run_blocking(os.makedirs, os.path.dirname(path.full_path), exist_ok=True)
+    # the metadata is computed as the file is written so it never needs to be read back
+    digest = FileDigest()
+    f = await run_blocking(open, path.full_path, "wb")
+    # an interrupted upload has to be sent again; clients that need to resume use /upload-session
+    try:
+        # buffer the small multipart chunks so each write to disk is worth a thread hand off
+        buffer = bytearray()
         while True:
             chunk = await user_file.read_chunk()
+            size += len(chunk)
+            buffer += chunk
+            if buffer and (not chunk or len(buffer) >= _UPLOAD_WRITE_SIZE):
+                await run_blocking(_write_and_digest, f, digest, bytes(buffer))
+                buffer.clear()
             if not chunk:
                 break
-            size += len(chunk)
-            f.write(chunk)
+    finally:
+        await run_blocking(f.close)
 
-    if not os.path.exists(path.full_path):
+    if not await run_blocking(os.path.exists, path.full_path):
         error_msg = "We are sorry but upload was interrupted. Please try again.".format(
             path=path.full_path
         )
         raise web.HTTPNotFound(text=error_msg)
 
+    await write_metadata(path, _UPLOAD_SOURCE, digest)
+    await update_index(path, source=_UPLOAD_SOURCE)
+    response = await some_metadata(
+        path,
+        desired_fields=["name", "path", "mtime", "size", "isFolder"],
+        source=_UPLOAD_SOURCE,
+    )
+    return web.json_response([response])
+
+
+@routes.post("/upload-session")
+async def create_upload_session(request: web.Request):
+    """
+    Starts a resumable upload. Expects a JSON body with the keys:
+        destPath - the folder to upload the file to.
+        filename - the name of the file.
+        size - the size of the file in bytes.
+    Returns the session ID and the current offset of the upload, which is 0. The data is then
+    sent with PATCH requests to /upload-session/{session_id}.
+    """
+    username = await authorize_request(request)
+    if request.content_type != _APP_JSON:
+        return _createJSONErrorResponse(
+            f"Required content-type is {_APP_JSON}",
+            error_class=web.HTTPUnsupportedMediaType)
+    data = await request.json()
+    if not isinstance(data, dict):
+        return _createJSONErrorResponse("The top level JSON element must be a mapping")
+    dest = data.get("destPath")
+    filename = data.get("filename")
+    size = data.get("size")
+    if not isinstance(dest, str):
+        return _createJSONErrorResponse("destPath is required and must be a string")
+    if not isinstance(filename, str) or not filename:
+        return _createJSONErrorResponse("filename is required and must be a string")
+    if type(size) is not int or size < 1:
+        return _createJSONErrorResponse("size is required and must be a positive integer")
+    _check_upload_filename(filename)
+    path = Path.validate_path(username, os.path.join(dest, filename))
+    if path.name != filename:
+        return _createJSONErrorResponse(f"Invalid filename: {filename}")
+    session = await run_blocking(upload_sessions.create_session, username, path, size)
+    return web.json_response(
+        _upload_session_json(session, 0),
+        status=201,
+        headers={"Location": f"/upload-session/{session.session_id}"},
+    )
+
+
+def _upload_session_json(session: upload_sessions.UploadSession, offset: int):
+    return {
+        "session_id": session.session_id,
+        "path": session.user_path,
+        "size": session.size,
+        "offset": offset,
+    }
+
+
+async def _get_upload_session(
+    request: web.Request, multipart: bool = False
+) -> upload_sessions.UploadSession:
+    username = await authorize_request(request)
+    session_id = request.match_info["session_id"]
+    session = await run_blocking(
+        upload_sessions.get_session, session_id, username, _upload_session_ttl_sec
+    )
+    if not session:
+        # expired, completed or deleted, possibly by another process
+        _upload_session_digests.pop(session_id, None)
+    if not session or (session.part_size is not None) != multipart:
+        raise _upload_not_found(session_id, multipart)
+    return session
+
+
+def _upload_not_found(session_id: str, multipart: bool = False) -> web.HTTPNotFound:
+    kind = "multipart upload" if multipart else "upload session"
+    return web.HTTPNotFound(text=f"no {kind} {session_id}")
+
+
+def _remove_expired_digests():
+    # a digest that hasn't been used for the time to live belongs to a session that has expired,
+    # or one whose data is now being received by another process
+    cutoff = time.time() - _upload_session_ttl_sec
+    for session_id, (_, _, last_used) in list(_upload_session_digests.items()):
+        if last_used < cutoff:
+            del _upload_session_digests[session_id]
+
+
+def _upload_offset_headers(session: upload_sessions.UploadSession, offset: int):
+    return {
+        "Upload-Offset": str(offset),
+        "Upload-Length": str(session.size),
+        "Cache-Control": "no-store",
+    }
+
+
+@routes.head("/upload-session/{session_id}")
+async def upload_session_offset(request: web.Request):
+    """
+    Returns the current offset of a resumable upload in the Upload-Offset header.
+    """
+    session = await _get_upload_session(request)
+    offset = await run_blocking(upload_sessions.get_offset, session)
+    return web.Response(headers=_upload_offset_headers(session, offset))
+
+
+@routes.patch("/upload-session/{session_id}")
+async def append_upload_session(request: web.Request):
+    """
+    Appends the request body to a resumable upload. The Upload-Offset header must match the
+    current offset of the upload. Returns 204 with the new offset in the Upload-Offset header,
+    or, once all the data has been received, moves the file into place and returns its
+    metadata as the upload endpoint does.
+    """
+    session = await _get_upload_session(request)
+    try:
+        offset = int(request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text="must provide an integer Upload-Offset header")
+    if request.content_length is not None and offset + request.content_length > session.size:
+        raise web.HTTPBadRequest(text="the data would exceed the size of the upload")
+    try:
+        f = await run_blocking(upload_sessions.open_for_append, session, offset)
+    except upload_sessions.OffsetMismatchException as e:
+        raise web.HTTPConflict(text=e.args[0], headers=_upload_offset_headers(session, e.offset))
+    except upload_sessions.SessionBusyException as e:
+        raise web.HTTPConflict(text=e.args[0])
+    except upload_sessions.SessionNotFoundException:
+        _upload_session_digests.pop(session.session_id, None)
+        raise _upload_not_found(session.session_id)
+    # the digest only survives in this process, so if an earlier chunk was received elsewhere
+    # the metadata is generated from the finished file instead
+    written, digest, _ = _upload_session_digests.pop(
+        session.session_id, (0, FileDigest(), None))
+    if written != offset:
+        digest = None
+    written = offset
+    try:
+        buffer = bytearray()
+        while True:
+            chunk = await request.content.read(_UPLOAD_WRITE_SIZE)
+            buffer += chunk
+            if written + len(buffer) > session.size:
+                await run_blocking(f.truncate, offset)
+                digest = None
+                raise web.HTTPBadRequest(text="the data would exceed the size of the upload")
+            if buffer and (not chunk or len(buffer) >= _UPLOAD_WRITE_SIZE):
+                if digest:
+                    await run_blocking(_write_and_digest, f, digest, bytes(buffer))
+                else:
+                    await run_blocking(f.write, bytes(buffer))
+                written += len(buffer)
+                buffer.clear()
+            if not chunk:
+                break
+        if written == session.size:
+            # completed while the file is still locked, so a concurrent request for the same
+            # offset finds the upload gone rather than completing it again
+            await run_blocking(upload_sessions.complete_session, session)
+    finally:
+        await run_blocking(f.close)
+        if digest and written < session.size:
+            _upload_session_digests[session.session_id] = (written, digest, time.time())
+    if written < session.size:
+        return web.Response(status=204, headers=_upload_offset_headers(session, written))
+    path = session.path
+    if digest:
+        await write_metadata(path, _UPLOAD_SOURCE, digest)
+    await update_index(path, source=_UPLOAD_SOURCE)
     response = await some_metadata(
         path,
         desired_fields=["name", "path", "mtime", "size", "isFolder"],
-        source="KBase upload",
+        source=_UPLOAD_SOURCE,
+    )
+    return web.json_response([response], headers=_upload_offset_headers(session, written))
+
+
+@routes.delete("/upload-session/{session_id}")
+async def delete_upload_session(request: web.Request):
+    """
+    Abandons a resumable upload and removes the data received so far.
+    """
+    session = await _get_upload_session(request)
+    _upload_session_digests.pop(session.session_id, None)
+    await run_blocking(upload_sessions.delete_session, session)
+    return web.Response(text=f"successfully deleted upload session {session.session_id}")
+
+
+@routes.post("/multipart-upload")
+async def create_multipart_upload(request: web.Request):
+    """
+    Starts a multipart upload. Expects a JSON body with the keys:
+        destPath - the folder to upload the file to.
+        filename - the name of the file.
+        size - the size of the file in bytes.
+        partSize - the size of each part in bytes, other than the last part, which holds
+            the remainder of the file.
+    Returns the session ID and the number of parts. The parts are then sent, in any order and
+    concurrently if desired, with PUT requests to /multipart-upload/{session_id}/{part_number}.
+    """
+    username = await authorize_request(request)
+    if request.content_type != _APP_JSON:
+        return _createJSONErrorResponse(
+            f"Required content-type is {_APP_JSON}",
+            error_class=web.HTTPUnsupportedMediaType)
+    data = await request.json()
+    if not isinstance(data, dict):
+        return _createJSONErrorResponse("The top level JSON element must be a mapping")
+    dest = data.get("destPath")
+    filename = data.get("filename")
+    size = data.get("size")
+    part_size = data.get("partSize")
+    if not isinstance(dest, str):
+        return _createJSONErrorResponse("destPath is required and must be a string")
+    if not isinstance(filename, str) or not filename:
+        return _createJSONErrorResponse("filename is required and must be a string")
+    if type(size) is not int or size < 1:
+        return _createJSONErrorResponse("size is required and must be a positive integer")
+    if type(part_size) is not int:
+        return _createJSONErrorResponse("partSize is required and must be an integer")
+    _check_upload_filename(filename)
+    path = Path.validate_path(username, os.path.join(dest, filename))
+    if path.name != filename:
+        return _createJSONErrorResponse(f"Invalid filename: {filename}")
+    try:
+        session = await run_blocking(
+            upload_sessions.create_session, username, path, size, part_size)
+    except ValueError as e:
+        return _createJSONErrorResponse(e.args[0])
+    return web.json_response(
+        _multipart_upload_json(session, {}),
+        status=201,
+        headers={"Location": f"/multipart-upload/{session.session_id}"},
+    )
+
+
+def _multipart_upload_json(session: upload_sessions.UploadSession, parts: dict):
+    return {
+        "session_id": session.session_id,
+        "path": session.user_path,
+        "size": session.size,
+        "partSize": session.part_size,
+        "partCount": session.part_count,
+        "parts": [_part_json(n, parts[n]) for n in sorted(parts)],
+    }
+
+
+def _part_json(part_number: int, part: dict):
+    return {"partNumber": part_number, "size": part["size"], "md5": part["md5"]}
+
+
+@routes.get("/multipart-upload/{session_id}")
+async def get_multipart_upload(request: web.Request):
+    """
+    Returns a multipart upload and the parts that have been received, so an interrupted upload
+    can send only the missing parts.
+    """
+    session = await _get_upload_session(request, multipart=True)
+    parts = await run_blocking(upload_sessions.get_parts, session)
+    return web.json_response(
+        _multipart_upload_json(session, parts), headers={"Cache-Control": "no-store"})
+
+
+def _pwrite_and_digest(fd: int, digest: FileDigest, data: bytes, offset: int):
+    # os.pwrite doesn't move the file position, so parts can share a file without seeking
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+    digest.update(data)
+
+
+@routes.put("/multipart-upload/{session_id}/{part_number}")
+async def upload_part(request: web.Request):
+    """
+    Writes a part of a multipart upload. The body must be exactly the length of the part.
+    A part may be sent again, for example if the connection dropped while it was being sent.
+    Returns the part number, size and md5 of the part. The md5 is also returned as the ETag.
+    """
+    session = await _get_upload_session(request, multipart=True)
+    try:
+        part_number = int(request.match_info["part_number"])
+        offset, length = session.part_range(part_number)
+    except ValueError:
+        raise web.HTTPBadRequest(
+            text=f"part number must be an integer between 1 and {session.part_count}")
+    if request.content_length is not None and request.content_length != length:
+        raise web.HTTPBadRequest(text=f"part {part_number} must be {length} bytes")
+    try:
+        f = await run_blocking(upload_sessions.open_part, session, part_number)
+    except upload_sessions.SessionBusyException:
+        raise web.HTTPConflict(text="the upload is being completed")
+    except upload_sessions.SessionNotFoundException:
+        raise _upload_not_found(session.session_id, multipart=True)
+    digest = FileDigest()
+    written = 0
+    try:
+        buffer = bytearray()
+        while True:
+            chunk = await request.content.read(_UPLOAD_WRITE_SIZE)
+            buffer += chunk
+            if written + len(buffer) > length:
+                raise web.HTTPBadRequest(text=f"part {part_number} must be {length} bytes")
+            if buffer and (not chunk or len(buffer) >= _UPLOAD_WRITE_SIZE):
+                await run_blocking(
+                    _pwrite_and_digest, f.fileno(), digest, bytes(buffer), offset + written)
+                written += len(buffer)
+                buffer.clear()
+            if not chunk:
+                break
+        if written != length:
+            raise web.HTTPBadRequest(text=f"part {part_number} must be {length} bytes")
+        part = digest.part(include_head=part_number == 1)
+        await run_blocking(upload_sessions.save_part, session, part_number, part)
+    finally:
+        await run_blocking(f.close)
+    return web.json_response(
+        _part_json(part_number, part), headers={"ETag": f'"{part["md5"]}"'})
+
+
+@routes.post("/multipart-upload/{session_id}/complete")
+async def complete_multipart_upload(request: web.Request):
+    """
+    Completes a multipart upload once all the parts have been received, moving the file into
+    place and returning its metadata as the upload endpoint does. The metadata includes the
+    multipart checksum combined from the md5s of the parts in the partsMd5 field.
+    """
+    session = await _get_upload_session(request, multipart=True)
+    try:
+        f, parts = await run_blocking(upload_sessions.lock_for_completion, session)
+    except upload_sessions.SessionBusyException:
+        raise web.HTTPConflict(text="parts of the upload are still being written")
+    except upload_sessions.SessionNotFoundException:
+        raise _upload_not_found(session.session_id, multipart=True)
+    except upload_sessions.MissingPartsException as e:
+        return _createJSONErrorResponse(e.args[0])
+    path = session.path
+    try:
+        # the md5 of the whole file can't be combined from the md5s of the parts
+        md5 = await run_blocking(md5_file, session.temp_path)
+        await run_blocking(upload_sessions.complete_session, session)
+    finally:
+        await run_blocking(f.close)
+    await write_metadata(path, _UPLOAD_SOURCE, PartsDigest(parts, md5))
+    await update_index(path, source=_UPLOAD_SOURCE)
+    response = await some_metadata(
+        path,
+        desired_fields=["name", "path", "mtime", "size", "isFolder"],
+        source=_UPLOAD_SOURCE,
     )
     return web.json_response([response])
 
 
+@routes.delete("/multipart-upload/{session_id}")
+async def delete_multipart_upload(request: web.Request):
+    """
+    Abandons a multipart upload and removes the parts received so far.
+    """
+    session = await _get_upload_session(request, multipart=True)
+    await run_blocking(upload_sessions.delete_session, session)
+    return web.Response(text=f"successfully deleted multipart upload {session.session_id}")
+
+
+async def _remove_expired_digests_periodically():
+    while True:
+        await asyncio.sleep(min(max(_upload_session_ttl_sec / 4, 1), 3600))
+        _remove_expired_digests()
+
+
+async def _remove_expired_state():
+    while True:
+        # check several times per time to live so sessions don't outlive it by much
+        await asyncio.sleep(min(max(_upload_session_ttl_sec / 4, 1), 3600))
+        try:
+            removed = await run_blocking(
+                upload_sessions.remove_expired_sessions, _upload_session_ttl_sec
+            )
+            if removed:
+                logging.info(f"Removed {removed} expired upload sessions")
+        except Exception:
+            logging.exception("Failed to remove expired upload sessions")
+        try:
+            removed = await run_blocking(
+                decompress_jobs.remove_expired_jobs, _DECOMPRESS_JOB_TTL_SEC
+            )
+            if removed:
+                logging.info(f"Removed {removed} expired decompression jobs")
+        except Exception:
+            logging.exception("Failed to remove expired decompression jobs")
+
+
+async def _reload_mappings(poll_sec: float):
+    while True:
+        await asyncio.sleep(poll_sec)
+        try:
+            # the new mappings are built off the event loop and then swapped in, so requests
+            # carry on with the old mappings until then
+            if await run_blocking(AutoDetectUtils.reload_mappings_if_changed):
+                logging.info("Reloaded the file extension mappings")
+        except Exception:
+            logging.exception("Failed to reload the file extension mappings")
+
+
+async def _flush_sources(interval_sec: float):
+    while True:
+        await asyncio.sleep(interval_sec)
+        try:
+            await run_blocking(flush_sources)
+        except Exception:
+            logging.exception("Failed to write file sources to the metadata")
+
+
 @routes.post("/define-upa/{path:.+}")
 async def define_UPA(request: web.Request):
     """
@@ -482,7 +1202,7 @@ async def define_UPA(request: web.Request):
     """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info["path"])
-    if not os.path.exists(path.full_path or not os.path.isfile(path.full_path)):
+    if not await run_blocking(os.path.exists, path.full_path):
         # TODO the security model here is to not care if someone wants to put in a false upa
         raise web.HTTPNotFound(
             text="no file found found on path {}".format(path.user_path)
@@ -514,18 +1234,18 @@ async def delete(request: web.Request):
         raise web.HTTPForbidden(text="cannot delete home directory")
     if is_globusid(path, username):
         raise web.HTTPForbidden(text="cannot delete protected file")
-    if os.path.isfile(path.full_path):
-        os.remove(path.full_path)
-        if os.path.exists(path.metadata_path):
-            os.remove(path.metadata_path)
-    elif os.path.isdir(path.full_path):
-        shutil.rmtree(path.full_path)
-        if os.path.exists(path.metadata_path):
-            shutil.rmtree(path.metadata_path)
+    if await run_blocking(os.path.isfile, path.full_path):
+        await run_blocking(os.remove, path.full_path)
+        await remove_metadata(path)
+    elif await run_blocking(os.path.isdir, path.full_path):
+        await run_blocking(shutil.rmtree, path.full_path)
+        await remove_metadata(path)
     else:
         raise web.HTTPNotFound(
             text="could not delete {path}".format(path=path.user_path)
         )
+    forget_user(username)
+    await remove_from_index(path)
     return web.Response(text="successfully deleted {path}".format(path=path.user_path))
 
 
@@ -547,11 +1267,12 @@ async def rename(request: web.Request):
     except KeyError as wrong_key:
         raise web.HTTPBadRequest(text="must provide newPath field in body")
     new_path = Path.validate_path(username, new_path)
-    if os.path.exists(path.full_path):
-        if not os.path.exists(new_path.full_path):
-            shutil.move(path.full_path, new_path.full_path)
-            if os.path.exists(path.metadata_path):
-                shutil.move(path.metadata_path, new_path.metadata_path)
+    if await run_blocking(os.path.exists, path.full_path):
+        if not await run_blocking(os.path.exists, new_path.full_path):
+            await run_blocking(shutil.move, path.full_path, new_path.full_path)
+            await move_metadata(path, new_path)
+            forget_user(username)
+            await move_in_index(path, new_path)
         else:
             raise web.HTTPConflict(
                 text="{new_path} allready exists".format(new_path=new_path.user_path)
@@ -567,39 +1288,72 @@ async def rename(request: web.Request):
 
 @routes.patch("/decompress/{path:.+}")
 async def decompress(request: web.Request):
+    """
+    decompresses an archive into the folder it is in
+    by default the request completes once the archive has been decompressed. If the
+    background query parameter is true, 202 is returned immediately with the status of the
+    decompression job, which can be polled at /decompress-jobs/{job_id}
+    """
     username = await authorize_request(request)
     path = Path.validate_path(username, request.match_info["path"])
     # make sure the file can be decompressed
-    filename, file_extension = os.path.splitext(path.full_path)
-    filename, upper_file_extension = os.path.splitext(filename)
+    if not extraction.can_extract(path.full_path):
+        raise web.HTTPBadRequest(
+            text="cannot decompress a {ext} file".format(ext=os.path.splitext(path.name)[1])
+        )
     # TODO behavior when the unzip would overwrite something, what does it do, what should it do
     # 1 if we just don't let it do this its important to provide the rename feature,
     # 2 could try again after doign an automatic rename scheme (add nubmers to end)
     # 3 just overwrite and force
-    destination = os.path.dirname(path.full_path)
-    if (
-        upper_file_extension == ".tar" and file_extension == ".gz"
-    ) or file_extension == ".tgz":
-        await run_command("tar", "xzf", path.full_path, "-C", destination)
-    elif upper_file_extension == ".tar" and (
-        file_extension == ".bz" or file_extension == ".bz2"
-    ):
-        await run_command("tar", "xjf", path.full_path, "-C", destination)
-    elif file_extension == ".zip" or file_extension == ".ZIP":
-        await run_command("unzip", path.full_path, "-d", destination)
-    elif file_extension == ".tar":
-        await run_command("tar", "xf", path.full_path, "-C", destination)
-    elif file_extension == ".gz":
-        await run_command("gzip", "-d", path.full_path)
-    elif file_extension == ".bz2" or file_extension == "bzip2":
-        await run_command("bzip2", "-d", path.full_path)
-    else:
-        raise web.HTTPBadRequest(
-            text="cannot decompress a {ext} file".format(ext=file_extension)
+    if not await run_blocking(os.path.isfile, path.full_path):
+        raise web.HTTPNotFound(text="{path} not found".format(path=path.user_path))
+
+    async def extract_and_index(path: Path, progress: decompress_jobs.Progress):
+        # the extracted files and their metadata are indexed as they are written
+        await _decompress_jobs.run_in_worker(
+            extraction.extract, path, progress, _decompress_jobs.threads_per_job)
+        # a compressed file is removed once it has been decompressed
+        await update_index(path)
+
+    job = await _decompress_jobs.submit(username, path, extract_and_index)
+    if request.query.get("background", "").lower() == "true":
+        return web.json_response(
+            job.to_dict(),
+            status=202,
+            headers={"Location": f"/decompress-jobs/{job.job_id}"},
         )
+    job = await _decompress_jobs.wait(job)
+    # the client has the result, so the status doesn't need to be kept
+    await run_blocking(decompress_jobs.remove_job, username, job.job_id)
+    if job.state != decompress_jobs.COMPLETE:
+        raise web.HTTPInternalServerError(text=job.error)
     return web.Response(text="succesfully decompressed " + path.user_path)
 
 
+@routes.get("/decompress-jobs/{job_id}")
+async def decompress_job_status(request: web.Request):
+    """
+    returns the status of a decompression job
+    """
+    username = await authorize_request(request)
+    job_id = request.match_info["job_id"]
+    job = await run_blocking(decompress_jobs.get_job, username, job_id)
+    if not job:
+        raise web.HTTPNotFound(text=f"no decompression job {job_id}")
+    return web.json_response(job.to_dict(), headers={"Cache-Control": "no-store"})
+
+
+@routes.get("/decompress-jobs")
+async def list_decompress_jobs(request: web.Request):
+    """
+    returns the status of all of the user's decompression jobs, oldest first
+    """
+    username = await authorize_request(request)
+    jobs = await run_blocking(decompress_jobs.list_jobs, username)
+    return web.json_response(
+        [job.to_dict() for job in jobs], headers={"Cache-Control": "no-store"})
+
+
 async def authorize_request(request):
     """
     Authenticate a token from kbase_session in cookies or Authorization header and return the
@@ -629,6 +1383,8 @@ def inject_config_dependencies(config):
     META_DIR = config["staging_service"]["META_DIR"]
     CONCIERGE_PATH = config["staging_service"]["CONCIERGE_PATH"]
     FILE_EXTENSION_MAPPINGS = config["staging_service"]["FILE_EXTENSION_MAPPINGS"]
+    globus.set_auth_url(config["staging_service"]["AUTH_URL"])
+    metadata_store.configure(config["staging_service"].get("METADATA_STORE", "sidecar"))
 
     if DATA_DIR.startswith("."):
         DATA_DIR = os.path.normpath(os.path.join(os.getcwd(), DATA_DIR))
@@ -656,24 +1412,16 @@ def inject_config_dependencies(config):
 
     if FILE_EXTENSION_MAPPINGS is None:
         raise Exception("Please provide FILE_EXTENSION_MAPPINGS in the config file ")
-    with open(FILE_EXTENSION_MAPPINGS) as f:
-        AutoDetectUtils._MAPPINGS = json.load(f)
-        datatypes = defaultdict(set)
-        extensions = defaultdict(set)
-        for fileext, val in AutoDetectUtils._MAPPINGS["types"].items():
-            # if we start using the file ext type array for anything else this might need changes
-            filetype = val["file_ext_type"][0]
-            extensions[filetype].add(fileext)
-            for m in val['mappings']:
-                datatypes[m['id']].add(filetype)
-        global _DATATYPE_MAPPINGS
-        _DATATYPE_MAPPINGS = {
-            "datatype_to_filetype": {k: sorted(datatypes[k]) for k in datatypes},
-            "filetype_to_extensions": {k: sorted(extensions[k]) for k in extensions},
-        }
+    AutoDetectUtils.load_mappings(FILE_EXTENSION_MAPPINGS)
 
 
-def app_factory(config):
+def app_factory(config, worker_index: int = 0):
+    """
+    Create the app.
+    :param config: the staging service config.
+    :param worker_index: the index of the worker process that will serve the app, from 0.
+        Periodic cleanup only runs in the first.
+    """
     app = web.Application(middlewares=[web.normalize_path_middleware()])
     app.router.add_routes(routes)
     cors = aiohttp_cors.setup(
@@ -690,6 +1438,123 @@ def app_factory(config):
 
     inject_config_dependencies(config)
 
+    blocking_io.configure(
+        int(config["staging_service"].get("BLOCKING_IO_THREADS", blocking_io.DEFAULT_THREADS))
+    )
+
+    async def set_default_executor(app):
+        asyncio.get_event_loop().set_default_executor(blocking_io.get_executor())
+
+    app.on_startup.append(set_default_executor)
+
+    global _upload_session_ttl_sec
+    _upload_session_ttl_sec = float(
+        config["staging_service"].get("UPLOAD_SESSION_TTL_SEC", _DEFAULT_UPLOAD_SESSION_TTL_SEC)
+    )
+
+    global _list_default_depth
+    _list_default_depth = int(config["staging_service"].get("LIST_DEFAULT_DEPTH", 0)) or None
+    dir_index.configure(
+        float(config["staging_service"].get("INDEX_RESCAN_SEC", dir_index.DEFAULT_RESCAN_SEC)))
+
+    async def start_state_cleanup(app):
+        app["state_cleanup"] = asyncio.ensure_future(_remove_expired_state())
+
+    async def stop_state_cleanup(app):
+        app["state_cleanup"].cancel()
+
+    # the cleanup is for the whole node, so one worker does it
+    if worker_index == 0:
+        app.on_startup.append(start_state_cleanup)
+        app.on_cleanup.append(stop_state_cleanup)
+
+    # but each worker has its own upload digests
+    async def start_digest_cleanup(app):
+        app["digest_cleanup"] = asyncio.ensure_future(_remove_expired_digests_periodically())
+
+    async def stop_digest_cleanup(app):
+        app["digest_cleanup"].cancel()
+
+    app.on_startup.append(start_digest_cleanup)
+    app.on_cleanup.append(stop_digest_cleanup)
+
+    mappings_poll_sec = float(config["staging_service"].get(
+        "FILE_EXTENSION_MAPPINGS_POLL_SEC", _DEFAULT_MAPPINGS_POLL_SEC))
+
+    async def start_mappings_reload(app):
+        if mappings_poll_sec > 0:
+            app["mappings_reload"] = asyncio.ensure_future(_reload_mappings(mappings_poll_sec))
+
+    async def stop_mappings_reload(app):
+        if "mappings_reload" in app:
+            app["mappings_reload"].cancel()
+
+    app.on_startup.append(start_mappings_reload)
+    app.on_cleanup.append(stop_mappings_reload)
+
+    source_flush_sec = float(config["staging_service"].get(
+        "SOURCE_FLUSH_INTERVAL_SEC", _DEFAULT_SOURCE_FLUSH_SEC))
+
+    async def start_source_flush(app):
+        app["source_flush"] = asyncio.ensure_future(_flush_sources(source_flush_sec))
+
+    async def stop_source_flush(app):
+        app["source_flush"].cancel()
+        await run_blocking(flush_sources)
+
+    app.on_startup.append(start_source_flush)
+    app.on_cleanup.append(stop_source_flush)
+
+    # the limits are shared by every worker on the node through the slot files
+    jobs_per_node = int(config["staging_service"].get(
+        "DECOMPRESS_JOBS_PER_NODE", decompress_jobs.DEFAULT_JOBS_PER_NODE))
+    jobs_per_user = int(config["staging_service"].get(
+        "DECOMPRESS_JOBS_PER_USER", decompress_jobs.DEFAULT_JOBS_PER_USER))
+    threads_per_job = int(config["staging_service"].get(
+        "DECOMPRESS_THREADS_PER_JOB", decompress_jobs.DEFAULT_THREADS_PER_JOB))
+    slot_dir = config["staging_service"].get(
+        "DECOMPRESS_SLOT_DIR", decompress_jobs.DEFAULT_SLOT_DIR)
+
+    async def start_decompress_jobs(app):
+        # created here so the job pool belongs to the running event loop
+        global _decompress_jobs
+        _decompress_jobs = decompress_jobs.DecompressJobs(
+            jobs_per_node, jobs_per_user, threads_per_job, slot_dir)
+
+    async def stop_decompress_jobs(app):
+        await _decompress_jobs.shutdown()
+
+    app.on_startup.append(start_decompress_jobs)
+    app.on_cleanup.append(stop_decompress_jobs)
+
+    http_config = {
+        "connection_limit": int(config["staging_service"].get(
+            "HTTP_CONNECTION_LIMIT", http_client.DEFAULT_CONNECTION_LIMIT)),
+        "connection_limit_per_host": int(config["staging_service"].get(
+            "HTTP_CONNECTION_LIMIT_PER_HOST", http_client.DEFAULT_CONNECTION_LIMIT_PER_HOST)),
+        "timeout_sec": float(config["staging_service"].get(
+            "HTTP_TIMEOUT_SEC", http_client.DEFAULT_TIMEOUT_SEC)),
+        "connect_timeout_sec": float(config["staging_service"].get(
+            "HTTP_CONNECT_TIMEOUT_SEC", http_client.DEFAULT_CONNECT_TIMEOUT_SEC)),
+        "dns_cache_ttl_sec": float(config["staging_service"].get(
+            "HTTP_DNS_CACHE_TTL_SEC", http_client.DEFAULT_DNS_CACHE_TTL_SEC)),
+        "keepalive_sec": float(config["staging_service"].get(
+            "HTTP_KEEPALIVE_SEC", http_client.DEFAULT_KEEPALIVE_SEC)),
+    }
+
+    async def start_http_client(app):
+        # created here so the session belongs to the running event loop
+        await http_client.start(**http_config)
+
+    async def stop_http_client(app):
+        await http_client.close()
+
+    app.on_startup.append(start_http_client)
+    app.on_cleanup.append(stop_http_client)
+
     global auth_client
-    auth_client = KBaseAuth2(config["staging_service"]["AUTH_URL"])
+    auth_client = KBaseAuth2(
+        config["staging_service"]["AUTH_URL"],
+        token_cache_from_config(config["staging_service"]),
+    )
     return app
@@ -5,30 +5,58 @@ A very basic KBase auth client for the Python server.
 modified for python3 and authV2
 """
 import time as _time
+from collections import OrderedDict
+
 import aiohttp
 import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+from . import http_client
+from .blocking_io import run_blocking
+from .single_flight import SingleFlight
+
+
+def _hash_token(token):
+    return hashlib.sha256(token.encode("utf8")).hexdigest()
 
 
 class TokenCache(object):
-    """ A basic cache for tokens. """
+    """
+    A basic cache for tokens, held in the memory of this process. Tokens are kept in least
+    recently used order, so the least recently used token is evicted when the cache is full.
+
+    hits, misses and evictions count the lookups that found a valid token, the lookups that
+    didn't and the tokens evicted to make room for others.
+    """
 
     _MAX_TIME_SEC = 5 * 60  # 5 min
 
     def __init__(self, maxsize=2000):
-        self._cache = {}
+        # token hash -> (user, insert time, expire time), least recently used first
+        self._cache = OrderedDict()
         self._maxsize = maxsize
-        self._halfmax = maxsize / 2  # int division to round down
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get_user(self, token):
-        token = hashlib.sha256(token.encode("utf8")).hexdigest()
+        token = _hash_token(token)
         usertime = self._cache.get(token)
         if not usertime:
+            self.misses += 1
             return None
 
         user, intime, expire_time = usertime
         now = _time.time()
         if now - intime > self._MAX_TIME_SEC or now > expire_time:
+            del self._cache[token]
+            self.misses += 1
             return None
+        self._cache.move_to_end(token)
+        self.hits += 1
         return user
 
     def add_valid_token(self, token, user, expire_time):
@@ -36,16 +64,166 @@ class TokenCache(object):
             raise aiohttp.web.HTTPBadRequest(text="Must supply token")
         if not user:
             raise aiohttp.web.HTTPBadRequest(text="Must supply user")
-        token = hashlib.sha256(token.encode("utf8")).hexdigest()
-        self._cache[token] = [user, _time.time(), expire_time]
-        if len(self._cache) > self._maxsize:
-            for i, (t, _) in enumerate(
-                sorted(self._cache.items(), key=lambda v: v[1][1])
-            ):
-                if i <= self._halfmax:
-                    del self._cache[t]
-                else:
-                    break
+        token = _hash_token(token)
+        self._cache[token] = (user, _time.time(), expire_time)
+        self._cache.move_to_end(token)
+        while len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Get the number of tokens in the cache and the hit, miss and eviction counts.
+        """
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteTokenCache(object):
+    """
+    A cache for tokens in a SQLite database, which is shared by every process on the node that
+    uses the same database file, so a token validated by one process is reused by the others.
+    Only hashes of the tokens are stored.
+
+    The database is in WAL mode, so lookups aren't blocked by other processes writing to it. The
+    cache is best effort: if the database is busy an addition is dropped, and if it can't be
+    read a lookup is treated as a miss, rather than holding up requests.
+
+    The methods block on the database, so KBaseAuth2 calls them off the event loop. They may be
+    called from any thread.
+
+    Once the cache is over maxsize the oldest tokens are evicted. hits, misses and evictions
+    count the lookups and evictions made by this process, as for TokenCache.
+    """
+
+    _MAX_TIME_SEC = 5 * 60  # 5 min
+    # how long to wait for another process that is writing to the database
+    _BUSY_TIMEOUT_SEC = 0.05
+    # the size of the cache is limited after every this many additions
+    _TRIM_INTERVAL = 100
+
+    def __init__(self, path, maxsize=20000):
+        """
+        :param path: the path of the database file, which should be on a local file system.
+        :param maxsize: the maximum number of tokens to keep.
+        """
+        self._path = path
+        self._maxsize = maxsize
+        self._conn = None
+        # the connection is shared by the threads of the blocking IO pool
+        self._lock = threading.Lock()
+        self._additions = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        # connected on first use so that each process opens its own connection
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            # only hashes are stored, but there's no reason for anyone else to read them
+            os.close(os.open(self._path, os.O_CREAT | os.O_RDWR, 0o600))
+            conn = sqlite3.connect(
+                self._path,
+                timeout=self._BUSY_TIMEOUT_SEC,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # the cache can be rebuilt from the auth service, so it doesn't need to be durable
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                + "token TEXT PRIMARY KEY, user TEXT NOT NULL, intime REAL NOT NULL, "
+                + "expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tokens_intime ON tokens (intime)")
+            self._conn = conn
+        return self._conn
+
+    def get_user(self, token):
+        with self._lock:
+            try:
+                row = self._connect().execute(
+                    "SELECT user, intime, expires FROM tokens WHERE token = ?",
+                    (_hash_token(token),),
+                ).fetchone()
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Failed to read the token cache: {e}")
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            user, intime, expire_time = row
+            now = _time.time()
+            if now - intime > self._MAX_TIME_SEC or now > expire_time:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return user
+
+    def add_valid_token(self, token, user, expire_time):
+        if not token:
+            raise aiohttp.web.HTTPBadRequest(text="Must supply token")
+        if not user:
+            raise aiohttp.web.HTTPBadRequest(text="Must supply user")
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO tokens (token, user, intime, expires) "
+                    + "VALUES (?, ?, ?, ?)",
+                    (_hash_token(token), user, _time.time(), expire_time),
+                )
+                self._additions += 1
+                if self._additions % self._TRIM_INTERVAL == 0:
+                    # drop everything older than the newest maxsize tokens
+                    self.evictions += conn.execute(
+                        "DELETE FROM tokens WHERE intime < (SELECT intime FROM tokens "
+                        + "ORDER BY intime DESC LIMIT 1 OFFSET ?)",
+                        (self._maxsize - 1,),
+                    ).rowcount
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Failed to write to the token cache: {e}")
+
+    def stats(self):
+        """
+        Get the number of tokens in the cache and this process's hit, miss and eviction counts.
+        """
+        with self._lock:
+            try:
+                size = self._connect().execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Failed to read the token cache: {e}")
+                size = None
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def token_cache_from_config(config_section):
+    """
+    Create the token cache given by the TOKEN_CACHE key of the config, which is either
+    'memory', the default, or 'sqlite', for a cache in the file given by TOKEN_CACHE_PATH
+    that is shared by the processes on the node.
+    :param config_section: the staging_service section of the config.
+    """
+    backend = config_section.get("TOKEN_CACHE", "memory")
+    if backend == "memory":
+        return TokenCache()
+    if backend == "sqlite":
+        path = config_section.get("TOKEN_CACHE_PATH")
+        if not path:
+            raise ValueError("TOKEN_CACHE_PATH is required for the sqlite token cache")
+        return SQLiteTokenCache(path)
+    raise ValueError(f"Unknown TOKEN_CACHE {backend}")
 
 
 class KBaseAuth2(object):
@@ -53,33 +231,58 @@ class KBaseAuth2(object):
     A very basic KBase auth client for the Python server.
     """
 
-    def __init__(self, auth_url):
+    def __init__(self, auth_url, cache=None):
         """
         Constructor
+        :param auth_url: the URL of the auth service token endpoint.
+        :param cache: the token cache, TokenCache or SQLiteTokenCache. Defaults to a new
+            TokenCache.
         """
         self._authurl = auth_url
-        self._cache = TokenCache()
+        self._cache = cache if cache is not None else TokenCache()
+        self._validations = SingleFlight()
+
+    async def _call_cache(self, method, *args):
+        # the SQLite cache blocks on its database, so it's used off the event loop
+        if isinstance(self._cache, SQLiteTokenCache):
+            return await run_blocking(method, *args)
+        return method(*args)
+
+    async def cache_stats(self):
+        """
+        Get the size of the token cache and its hit, miss and eviction counts.
+        """
+        return await self._call_cache(self._cache.stats)
 
     async def get_user(self, token):
         if not token:
             raise aiohttp.web.HTTPBadRequest(text="Must supply token")
-        user = self._cache.get_user(token)
+        user = await self._call_cache(self._cache.get_user, token)
         if user:
             return user
-        async with aiohttp.ClientSession() as session:
+        # concurrent requests with the same uncached token share one call to the auth service
+        reason, ret = await self._validations.run(_hash_token(token), self._validate, token)
+        if not reason == "OK":
+            raise aiohttp.web.HTTPUnauthorized(
+                text="Error connecting to auth service: {} {}\n{}".format(
+                    ret["error"]["httpcode"],
+                    reason,
+                    ret["error"]["message"],
+                )
+            )
+        return ret["user"]
+
+    async def _validate(self, token):
+        # returns the response rather than raising, as the result is shared between requests
+        async with http_client.session() as session:
             async with session.get(
                 self._authurl, headers={"Authorization": token}
             ) as resp:
                 ret = await resp.json()
-                if not resp.reason == "OK":
-                    raise aiohttp.web.HTTPUnauthorized(
-                        text="Error connecting to auth service: {} {}\n{}".format(
-                            ret["error"]["httpcode"],
-                            resp.reason,
-                            ret["error"]["message"],
-                        )
-                    )
-        # whichever one comes first
-        self._cache._MAX_TIME_SEC = ret["cachefor"]
-        self._cache.add_valid_token(token, ret["user"], ret["expires"])
-        return ret["user"]
+                reason = resp.reason
+        if reason == "OK":
+            # whichever one comes first
+            self._cache._MAX_TIME_SEC = ret["cachefor"]
+            await self._call_cache(
+                self._cache.add_valid_token, token, ret["user"], ret["expires"])
+        return reason, ret
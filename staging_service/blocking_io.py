@@ -0,0 +1,109 @@
+"""
+A bounded thread pool for running blocking file system work off the event loop.
+
+A single slow stat on a network file system would otherwise stall every concurrent request.
+The pool is also installed as the event loop's default executor, so aiofiles and anything else
+that calls run_in_executor(None, ...) shares the same bound.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_THREADS = 32
+
+_executor = None
+_threads = DEFAULT_THREADS
+
+
+class BlockingIOExecutor(ThreadPoolExecutor):
+    """
+    A thread pool that keeps track of how many tasks are waiting for a thread, so the pool
+    can be sized under load.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_THREADS):
+        super().__init__(max_workers=max_workers, thread_name_prefix="blocking-io")
+        self._size = max_workers
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._max_queued = 0
+        self._completed = 0
+        self.closed = False
+
+    def shutdown(self, *args, **kwargs):
+        # the event loop shuts down its default executor when it closes
+        self.closed = True
+        super().shutdown(*args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        return super().submit(self._track, fn, *args, **kwargs)
+
+    def _track(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._active -= 1
+                self._completed += 1
+
+    def stats(self) -> dict:
+        """
+        Get the current pool statistics:
+        threads - the maximum number of threads in the pool.
+        active - the number of tasks currently running.
+        queued - the number of tasks waiting for a thread.
+        max_queued - the largest number of tasks that have waited for a thread at once.
+        completed - the number of tasks that have finished.
+        """
+        with self._stats_lock:
+            return {
+                "threads": self._size,
+                "active": self._active,
+                "queued": self._queued,
+                "max_queued": self._max_queued,
+                "completed": self._completed,
+            }
+
+
+def configure(max_workers: int = DEFAULT_THREADS):
+    """
+    Set the size of the pool. If the size changes, the pool is replaced and tasks running in
+    the old pool are allowed to finish.
+    """
+    global _executor, _threads
+    if max_workers < 1:
+        raise ValueError("The blocking IO pool must have at least one thread")
+    _threads = max_workers
+    old = _executor
+    if old and not old.closed and old.stats()["threads"] == max_workers:
+        return
+    _executor = BlockingIOExecutor(max_workers)
+    if old:
+        old.shutdown(wait=False)
+
+
+def get_executor() -> BlockingIOExecutor:
+    """
+    Get the pool, creating a new one if there is no pool or the pool has been shut down.
+    """
+    global _executor
+    if _executor is None or _executor.closed:
+        _executor = BlockingIOExecutor(_threads)
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function in the pool and return its result.
+    """
+    return await asyncio.get_event_loop().run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
@@ -0,0 +1,382 @@
+"""
+Background jobs for decompressing archives.
+
+Extracting a large archive can take far longer than a client or proxy will hold a request open,
+so each extraction runs as a job. The job status, including how much of the archive has been
+read and how many files have been extracted, is kept in a small JSON file under META_DIR so it
+can be polled from any server process. Jobs wait for a slot limited both per node and per user
+before they start, so a user extracting many archives can't starve everyone else. A slot is an
+flock on a file in a directory on the node's local file system, so the limits hold across every
+server process on the node but not across nodes.
+
+A job whose status hasn't been updated for a while is reported as failed, since the server
+process running it must have stopped.
+"""
+import asyncio
+import contextlib
+import dataclasses
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .blocking_io import run_blocking
+from .utils import Path
+
+_JOB_DIR = ".decompress_jobs"
+
+DEFAULT_JOBS_PER_NODE = 4
+DEFAULT_JOBS_PER_USER = 2
+DEFAULT_THREADS_PER_JOB = 4
+DEFAULT_SLOT_DIR = "/tmp/staging_service/decompress_slots"
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+# how often the status of a job is saved while it is queued or running
+_SAVE_INTERVAL_SEC = 1
+# a queued or running job whose status is older than this was interrupted
+_STALE_SEC = 60
+# how often a queued job checks for a free slot
+_SLOT_POLL_SEC = 0.5
+
+
+@dataclass(frozen=True)
+class JobStatus:
+    """
+    The status of a decompression job.
+
+    job_id - the ID of the job.
+    username - the user that started the job.
+    path - the path of the archive, starting with the username.
+    state - one of queued, running, complete or failed.
+    created - when the job was created in seconds since the epoch.
+    updated - when the status was last saved in seconds since the epoch.
+    started - when the job started running, if it has.
+    finished - when the job completed or failed, if it has.
+    bytes_processed - how many bytes of the archive have been read.
+    total_bytes - the size of the archive.
+    files_extracted - how many files and folders have been extracted.
+    error - why the job failed, if it did.
+    """
+    job_id: str
+    username: str
+    path: str
+    state: str
+    created: float
+    updated: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    bytes_processed: int = 0
+    total_bytes: int = 0
+    files_extracted: int = 0
+    error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+class Progress:
+    """
+    The progress of an extraction, which the extraction updates as it goes. The counters may be
+    updated from any thread. An extraction that runs in a worker thread should stop when it sees
+    it has been cancelled.
+    """
+
+    def __init__(self):
+        self.bytes_processed = 0
+        self.files_extracted = 0
+        self.cancelled = False
+
+    def add_bytes(self, count: int):
+        self.bytes_processed += count
+
+    def add_file(self):
+        self.files_extracted += 1
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# an extraction takes the archive path and a Progress to update
+Extractor = Callable[[Path, Progress], Awaitable[None]]
+
+
+def _user_dir(username: str) -> str:
+    return os.path.join(Path._META_DIR, _JOB_DIR, username)
+
+
+def _status_path(username: str, job_id: str) -> str:
+    return os.path.join(_user_dir(username), job_id + ".json")
+
+
+def _try_take_slot(slot_dir: str, name: str, count: int) -> Optional[Tuple[int, str]]:
+    """
+    Take one of a set of slots if any are free. Blocks.
+    :param slot_dir: the directory of the slot files.
+    :param name: the name of the set of slots.
+    :param count: the number of slots in the set.
+    :return: the file descriptor that holds the slot and the path of the slot's file, to be
+        passed to _free_slot, or None if every slot is taken.
+    """
+    os.makedirs(slot_dir, exist_ok=True)
+    for i in range(count):
+        path = os.path.join(slot_dir, f"{name}.{i}")
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            st = os.fstat(fd)
+            current = os.stat(path)
+            # the holder removes the file when it frees the slot, so a file locked after it
+            # was removed isn't the slot any more
+            if (st.st_dev, st.st_ino) == (current.st_dev, current.st_ino):
+                return fd, path
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        os.close(fd)
+    return None
+
+
+def _free_slot(slot: Tuple[int, str]):
+    """
+    Free a slot taken with _try_take_slot. Blocks.
+    """
+    fd, path = slot
+    # removed while it is still locked, so the files of users' slots don't pile up
+    try:
+        os.remove(path)
+    finally:
+        os.close(fd)
+
+
+def _free_slot_when_taken(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        _free_slot(future.result())
+
+
+@contextlib.asynccontextmanager
+async def _slot(slot_dir: str, name: str, count: int):
+    """
+    Wait for one of a set of slots and hold it for the duration of the block.
+    """
+    while True:
+        attempt = asyncio.ensure_future(run_blocking(_try_take_slot, slot_dir, name, count))
+        try:
+            slot = await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            # the thread may still take the slot after the job is cancelled, so free it then
+            attempt.add_done_callback(_free_slot_when_taken)
+            raise
+        if slot is not None:
+            break
+        await asyncio.sleep(_SLOT_POLL_SEC)
+    try:
+        yield
+    finally:
+        # freed on the loop so a cancelled job can't leave it held. The slot files are on a
+        # local file system, so this doesn't wait on the network.
+        _free_slot(slot)
+
+
+def _save(status: JobStatus):
+    path = _status_path(status.username, status.job_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so a reader never sees a partial status
+    temp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp, "w") as f:
+        json.dump(status.to_dict(), f)
+    os.replace(temp, path)
+
+
+def _load(path: str) -> Optional[JobStatus]:
+    try:
+        with open(path) as f:
+            status = JobStatus(**json.load(f))
+    except FileNotFoundError:
+        return None
+    if status.state in (QUEUED, RUNNING) and time.time() - status.updated > _STALE_SEC:
+        return dataclasses.replace(
+            status, state=FAILED, error="The job was interrupted by a server restart")
+    return status
+
+
+def get_job(username: str, job_id: str) -> Optional[JobStatus]:
+    """
+    Get the status of a job. Blocks.
+    :param username: the user requesting the job. Other users' jobs are treated as missing.
+    :param job_id: the ID of the job.
+    :return: the status or None if there is no such job.
+    """
+    if not job_id.isalnum():
+        return None
+    return _load(_status_path(username, job_id))
+
+
+def list_jobs(username: str) -> List[JobStatus]:
+    """
+    Get the status of all of a user's jobs, oldest first. Blocks.
+    """
+    try:
+        names = os.listdir(_user_dir(username))
+    except FileNotFoundError:
+        return []
+    jobs = [_load(os.path.join(_user_dir(username), n)) for n in names if n.endswith(".json")]
+    return sorted((j for j in jobs if j), key=lambda j: j.created)
+
+
+def remove_job(username: str, job_id: str):
+    """
+    Remove the status of a job. Blocks.
+    """
+    try:
+        os.remove(_status_path(username, job_id))
+    except FileNotFoundError:
+        pass
+
+
+def remove_expired_jobs(ttl: float) -> int:
+    """
+    Remove the status of jobs that finished longer ago than the time to live. Blocks.
+    :return: the number of jobs removed.
+    """
+    try:
+        users = os.listdir(os.path.join(Path._META_DIR, _JOB_DIR))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    now = time.time()
+    for username in users:
+        for job in list_jobs(username):
+            if job.state in (COMPLETE, FAILED) and now - (job.finished or job.updated) > ttl:
+                try:
+                    os.remove(_status_path(username, job.job_id))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+class DecompressJobs:
+    """
+    Runs decompression jobs in the background with a limit on how many run at once on the node.
+    """
+
+    def __init__(
+        self,
+        jobs_per_node: int = DEFAULT_JOBS_PER_NODE,
+        jobs_per_user: int = DEFAULT_JOBS_PER_USER,
+        threads_per_job: int = DEFAULT_THREADS_PER_JOB,
+        slot_dir: str = DEFAULT_SLOT_DIR,
+    ):
+        """
+        :param jobs_per_node: the maximum number of jobs that run at once on the node, across
+            every process sharing the slot directory.
+        :param jobs_per_user: the maximum number of jobs a single user can run at once on the
+            node.
+        :param threads_per_job: the number of threads a job may use to decompress a file, in
+            addition to the worker thread it runs in.
+        :param slot_dir: the directory of the files that hold the slots of running jobs, which
+            must be on a local file system of the node.
+        """
+        if jobs_per_node < 1 or jobs_per_user < 1 or threads_per_job < 1:
+            raise ValueError("The decompression job limits must be at least 1")
+        self.threads_per_job = threads_per_job
+        self._jobs_per_node = jobs_per_node
+        self._jobs_per_user = jobs_per_user
+        self._slot_dir = slot_dir
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # a job holds a worker thread for as long as it runs, so jobs don't use the IO pool
+        self._workers = ThreadPoolExecutor(jobs_per_node, thread_name_prefix="decompress")
+
+    async def run_in_worker(self, func, *args):
+        """
+        Run a long running blocking function, such as an extraction, in a job worker thread.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._workers, func, *args)
+
+    async def submit(self, username: str, path: Path, extract: Extractor) -> JobStatus:
+        """
+        Start a job.
+        :param username: the user starting the job.
+        :param path: the archive to decompress.
+        :param extract: the function that decompresses the archive.
+        :return: the initial status of the job.
+        """
+        size = (await run_blocking(os.stat, path.full_path)).st_size
+        now = time.time()
+        status = JobStatus(uuid.uuid4().hex, username, path.user_path, QUEUED, now, now,
+                           total_bytes=size)
+        await run_blocking(_save, status)
+        self._tasks[status.job_id] = asyncio.ensure_future(self._run(status, path, extract))
+        return status
+
+    async def wait(self, job: JobStatus) -> JobStatus:
+        """
+        Wait for a job started by this process to finish.
+        :param job: the status returned when the job was submitted.
+        :return: the final status of the job.
+        """
+        task = self._tasks.get(job.job_id)
+        if task is None:  # already finished
+            return await run_blocking(get_job, job.username, job.job_id)
+        # waiting may be cancelled if the client goes away, but the job keeps running
+        return await asyncio.shield(task)
+
+    async def _run(self, status: JobStatus, path: Path, extract: Extractor) -> JobStatus:
+        progress = Progress()
+        current = status
+
+        async def save(**changes):
+            nonlocal current
+            current = dataclasses.replace(
+                current,
+                updated=time.time(),
+                bytes_processed=progress.bytes_processed,
+                files_extracted=progress.files_extracted,
+                **changes,
+            )
+            await run_blocking(_save, current)
+
+        async def save_periodically():
+            while True:
+                await asyncio.sleep(_SAVE_INTERVAL_SEC)
+                await save()
+
+        saver = asyncio.ensure_future(save_periodically())
+        try:
+            user_slot = _slot(self._slot_dir, "user-" + status.username, self._jobs_per_user)
+            async with user_slot, _slot(self._slot_dir, "node", self._jobs_per_node):
+                await save(state=RUNNING, started=time.time())
+                await extract(path, progress)
+            saver.cancel()
+            await save(state=COMPLETE, finished=time.time())
+        except asyncio.CancelledError:
+            # stop an extraction that is running in a worker thread
+            progress.cancel()
+            saver.cancel()
+            raise
+        except Exception as e:
+            saver.cancel()
+            logging.exception(f"Decompression job {status.job_id} failed")
+            error = getattr(e, "text", None) or str(e) or type(e).__name__
+            await save(state=FAILED, finished=time.time(), error=error)
+        finally:
+            self._tasks.pop(status.job_id, None)
+        return current
+
+    async def shutdown(self):
+        """
+        Cancel all running jobs.
+        """
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.shutdown(wait=False)
@@ -0,0 +1,614 @@
+"""
+A persistent, per user index of the files and folders in the staging area.
+
+The index stores the stat data and source of every entry under a user's home directory in a
+SQLite database under META_DIR. It is reconciled against the file system one folder at a time.
+A folder whose mtime and inode haven't changed since it was last scanned has had no entries
+added, removed or renamed, so it costs a single stat and its entries are read from the index.
+Otherwise the folder is scanned and its entries are stat'd. Only entries that are new or whose
+stat data changed are written, and the source of a file is only determined the first time it is
+seen, which is the expensive part of listing a file.
+
+A file changed in place, for example by a transfer that is still running, doesn't change its
+folder, so unchanged folders are also scanned again once their last scan is older than the
+rescan interval set with configure(). Until then such a file is listed with the size and mtime
+it had when its folder was last scanned. Files the service writes are updated straight away.
+
+Each folder is written in its own short transaction, after it has been scanned and the sources
+of its new files have been determined, so indexing a large tree doesn't keep the service's own
+updates for the user waiting. The service handlers call update() for any file they write.
+
+Listings can be returned whole or a page at a time with page(), or yielded as they are read with
+iter_entries(). Both reconcile one folder at a time as they walk the tree in path order, so the
+first entries of a large tree are available long before the whole tree has been checked, and a
+page only checks the folders from its cursor to its last entry.
+
+A listing limited to a depth only scans the folders down to that depth, and the folders at that
+depth. Their entries include the number of entries in them and the total size of the files below
+them, summed from the index, so the contents of folders further down are counted as of the last
+time they were listed or the service wrote to them.
+
+All of the methods here block and should be run off the event loop.
+"""
+import heapq
+import itertools
+import os
+import sqlite3
+import stat
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from . import sqlite_db
+from .utils import Path
+
+_INDEX_DIR = ".staging_index"
+
+DEFAULT_RESCAN_SEC = 300
+# a folder changed this soon before it was scanned may change again without its mtime changing
+# on file systems with coarse timestamps, so the scan is only trusted once it is older
+_RACY_SEC = 2
+
+_rescan_sec = DEFAULT_RESCAN_SEC
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    is_folder INTEGER NOT NULL,
+    source TEXT,
+    -- for folders, the folder's mtime and inode when it was last scanned, and when that was
+    scan_mtime_ns INTEGER,
+    scan_ino INTEGER,
+    scanned REAL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+"""
+
+_UPSERT = """
+INSERT INTO entries (path, parent, name, mtime, size, is_folder, source)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET
+    mtime = excluded.mtime,
+    size = excluded.size,
+    is_folder = excluded.is_folder,
+    source = excluded.source
+"""
+
+
+def configure(rescan_sec: float = DEFAULT_RESCAN_SEC):
+    """
+    Set how long a folder that hasn't changed is listed from the index before its entries are
+    stat'd again, to pick up files changed in place.
+    """
+    global _rescan_sec
+    _rescan_sec = rescan_sec
+
+
+def _parent(user_path: str) -> str:
+    return user_path.rpartition("/")[0]
+
+
+def _is_hidden(relative_path: str) -> bool:
+    return any(part.startswith(".") for part in relative_path.split("/"))
+
+
+def _mtime_ms(st: os.stat_result) -> int:
+    return int(st.st_mtime * 1000)  # given in seconds, want ms
+
+
+# the sort keys of the entry rows, which are lists so they can be sent to clients as JSON
+_SORT_KEYS = {
+    "path": lambda row: row[0].split("/"),
+    "mtime": lambda row: [-row[2], row[0].split("/")],
+}
+SORTS = tuple(_SORT_KEYS)
+
+_COLUMNS = "SELECT path, name, mtime, size, is_folder, source FROM entries "
+
+
+def _entry(row: tuple) -> dict:
+    user_path, name, mtime, size, is_folder, source = row
+    data = {
+        "name": name,
+        "path": user_path,
+        "mtime": mtime,
+        "size": size,
+        "isFolder": bool(is_folder),
+    }
+    if not is_folder:
+        data["source"] = source
+    return data
+
+
+def _summarize(conn: sqlite3.Connection, entry: dict, show_hidden: bool):
+    if not entry["isFolder"]:
+        return
+    user_path = entry["path"]
+    entry["childCount"] = conn.execute(
+        "SELECT COUNT(*) FROM entries WHERE parent = ?"
+        + ("" if show_hidden else " AND substr(name, 1, 1) != '.'"),
+        (user_path,),
+    ).fetchone()[0]
+    # the part of each path below the folder starts with a '/', so a hidden entry anywhere
+    # below the folder has a '/.' in it
+    entry["totalSize"] = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM entries "
+        + "WHERE path > ? AND path < ? AND is_folder = 0"
+        + ("" if show_hidden else " AND instr(substr(path, ?), '/.') = 0"),
+        sqlite_db.subtree_bounds(user_path) + (() if show_hidden else (len(user_path) + 1,)),
+    ).fetchone()[0]
+
+
+def _scan_depth(depth: Optional[int]) -> Optional[int]:
+    # the folders at the depth are scanned as well, so their summaries are current
+    return None if depth is None else depth + 1
+
+
+def _matches(
+    row: tuple, offset: int, show_hidden: bool, query: str, depth: Optional[int]
+) -> bool:
+    return (
+        (show_hidden or not _is_hidden(row[0][offset:]))
+        and (not query or row[0].find(query) != -1)
+        and (depth is None or row[0].count("/", offset) < depth)
+    )
+
+
+class DirIndex:
+    """
+    The index for a single user.
+    """
+
+    def __init__(self, username: str, sources_resolver: Callable[[List[Path]], List[str]]):
+        """
+        :param username: the user whose files are indexed.
+        :param sources_resolver: a function that determines the sources of files the first time
+            they are indexed, given the files of a folder at a time.
+        """
+        self._username = username
+        self._resolve_sources = sources_resolver
+        self._db_path = os.path.join(Path._META_DIR, _INDEX_DIR, username + ".sqlite3")
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        return sqlite_db.connect(self._db_path, _SCHEMA, check_same_thread)
+
+    def list(self, path: Path, show_hidden: bool, query: str = "", recurse: bool = True) -> list:
+        """
+        Reconcile the index for a folder and return the entries below it.
+        :param path: the folder to list.
+        :param show_hidden: whether to include entries where any part of the path below the
+            folder starts with a '.'.
+        :param query: only return entries whose user path contains this string.
+        :param recurse: whether to include the contents of subfolders.
+        :return: a list of stat data dicts in traversal order. Files include their source.
+        """
+        entries, _ = self.page(path, show_hidden, query, depth=None if recurse else 1)
+        return entries
+
+    def page(
+        self,
+        path: Path,
+        show_hidden: bool,
+        query: str = "",
+        depth: Optional[int] = None,
+        sort: str = "path",
+        limit: Optional[int] = None,
+        after: Optional[list] = None,
+    ) -> Tuple[list, Optional[list]]:
+        """
+        Reconcile the index for a folder and return a page of the entries below it. In path
+        order the folders are walked from the cursor, so only the folders up to the end of the
+        page are reconciled. In mtime order the whole tree is reconciled, and only the entries
+        on the page are sorted, with a heap, rather than every entry.
+        :param path: the folder to list.
+        :param show_hidden: whether to include entries where any part of the path below the
+            folder starts with a '.'.
+        :param query: only return entries whose user path contains this string.
+        :param depth: only return entries at most this many levels below the folder, or None
+            for every entry.
+        :param sort: the order of the entries, one of SORTS: 'path' for traversal order or
+            'mtime' for the most recently modified first, in traversal order where entries
+            were modified at the same time.
+        :param limit: the maximum number of entries to return, or None for every entry.
+        :param after: return the entries after the entry with this sort key, which is returned
+            with the previous page.
+        :return: a list of stat data dicts, where files include their source, and the sort key
+            of the last entry if there are more entries, or None. If a depth is given, folders
+            include the number of entries in them, childCount, and the total size of the files
+            below them, totalSize.
+        """
+        key = _SORT_KEYS[sort]
+        root = sqlite_db.normalize(path.user_path)
+        conn = self._connect()
+        try:
+            if sort == "path":
+                return self._path_page(
+                    conn, root, path.full_path, show_hidden, query, depth, limit, after)
+            self._reconcile_root(conn, root, path.full_path, _scan_depth(depth), show_hidden)
+            rows = self._select_below(conn, root, depth).fetchall()
+            offset = len(root) + 1
+            rows = [
+                row for row in rows
+                if _matches(row, offset, show_hidden, query, depth)
+                and (after is None or key(row) > after)
+            ]
+            if limit is None:
+                rows.sort(key=key)
+                next_key = None
+            else:
+                rows = heapq.nsmallest(limit + 1, rows, key=key)
+                next_key = key(rows[limit - 1]) if len(rows) > limit else None
+                rows = rows[:limit]
+            entries = [_entry(row) for row in rows]
+            if depth is not None:
+                for entry in entries:
+                    _summarize(conn, entry, show_hidden)
+        finally:
+            conn.close()
+        return entries, next_key
+
+    def iter_entries(
+        self,
+        path: Path,
+        show_hidden: bool,
+        query: str = "",
+        depth: Optional[int] = None,
+        sort: str = "path",
+    ) -> Iterator[dict]:
+        """
+        Reconcile the index for a folder and yield the entries below it, in the same order as
+        page() returns them. In path order each folder is reconciled just before its entries
+        are yielded, so the first entries come out before the rest of the tree is checked. In
+        mtime order the whole tree is reconciled first, and the entries are then read from the
+        database in order rather than being sorted in memory.
+        The generator holds a database connection until it is exhausted or closed. It may be
+        resumed from a different thread than the one that started it, but not from two
+        threads at once.
+        :param path: the folder to list.
+        :param show_hidden: whether to include entries where any part of the path below the
+            folder starts with a '.'.
+        :param query: only yield entries whose user path contains this string.
+        :param depth: only yield entries at most this many levels below the folder, or None
+            for every entry.
+        :param sort: the order of the entries, one of SORTS, see page().
+        :return: the stat data dicts of the entries, as page() returns them.
+        """
+        root = sqlite_db.normalize(path.user_path)
+        conn = self._connect(check_same_thread=False)
+        try:
+            if sort == "path":
+                self._reconcile_root(conn, root, path.full_path, 1, show_hidden)
+                for entry in self._walk(conn, root, path.full_path, show_hidden, query, depth):
+                    if depth is not None:
+                        _summarize(conn, entry, show_hidden)
+                    yield entry
+                return
+            self._reconcile_root(conn, root, path.full_path, _scan_depth(depth), show_hidden)
+            offset = len(root) + 1
+            rows = self._select_below(conn, root, depth, "ORDER BY mtime DESC")
+            for _, group in itertools.groupby(rows, key=lambda row: row[2]):
+                group = [row for row in group
+                         if _matches(row, offset, show_hidden, query, depth)]
+                group.sort(key=_SORT_KEYS["path"])
+                for row in group:
+                    entry = _entry(row)
+                    if depth is not None:
+                        _summarize(conn, entry, show_hidden)
+                    yield entry
+        finally:
+            conn.close()
+
+    def _path_page(
+        self,
+        conn: sqlite3.Connection,
+        root: str,
+        full_path: str,
+        show_hidden: bool,
+        query: str,
+        depth: Optional[int],
+        limit: Optional[int],
+        after: Optional[list],
+    ) -> Tuple[list, Optional[list]]:
+        # the tree is walked rather than read with a path range, as the order of the paths as
+        # strings isn't their sort order where a name has a character before '/', such as '-'
+        parts = root.split("/")
+        if after is not None and after[:len(parts)] != parts:
+            if after > parts:  # the cursor is after every entry below the folder
+                return [], None
+            after = None
+        elif after == parts:
+            after = None
+        self._reconcile_root(conn, root, full_path, 1, show_hidden)
+        entries = self._walk(conn, root, full_path, show_hidden, query, depth, after)
+        entries = list(entries if limit is None else itertools.islice(entries, limit + 1))
+        next_key = None
+        if limit is not None and len(entries) > limit:
+            entries = entries[:limit]
+            next_key = entries[-1]["path"].split("/")
+        if depth is not None:
+            # summarized once the folders on the page have been scanned, so a folder's summary
+            # counts the changes in the folders below it on the page
+            for entry in entries:
+                _summarize(conn, entry, show_hidden)
+        return entries, next_key
+
+    def _walk(
+        self,
+        conn: sqlite3.Connection,
+        user_path: str,
+        full_path: str,
+        show_hidden: bool,
+        query: str,
+        depth: Optional[int],
+        after: Optional[list] = None,
+    ) -> Iterator[dict]:
+        """
+        Yield the entries below a folder that has been scanned, in path order, scanning the
+        folders below it as they are reached. The entries of folders aren't summarized.
+        :param after: only yield the entries after the entry with this path sort key, which is
+            below the folder.
+        """
+        if after is None:
+            rows = conn.execute(_COLUMNS + "WHERE parent = ?", (user_path,)).fetchall()
+        else:
+            # the entries before the one the cursor entry is in or below are skipped, along with
+            # everything below them, so their folders aren't scanned
+            level = user_path.count("/") + 1
+            rows = conn.execute(
+                _COLUMNS + "WHERE parent = ? AND name >= ?", (user_path, after[level])
+            ).fetchall()
+        # sorting each folder by name and visiting the subfolders in turn gives the same order
+        # as sorting every path
+        rows.sort(key=lambda row: row[1])
+        for row in rows:
+            if not show_hidden and row[1].startswith("."):
+                continue
+            # the cursor entry and the folders it is in have already been listed
+            listed = after is None or row[1] != after[level]
+            walked = row[4] and (depth is None or depth > 1)
+            folder_path = os.path.join(full_path, row[1])
+            if row[4] and (listed or walked):
+                # scanned before its entry is yielded, as it's either walked or summarized
+                self._reconcile(conn, row[0], folder_path, 1, show_hidden)
+            if listed and (not query or row[0].find(query) != -1):
+                yield _entry(row)
+            if walked:
+                yield from self._walk(
+                    conn,
+                    row[0],
+                    folder_path,
+                    show_hidden,
+                    query,
+                    None if depth is None else depth - 1,
+                    None if listed or len(after) == level + 1 else after,
+                )
+
+    def _reconcile_root(
+        self,
+        conn: sqlite3.Connection,
+        user_path: str,
+        full_path: str,
+        depth: Optional[int],
+        show_hidden: bool,
+    ):
+        self._reconcile(conn, user_path, full_path, depth, show_hidden)
+        with sqlite_db.transaction(conn):
+            self._add_parents(conn, user_path)
+
+    def _select_below(
+        self, conn: sqlite3.Connection, user_path: str, depth: Optional[int], order: str = ""
+    ) -> sqlite3.Cursor:
+        if depth == 1:
+            return conn.execute(_COLUMNS + "WHERE parent = ? " + order, (user_path,))
+        return conn.execute(
+            _COLUMNS + "WHERE path > ? AND path < ? " + order, sqlite_db.subtree_bounds(user_path))
+
+    def update(self, path: Path, source: Optional[str] = None):
+        """
+        Update the entry for a file or folder after the service changed it. Removes the entry,
+        and any entries below it, if the path no longer exists. The contents of a folder are
+        picked up the next time it is listed.
+        :param path: the path to update.
+        :param source: the source of the file. If not provided any existing source is kept.
+        """
+        self.update_many([(path, source)])
+
+    def update_many(self, entries: Iterable[Tuple[Path, Optional[str]]]):
+        """
+        Update the entries for several files or folders in one transaction, as update() does.
+        :param entries: the path and source of each entry to update.
+        """
+        conn = self._connect()
+        try:
+            with sqlite_db.transaction(conn):
+                for path, source in entries:
+                    self._update(conn, path, source)
+        finally:
+            conn.close()
+
+    def _update(self, conn: sqlite3.Connection, path: Path, source: Optional[str]):
+        user_path = sqlite_db.normalize(path.user_path)
+        try:
+            st = os.stat(path.full_path)
+        except FileNotFoundError:
+            self._delete(conn, user_path)
+            return
+        is_folder = stat.S_ISDIR(st.st_mode)
+        if not is_folder and source is None:
+            row = conn.execute(
+                "SELECT source, is_folder FROM entries WHERE path = ?", (user_path,)
+            ).fetchone()
+            if row and not row[1]:
+                source = row[0]
+            else:
+                source = self._resolve_sources([path])[0]
+        self._upsert(conn, [(user_path, os.path.basename(user_path), st, is_folder, source)])
+        self._add_parents(conn, user_path)
+
+    def remove(self, path: Path):
+        """
+        Remove the entry for a file or folder and any entries below it.
+        """
+        conn = self._connect()
+        try:
+            with sqlite_db.transaction(conn):
+                self._delete(conn, sqlite_db.normalize(path.user_path))
+        finally:
+            conn.close()
+
+    def move(self, path: Path, new_path: Path):
+        """
+        Move the entry for a file or folder, and any entries below it, to a new path.
+        """
+        old = sqlite_db.normalize(path.user_path)
+        new = sqlite_db.normalize(new_path.user_path)
+        conn = self._connect()
+        try:
+            with sqlite_db.transaction(conn):
+                self._delete(conn, new)
+                conn.execute(
+                    "UPDATE entries SET path = ?, parent = ?, name = ? WHERE path = ?",
+                    (new, _parent(new), os.path.basename(new), old),
+                )
+                conn.execute(
+                    "UPDATE entries SET path = ? || substr(path, ?), "
+                    + "parent = ? || substr(parent, ?) WHERE path > ? AND path < ?",
+                    (new, len(old) + 1, new, len(old) + 1) + sqlite_db.subtree_bounds(old),
+                )
+                self._add_parents(conn, new)
+        finally:
+            conn.close()
+
+    def _reconcile(
+        self,
+        conn: sqlite3.Connection,
+        user_path: str,
+        full_path: str,
+        depth: Optional[int],
+        show_hidden: bool,
+    ):
+        """
+        Scan a folder and the folders below it.
+        :param depth: how many levels of folders to scan, from the folder itself, or None to
+            scan every level.
+        """
+        subdirs = self._scan(conn, user_path, full_path)
+        if depth is not None and depth <= 1:
+            return
+        for name in subdirs:
+            if show_hidden or not name.startswith("."):
+                self._reconcile(
+                    conn,
+                    user_path + "/" + name,
+                    os.path.join(full_path, name),
+                    None if depth is None else depth - 1,
+                    show_hidden,
+                )
+
+    def _scan(self, conn: sqlite3.Connection, user_path: str, full_path: str) -> list:
+        try:
+            # before the folder is read, so a change made while it is read changes the mtime
+            st = os.stat(full_path)
+        except FileNotFoundError:
+            with sqlite_db.transaction(conn):
+                self._delete(conn, user_path)
+            return []
+        last_scan = conn.execute(
+            "SELECT scan_mtime_ns, scan_ino, scanned FROM entries WHERE path = ?", (user_path,)
+        ).fetchone()
+        if (
+            last_scan
+            and last_scan[:2] == (st.st_mtime_ns, st.st_ino)
+            and time.time() - last_scan[2] < _rescan_sec
+        ):
+            return [r[0] for r in conn.execute(
+                "SELECT name FROM entries WHERE parent = ? AND is_folder = 1", (user_path,))]
+        # the folder is read and the sources of its new files determined before the write lock
+        # is taken. An entry the service adds in the meantime isn't in known, so isn't removed.
+        known = {
+            r[0]: r[1:] for r in conn.execute(
+                "SELECT name, mtime, size, is_folder, source FROM entries WHERE parent = ?",
+                (user_path,),
+            )
+        }
+        subdirs = []
+        changed = []
+        replaced = []
+        unresolved = []
+        try:
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        is_folder = True
+                    elif entry.is_file():
+                        is_folder = False
+                    else:
+                        continue
+                    est = entry.stat()
+                    old = known.pop(entry.name, None)
+                    source = None
+                    if is_folder:
+                        subdirs.append(entry.name)
+                    if old:
+                        if bool(old[2]) != is_folder:
+                            replaced.append(entry.name)
+                        elif old[:2] == (_mtime_ms(est), est.st_size):
+                            continue
+                        else:
+                            source = old[3]
+                    if not is_folder and source is None:
+                        unresolved.append(len(changed))
+                    changed.append(
+                        [user_path + "/" + entry.name, entry.name, est, is_folder, source])
+        except FileNotFoundError:
+            with sqlite_db.transaction(conn):
+                self._delete(conn, user_path)
+            return []
+        if unresolved:
+            sources = self._resolve_sources(
+                [Path.from_full_path(os.path.join(full_path, changed[i][1])) for i in unresolved])
+            for i, source in zip(unresolved, sources):
+                changed[i][4] = source
+        with sqlite_db.transaction(conn):
+            for name in replaced + list(known):
+                self._delete(conn, user_path + "/" + name)
+            self._upsert(conn, changed)
+            self._upsert(conn, [(user_path, os.path.basename(user_path), st, True, None)])
+            now = time.time()
+            conn.execute(
+                "UPDATE entries SET scan_mtime_ns = ?, scan_ino = ?, scanned = ? WHERE path = ?",
+                (
+                    st.st_mtime_ns,
+                    st.st_ino,
+                    now if now - st.st_mtime > _RACY_SEC else 0,
+                    user_path,
+                ),
+            )
+        return subdirs
+
+    def _upsert(self, conn: sqlite3.Connection, entries: Iterable[tuple]):
+        conn.executemany(
+            _UPSERT,
+            [
+                (p, _parent(p), name, _mtime_ms(st), st.st_size, int(is_folder), source)
+                for p, name, st, is_folder, source in entries
+            ],
+        )
+
+    def _add_parents(self, conn: sqlite3.Connection, user_path: str):
+        # an entry without a row for its folder would never be removed by reconciliation
+        parent = _parent(user_path)
+        while "/" in parent and not conn.execute(
+                "SELECT 1 FROM entries WHERE path = ?", (parent,)).fetchone():
+            st = os.stat(os.path.join(Path._DATA_DIR, parent))
+            self._upsert(conn, [(parent, os.path.basename(parent), st, True, None)])
+            parent = _parent(parent)
+
+    def _delete(self, conn: sqlite3.Connection, user_path: str):
+        conn.execute(
+            "DELETE FROM entries WHERE path = ? OR (path > ? AND path < ?)",
+            (user_path,) + sqlite_db.subtree_bounds(user_path),
+        )
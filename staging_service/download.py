@@ -0,0 +1,376 @@
+"""
+Conditional and range request handling for file downloads.
+
+Files are served with a strong ETag and a Last-Modified date so clients can revalidate a cached
+copy with If-None-Match or If-Modified-Since rather than downloading it again. A Range header
+with one or more byte ranges returns just those parts of the file, which lets a client resume an
+interrupted download or read a slice of a large file, such as the header of a BAM file. If-Range
+makes sure a resumed download is still of the same file.
+
+A folder or a selection of files can also be downloaded as a zip or tar archive. The archive is
+written by a worker thread into a bounded queue that the response is sent from, so it is never
+staged on disk, memory use doesn't depend on the size of the archive, and the first bytes are
+sent as soon as they are written.
+"""
+import asyncio
+import io
+import logging
+import os
+import tarfile
+import threading
+import uuid
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+from .blocking_io import run_blocking
+
+# a request for more ranges than this is served in full rather than as many small parts
+_MAX_RANGES = 100
+_READ_SIZE = 1024 * 1024
+_CONTENT_TYPE = "application/octet-stream"
+
+# format -> content type
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+}
+# the archive is sent in chunks of about this size, and at most this many chunks are held
+_ARCHIVE_CHUNK_SIZE = 256 * 1024
+_ARCHIVE_QUEUE_SIZE = 16
+
+
+class RangeNotSatisfiableException(Exception):
+    """
+    Thrown when none of the ranges in a Range header overlap the file.
+    """
+
+
+def etag(st: os.stat_result) -> str:
+    """
+    Get the strong ETag of a file from its stat data. The ETag doesn't depend on whether the
+    file's md5 is known, so it doesn't change when the file's metadata is generated.
+    """
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def last_modified(st: os.stat_result) -> str:
+    return formatdate(st.st_mtime, usegmt=True)
+
+
+def _parse_date(value: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_list(value: str) -> List[str]:
+    return [t.strip() for t in value.split(",") if t.strip()]
+
+
+def _weak_match(tag: str, etag_: str) -> bool:
+    return (tag[2:] if tag.startswith("W/") else tag) == etag_
+
+
+def not_modified(headers, etag_: str, mtime: float) -> bool:
+    """
+    Determine whether a client's cached copy of a file is current, in which case a 304 should
+    be returned.
+    :param headers: the request headers.
+    :param etag_: the ETag of the file.
+    :param mtime: the modification time of the file in seconds since the epoch.
+    """
+    if "If-None-Match" in headers:
+        # If-Modified-Since is ignored when If-None-Match is present
+        tags = _etag_list(headers["If-None-Match"])
+        return "*" in tags or any(_weak_match(t, etag_) for t in tags)
+    if "If-Modified-Since" in headers:
+        since = _parse_date(headers["If-Modified-Since"])
+        # HTTP dates have a resolution of one second
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(headers, etag_: str, mtime: float) -> bool:
+    """
+    Determine whether the Range header of a request should be honored given its If-Range
+    header. If the file has changed since the validator in If-Range was sent, the whole file
+    must be returned.
+    """
+    value = headers.get("If-Range")
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        # requires a strong comparison, which a weak tag never matches
+        return value == etag_
+    return _parse_date(value) == int(mtime)
+
+
+def parse_range(value: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a Range header.
+    :param value: the value of the header.
+    :param size: the size of the file in bytes.
+    :return: the start and inclusive end of each satisfiable range in the order they were
+        requested, or None if the header is invalid or should otherwise be ignored.
+    :raises RangeNotSatisfiableException: if no range overlaps the file.
+    """
+    unit, _, ranges = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [r.strip() for r in ranges.split(",") if r.strip()]
+    if not specs or len(specs) > _MAX_RANGES:
+        return None
+    result = []
+    for spec in specs:
+        first, dash, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # a suffix range, the final n bytes of the file
+            length = int(last)
+            if length > 0 and size > 0:
+                result.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            result.append((start, min(int(last), size - 1) if last else size - 1))
+    if not result:
+        raise RangeNotSatisfiableException()
+    return result
+
+
+def _part_header(boundary: str, start: int, end: int, size: int) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        + f"Content-Type: {_CONTENT_TYPE}\r\n"
+        + f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+    ).encode()
+
+
+async def _write_range(response: web.StreamResponse, fd: int, start: int, end: int):
+    offset = start
+    while offset <= end:
+        data = await run_blocking(os.pread, fd, min(_READ_SIZE, end + 1 - offset), offset)
+        if not data:
+            # the file was truncated while it was being sent
+            raise ConnectionResetError("File truncated during download")
+        await response.write(data)
+        offset += len(data)
+
+
+async def send_file(
+    request: web.Request,
+    fd: int,
+    size: int,
+    ranges: Optional[List[Tuple[int, int]]],
+    headers: dict,
+) -> web.StreamResponse:
+    """
+    Send all or part of an open file.
+    :param request: the request.
+    :param fd: the file descriptor of the file.
+    :param size: the size of the file.
+    :param ranges: the ranges to send from parse_range, or None to send the whole file.
+    :param headers: other headers to include in the response.
+    """
+    headers = dict(headers)
+    if ranges is None:
+        parts = [(b"", 0, size - 1)]
+        status = 200
+        headers["Content-Type"] = _CONTENT_TYPE
+        trailer = b""
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        parts = [(b"", start, end)]
+        status = 206
+        headers["Content-Type"] = _CONTENT_TYPE
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        trailer = b""
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [
+            # every part after the first starts on a new line
+            ((b"\r\n" if i else b"") + _part_header(boundary, start, end, size), start, end)
+            for i, (start, end) in enumerate(ranges)
+        ]
+        status = 206
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        trailer = f"\r\n--{boundary}--\r\n".encode()
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_length = (
+        sum(len(h) + end + 1 - start for h, start, end in parts) + len(trailer)
+    )
+    await response.prepare(request)
+    if request.method != "HEAD":
+        for part_header, start, end in parts:
+            if part_header:
+                await response.write(part_header)
+            await _write_range(response, fd, start, end)
+        if trailer:
+            await response.write(trailer)
+    await response.write_eof()
+    return response
+
+
+class _QueueWriter(io.RawIOBase):
+    """
+    A write only, unseekable file that hands its data to the event loop in chunks through a
+    bounded queue. A write blocks while the queue is full, which limits how far the archive
+    gets ahead of the client.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        self._loop = loop
+        self._queue = queue
+        self._buffer = bytearray()
+        self.abandoned = False
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= _ARCHIVE_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def _put(self, item):
+        if self.abandoned:
+            raise ConnectionAbortedError("The client stopped reading the archive")
+        asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop).result()
+
+    def finish(self, error: BaseException = None):
+        """
+        Send any buffered data followed by the end of the archive, or the error that stopped
+        the archive from being written.
+        """
+        if error is None and self._buffer:
+            self._put(bytes(self._buffer))
+        self._buffer.clear()
+        self._put(error)
+
+
+def _archive_entries(full_path: str, arcname: str, show_hidden: bool):
+    # symlinks are skipped as zip would follow them, possibly out of the staging area
+    if os.path.islink(full_path):
+        return
+    if not os.path.isdir(full_path):
+        yield full_path, arcname
+        return
+    yield full_path, arcname
+    try:
+        with os.scandir(full_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except FileNotFoundError:
+        return  # removed while the archive was being written
+    for entry in entries:
+        if show_hidden or not entry.name.startswith("."):
+            yield from _archive_entries(entry.path, arcname + "/" + entry.name, show_hidden)
+
+
+def _write_archive(
+    writer: _QueueWriter, fmt: str, selections: List[Tuple[str, str]], show_hidden: bool
+):
+    try:
+        if fmt == "zip":
+            # entries are stored rather than deflated so the archive is limited by disk and
+            # network speed rather than by one core, use tar.gz to compress
+            archive = zipfile.ZipFile(writer, "w", zipfile.ZIP_STORED, allowZip64=True)
+            add = archive.write
+        else:
+            archive = tarfile.open(
+                fileobj=writer, mode="w|gz" if fmt == "tar.gz" else "w|",
+                format=tarfile.PAX_FORMAT)
+
+            def add(path, name):
+                archive.add(path, name, recursive=False)
+        with archive:
+            for full_path, arcname in selections:
+                for path, name in _archive_entries(full_path, arcname, show_hidden):
+                    try:
+                        add(path, name)
+                    except FileNotFoundError:
+                        pass  # removed while the archive was being written
+    except ConnectionAbortedError:
+        return
+    except BaseException as e:
+        logging.exception("Failed to write archive")
+        try:
+            writer.finish(e)
+        except ConnectionAbortedError:
+            pass
+        return
+    try:
+        writer.finish()
+    except ConnectionAbortedError:
+        pass
+
+
+async def send_archive(
+    request: web.Request,
+    fmt: str,
+    selections: List[Tuple[str, str]],
+    show_hidden: bool,
+    filename: str,
+) -> web.StreamResponse:
+    """
+    Send an archive of files and folders, which is written as it is sent.
+    :param request: the request.
+    :param fmt: the format of the archive, one of the keys of ARCHIVE_FORMATS.
+    :param selections: the full path of each file or folder to include in the archive and
+        its name in the archive. Folders are included with their contents.
+    :param show_hidden: whether to include files and folders in folders whose names start
+        with a '.'.
+    :param filename: the name of the archive file.
+    """
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=_ARCHIVE_QUEUE_SIZE)
+    writer = _QueueWriter(loop, queue)
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": ARCHIVE_FORMATS[fmt],
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    if request.method == "HEAD":
+        await response.write_eof()
+        return response
+    # the thread is busy for as long as the download takes, so it isn't taken from the IO pool
+    thread = threading.Thread(
+        target=_write_archive,
+        args=(writer, fmt, selections, show_hidden),
+        name="archive-writer",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                # the headers have been sent, so all that can be done is to drop the
+                # connection so the client sees the archive is incomplete
+                raise ConnectionResetError("Failed to write archive") from item
+            await response.write(item)
+    finally:
+        writer.abandoned = True
+        # let a write that is blocked on the full queue finish so the thread sees the flag
+        while not queue.empty():
+            queue.get_nowait()
+    await response.write_eof()
+    return response
@@ -0,0 +1,321 @@
+"""
+Streaming extraction of archives and compressed files.
+
+Archives are read sequentially and each entry is written straight to disk in bounded chunks, so
+memory use doesn't depend on the size of the archive or the number of entries in it. Each file
+is digested as it is written so its metadata is saved as soon as it lands, and the extracted
+files and folders are added to the directory index in batches, so neither needs the files to be
+read or scanned again.
+
+Large gzip and bzip2 files are decompressed on more than one thread where the file allows it,
+see parallel_decompress.
+
+Entries that would be written outside the destination folder, and entries that are not regular
+files or folders, such as links and devices, are skipped.
+
+The functions here block and should be run off the event loop.
+"""
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+from typing import List, Optional, Tuple
+
+from . import parallel_decompress
+from .decompress_jobs import Progress
+from .metadata import FileDigest, save_metadata, index_entries, _determine_source
+from .utils import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_CHUNK_SIZE = 1024 * 1024
+# extracted entries are added to the index once there are this many or this much time has passed
+_INDEX_BATCH_SIZE = 1000
+_INDEX_BATCH_SEC = 1
+
+
+class ExtractionException(Exception):
+    """
+    Thrown when an archive can't be extracted.
+    """
+
+
+class ExtractionCancelledException(ExtractionException):
+    """
+    Thrown when an extraction is cancelled.
+    """
+
+    def __init__(self):
+        super().__init__("The extraction was cancelled")
+
+
+def _check_cancelled(progress: Progress):
+    if progress.cancelled:
+        raise ExtractionCancelledException()
+
+
+def _zstd_reader(f):
+    return zstandard.ZstdDecompressor().stream_reader(f)
+
+
+# compression -> function that wraps a binary file in a decompressing reader
+_DECOMPRESSORS = {
+    "": lambda f: f,
+    "gz": lambda f: gzip.GzipFile(fileobj=f),
+    "bz2": lambda f: bz2.BZ2File(f),
+    "xz": lambda f: lzma.LZMAFile(f),
+}
+# errors from reading a corrupt archive or writing the extracted files
+_ERRORS = (
+    tarfile.TarError, zipfile.BadZipFile, OSError, EOFError, lzma.LZMAError, zlib.error)
+if zstandard:
+    _DECOMPRESSORS["zst"] = _zstd_reader
+    _ERRORS += (zstandard.ZstdError,)
+
+# suffix -> compression of a tar file, longest suffixes first
+_TAR_SUFFIXES = [
+    (".tar.gz", "gz"),
+    (".tgz", "gz"),
+    (".tar.bz2", "bz2"),
+    (".tar.bz", "bz2"),
+    (".tar.xz", "xz"),
+    (".txz", "xz"),
+    (".tar.zst", "zst"),
+    (".tar", ""),
+]
+_ZIP_SUFFIXES = [".zip", ".ZIP"]
+# suffix -> compression of a single compressed file
+_FILE_SUFFIXES = [
+    (".gz", "gz"),
+    (".bz2", "bz2"),
+    (".bzip2", "bz2"),
+    (".xz", "xz"),
+    (".zst", "zst"),
+]
+
+
+def _format(full_path: str) -> Optional[Tuple[str, str]]:
+    for suffix, compression in _TAR_SUFFIXES:
+        if full_path.endswith(suffix):
+            return ("tar", compression) if compression in _DECOMPRESSORS else None
+    for suffix in _ZIP_SUFFIXES:
+        if full_path.endswith(suffix):
+            return "zip", ""
+    for suffix, compression in _FILE_SUFFIXES:
+        if full_path.endswith(suffix):
+            return ("file", compression) if compression in _DECOMPRESSORS else None
+    return None
+
+
+def can_extract(full_path: str) -> bool:
+    """
+    Determine whether a file can be extracted based on its extension.
+    """
+    return _format(full_path) is not None
+
+
+class _CountingReader(io.RawIOBase):
+    """
+    Reports how far into a file has been read. Seeking back, as zip files do, doesn't count the
+    same bytes twice.
+    """
+
+    def __init__(self, f, progress: Progress):
+        self._f = f
+        self._progress = progress
+        self._high_water = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._f.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def readinto(self, b):
+        _check_cancelled(self._progress)
+        count = self._f.readinto(b)
+        position = self._f.tell()
+        if position > self._high_water:
+            self._progress.add_bytes(position - self._high_water)
+            self._high_water = position
+        return count
+
+
+class _Landed:
+    """
+    Saves the metadata of extracted files and adds extracted entries to the index in batches.
+    """
+
+    def __init__(self, progress: Progress):
+        self._progress = progress
+        self._batch: List[Tuple[Path, Optional[str]]] = []
+        self._last_flush = time.monotonic()
+
+    def folder(self, full_path: str):
+        self._add(Path.from_full_path(full_path), None)
+
+    def file(self, full_path: str, digest: FileDigest, mtime: Optional[float] = None):
+        if mtime is not None:
+            os.utime(full_path, (mtime, mtime))
+        path = Path.from_full_path(full_path)
+        # the metadata is saved after the mtime is set so that it is not considered stale
+        source = _determine_source(path)
+        save_metadata(path, source, digest)
+        self._add(path, source)
+
+    def _add(self, path: Path, source: Optional[str]):
+        self._progress.add_file()
+        self._batch.append((path, source))
+        if (len(self._batch) >= _INDEX_BATCH_SIZE
+                or time.monotonic() - self._last_flush >= _INDEX_BATCH_SEC):
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            index_entries(self._batch)
+            self._batch = []
+        self._last_flush = time.monotonic()
+
+
+def _target(destination: str, name: str) -> Optional[str]:
+    # the same rules as zipfile.extract: leading slashes, drive letters, '.' and '..' are
+    # dropped, which keeps the target inside the destination
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    if not parts:
+        return None
+    return os.path.join(destination, *parts)
+
+
+def _makedirs(full_path: str, destination: str, landed: _Landed):
+    # record each folder that is created so that it is indexed
+    missing = []
+    while full_path != destination and not os.path.isdir(full_path):
+        missing.append(full_path)
+        full_path = os.path.dirname(full_path)
+    for folder in reversed(missing):
+        os.mkdir(folder)
+        landed.folder(folder)
+
+
+def _copy(source, target: str, progress: Progress) -> FileDigest:
+    digest = FileDigest()
+    with open(target, "wb") as out:
+        while True:
+            _check_cancelled(progress)
+            chunk = source.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            digest.update(chunk)
+    return digest
+
+
+def _extract_tar(reader, destination: str, landed: _Landed, progress: Progress):
+    # stream mode reads the archive strictly in order, without seeking
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for member in tar:
+            # stream mode keeps every member it has read, which would grow without bound
+            tar.members = []
+            target = _target(destination, member.name)
+            if target is None:
+                continue
+            if member.isdir():
+                _makedirs(target, destination, landed)
+            elif member.isfile():
+                _makedirs(os.path.dirname(target), destination, landed)
+                digest = _copy(tar.extractfile(member), target, progress)
+                landed.file(target, digest, member.mtime)
+            else:
+                logging.info(f"Skipping tar entry {member.name} which is not a file or folder")
+
+
+def _extract_zip(reader, destination: str, landed: _Landed, progress: Progress):
+    with zipfile.ZipFile(reader) as zf:
+        for info in zf.infolist():
+            target = _target(destination, info.filename)
+            if target is None:
+                continue
+            if info.is_dir():
+                _makedirs(target, destination, landed)
+            else:
+                _makedirs(os.path.dirname(target), destination, landed)
+                with zf.open(info) as source:
+                    digest = _copy(source, target, progress)
+                landed.file(target, digest, time.mktime(info.date_time + (0, 0, -1)))
+
+
+def _extract_file(
+    reader, full_path: str, suffix_len: int, landed: _Landed, progress: Progress
+):
+    target = full_path[:-suffix_len]
+    if os.path.exists(target):
+        raise ExtractionException(f"{Path.from_full_path(target).user_path} already exists")
+    try:
+        digest = _copy(reader, target, progress)
+    except BaseException:
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        raise
+    landed.file(target, digest)
+    # as gzip -d and bzip2 -d do
+    os.remove(full_path)
+
+
+def _open_decompressed(f, reader, compression: str, threads: int, progress: Progress):
+    if threads > 1 and compression in parallel_decompress.COMPRESSIONS:
+        if parallel_decompress.splittable(f.fileno(), compression):
+            return parallel_decompress.open_split(reader, compression, threads)
+        command = parallel_decompress.command(compression, threads)
+        if command:
+            return parallel_decompress.open_command(command, f, progress)
+    return _DECOMPRESSORS[compression](reader)
+
+
+def extract(path: Path, progress: Progress, threads: int = 1):
+    """
+    Extract an archive into the folder it is in, or decompress a single compressed file in
+    place of the compressed file.
+    :param path: the archive.
+    :param progress: updated with the bytes of the archive read and the entries extracted.
+    :param threads: the number of threads that may be used to decompress a gzip or bzip2 file.
+    """
+    fmt = _format(path.full_path)
+    if fmt is None:
+        raise ExtractionException(f"cannot decompress {path.user_path}")
+    kind, compression = fmt
+    destination = os.path.dirname(path.full_path)
+    landed = _Landed(progress)
+    try:
+        with open(path.full_path, "rb") as f:
+            reader = io.BufferedReader(_CountingReader(f, progress), _CHUNK_SIZE)
+            if kind == "zip":
+                _extract_zip(reader, destination, landed, progress)
+                return
+            with _open_decompressed(f, reader, compression, threads, progress) as decompressed:
+                if kind == "tar":
+                    _extract_tar(decompressed, destination, landed, progress)
+                else:
+                    suffix = [s for s, c in _FILE_SUFFIXES if path.full_path.endswith(s)][0]
+                    _extract_file(
+                        decompressed, path.full_path, len(suffix), landed, progress)
+    except _ERRORS as e:
+        raise ExtractionException(f"Failed to decompress {path.user_path}: {e}") from e
+    finally:
+        landed.flush()
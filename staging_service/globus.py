@@ -1,24 +1,47 @@
+from .blocking_io import run_blocking
+from . import http_client
+from .single_flight import SingleFlight
 from .utils import Path
+from collections import OrderedDict
 import aiohttp
 import aiofiles
 import os
 import configparser
+import time
 
+# the .globus_id file writes in progress, by username
+_globus_id_writes = SingleFlight()
+
+# the users whose root directory and non-empty .globus_id file have been confirmed to exist, and
+# when, oldest first. The files can also be removed by other workers or outside the service, so
+# they are checked again after a while.
+_KNOWN_USERS_MAX = 10000
+_KNOWN_USERS_TTL_SEC = 10 * 60
+_known_users = OrderedDict()
+
+_auth2_me_url = None
 
-def _get_authme_url():
-    config = configparser.ConfigParser()
-    config.read(os.environ["KB_DEPLOYMENT_CONFIG"])
-    auth2_url = config["staging_service"]["AUTH_URL"]
 
-    auth2_me_url = auth2_url.split("services")[0] + "services/auth/api/V2/me"
+def set_auth_url(auth2_url):
+    """
+    Set the auth service URL the auth me URL is built from, given the token URL from the config.
+    """
+    global _auth2_me_url
+    _auth2_me_url = auth2_url.split("services")[0] + "services/auth/api/V2/me"
 
-    return auth2_me_url
+
+def _get_authme_url():
+    if _auth2_me_url is None:
+        config = configparser.ConfigParser()
+        config.read(os.environ["KB_DEPLOYMENT_CONFIG"])
+        set_auth_url(config["staging_service"]["AUTH_URL"])
+    return _auth2_me_url
 
 
 async def _get_globus_ids(token):
     if not token:
         raise aiohttp.web.HTTPBadRequest(text="must supply token")
-    async with aiohttp.ClientSession() as session:
+    async with http_client.session() as session:
         auth2_me_url = _get_authme_url()
         async with session.get(auth2_me_url, headers={"Authorization": token}) as resp:
             ret = await resp.json()
@@ -44,23 +67,70 @@ def is_globusid(path: Path, username: str):
     return path.full_path == _globus_id_path(username)
 
 
+def _nonempty_file_exists(file_path: str):
+    return os.path.exists(file_path) and os.stat(file_path).st_size > 0
+
+
+def _is_known_user(username):
+    confirmed = _known_users.get(username)
+    if confirmed is None:
+        return False
+    if time.monotonic() - confirmed > _KNOWN_USERS_TTL_SEC:
+        del _known_users[username]
+        return False
+    return True
+
+
+def _add_known_user(username):
+    _known_users.pop(username, None)
+    _known_users[username] = time.monotonic()
+    while len(_known_users) > _KNOWN_USERS_MAX:
+        _known_users.popitem(last=False)
+
+
+def forget_user(username):
+    """
+    Check the user's root directory and .globus_id file again on the user's next request, for
+    when the user's files are deleted or moved.
+    """
+    _known_users.pop(username, None)
+
+
+async def _write_globus_id(username, token):
+    # returns an error rather than raising it, as the result is shared between requests
+    try:
+        globus_ids = await _get_globus_ids(token)
+    except aiohttp.web.HTTPException as e:
+        return type(e), e.text
+    if len(globus_ids) == 0:
+        return None
+    # TODO in the future this should support writing multiple lines
+    # such as the commented code below, for multiple linked accounts
+    # text = '\n'.join(globus_ids)
+    text = globus_ids[0]
+    async with aiofiles.open(_globus_id_path(username).full_path, mode="w") as globus_file:
+        await globus_file.writelines(text)
+    _add_known_user(username)
+    return None
+
+
 async def assert_globusid_exists(username, token):
     """ ensures that a globus id exists if there is a valid one for user"""
+    if _is_known_user(username):
+        return
 
     # make root dir
     root = Path.validate_path(username, "")
-    if not os.path.exists(root.full_path):
-        os.makedirs(root.full_path)
+    if not await run_blocking(os.path.exists, root.full_path):
+        await run_blocking(os.makedirs, root.full_path, exist_ok=True)
 
     path = _globus_id_path(username)
     # check to see if file exists or is empty
-    if not os.path.exists(path.full_path) or os.stat(path.full_path).st_size == 0:
-        globus_ids = await _get_globus_ids(token)
-        if len(globus_ids) == 0:
-            return
-        # TODO in the future this should support writing multiple lines
-        # such as the commented code below, for multiple linked accounts
-        # text = '\n'.join(globus_ids)
-        text = globus_ids[0]
-        async with aiofiles.open(path.full_path, mode="w") as globus_file:
-            await globus_file.writelines(text)
+    if await run_blocking(_nonempty_file_exists, path.full_path):
+        _add_known_user(username)
+    else:
+        # concurrent requests for the user share one lookup and write
+        error = await _globus_id_writes.run(username, _write_globus_id, username, token)
+        if error:
+            error_type, text = error
+            raise error_type(text=text)
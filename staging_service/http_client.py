@@ -0,0 +1,83 @@
+"""
+A shared HTTP client session for calls to other services, such as the auth service.
+
+Creating a session per call means a new TCP connection and TLS handshake, and a DNS lookup, for
+every call. The shared session keeps connections to each host open between calls and caches
+DNS lookups, so a call to a service that was called recently only costs its own round trip.
+The session is started and closed with the app.
+"""
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+DEFAULT_CONNECTION_LIMIT = 100
+DEFAULT_CONNECTION_LIMIT_PER_HOST = 20
+DEFAULT_TIMEOUT_SEC = 30
+DEFAULT_CONNECT_TIMEOUT_SEC = 10
+DEFAULT_DNS_CACHE_TTL_SEC = 300
+DEFAULT_KEEPALIVE_SEC = 60
+
+_session = None
+
+
+def _timeout(
+    timeout_sec: float = DEFAULT_TIMEOUT_SEC,
+    connect_timeout_sec: float = DEFAULT_CONNECT_TIMEOUT_SEC,
+) -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=timeout_sec, connect=connect_timeout_sec)
+
+
+async def start(
+    connection_limit: int = DEFAULT_CONNECTION_LIMIT,
+    connection_limit_per_host: int = DEFAULT_CONNECTION_LIMIT_PER_HOST,
+    timeout_sec: float = DEFAULT_TIMEOUT_SEC,
+    connect_timeout_sec: float = DEFAULT_CONNECT_TIMEOUT_SEC,
+    dns_cache_ttl_sec: float = DEFAULT_DNS_CACHE_TTL_SEC,
+    keepalive_sec: float = DEFAULT_KEEPALIVE_SEC,
+):
+    """
+    Start the shared session, closing any existing session. Must be called on the event loop
+    the session will be used from.
+    :param connection_limit: the maximum number of open connections, or 0 for no limit.
+    :param connection_limit_per_host: the maximum number of open connections to each host, or
+        0 for no limit.
+    :param timeout_sec: the maximum time for a call, including reading the response.
+    :param connect_timeout_sec: the maximum time to wait for a connection, including waiting
+        for a connection from the pool.
+    :param dns_cache_ttl_sec: how long DNS lookups are cached.
+    :param keepalive_sec: how long an idle connection is kept open.
+    """
+    global _session
+    await close()
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit_per_host,
+        ttl_dns_cache=dns_cache_ttl_sec,
+        keepalive_timeout=keepalive_sec,
+    )
+    _session = aiohttp.ClientSession(
+        connector=connector, timeout=_timeout(timeout_sec, connect_timeout_sec)
+    )
+
+
+async def close():
+    """
+    Close the shared session and its connections.
+    """
+    global _session
+    session, _session = _session, None
+    if session is not None:
+        await session.close()
+
+
+@asynccontextmanager
+async def session():
+    """
+    Get the shared session for the duration of a call, or a session that is closed after the
+    call if the shared session hasn't been started.
+    """
+    if _session is not None and not _session.closed:
+        yield _session
+    else:
+        async with aiohttp.ClientSession(timeout=_timeout()) as s:
+            yield s
@@ -1,22 +1,25 @@
-from json import JSONDecoder, JSONEncoder
-import aiofiles
-from .utils import run_command, Path
+import base64
+import io
+import stat
+import threading
+from typing import List
+from .blocking_io import run_blocking
+from .dir_index import DirIndex
+from .metadata_store import get_store
+from .utils import Path
 import os
 from aiohttp import web
 import hashlib
 from difflib import SequenceMatcher
 from itertools import islice
 
-decoder = JSONDecoder()
-encoder = JSONEncoder()
-
 
 async def stat_data(path: Path) -> dict:
     """
     only call this on a validated full path
     """
-    file_stats = os.stat(path.full_path)
-    isFolder = os.path.isdir(path.full_path)
+    file_stats = await run_blocking(os.stat, path.full_path)
+    isFolder = stat.S_ISDIR(file_stats.st_mode)
     return {
         "name": path.name,
         "path": path.user_path,
@@ -26,60 +29,192 @@ async def stat_data(path: Path) -> dict:
     }
 
 
-def _file_read_from_tail(file_path):
-    upper_bound = min(1024, os.stat(file_path).st_size)
-    with open(file_path, "r") as file:
-        file.seek(0, os.SEEK_END)
-        file.seek(file.tell() - upper_bound, os.SEEK_SET)
-        return file.read()
+_READ_SIZE = 1024 * 1024
+# a text mode read decodes the start of the file in chunks of this size
+_HEAD_BYTES = 8192
+_HEAD_CHARS = 1024
+_TAIL_BYTES = 1024
 
 
-def _file_read_from_head(file_path):
-    with open(file_path, "r") as file:
-        return file.read(1024)
+class FileDigest:
+    """
+    Computes the md5, line count, head and tail of a file in a single pass over its contents,
+    holding no more than one chunk of the file in memory.
+    """
 
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._newlines = 0
+        self._size = 0
+        self._head = bytearray()
+        self._tail = b""
 
-async def _generate_metadata(path: Path, source: str):
-    os.makedirs(os.path.dirname(path.metadata_path), exist_ok=True)
-    if os.path.exists(path.metadata_path):
-        async with aiofiles.open(path.metadata_path, mode="r") as extant:
-            data = await extant.read()
-            data = decoder.decode(data)
-    else:
-        data = {}
-    # first ouptut of md5sum is the checksum
-    if source:
-        data["source"] = source
-    try:
-        md5 = hashlib.md5(open(path.full_path, "rb").read()).hexdigest()
-    except:
-        md5 = "n/a"
+    def update(self, chunk: bytes):
+        if not chunk:
+            return
+        self._md5.update(chunk)
+        self._newlines += chunk.count(b"\n")
+        self._size += len(chunk)
+        if len(self._head) < _HEAD_BYTES:
+            self._head += chunk[: _HEAD_BYTES - len(self._head)]
+        self._tail = (self._tail + chunk[-_TAIL_BYTES:])[-_TAIL_BYTES:]
+
+    def metadata(self) -> dict:
+        """
+        Returns the md5, lineCount, head and tail metadata fields for the data seen so far.
+        """
+        return _digest_metadata(self._md5.hexdigest(), self._newlines, self._head, self._tail)
+
+    def part(self, include_head: bool) -> dict:
+        """
+        Returns a JSON serializable digest of the data seen so far as one part of a larger
+        file, which can be combined with the digests of the other parts by PartsDigest.
+        :param include_head: whether to keep the start of the data, which is only needed for
+            the first part of the file.
+        """
+        part = {
+            "size": self._size,
+            "md5": self._md5.hexdigest(),
+            "newlines": self._newlines,
+            "tail": base64.b64encode(self._tail).decode(),
+        }
+        if include_head:
+            part["head"] = base64.b64encode(bytes(self._head)).decode()
+        return part
 
-    data["md5"] = md5.split()[0]
-    # first output of wc is the count
-    data["lineCount"] = str(sum((1 for i in open(path.full_path, "rb"))))
+
+class PartsDigest:
+    """
+    The metadata of a file that was written as separately digested parts. The line count,
+    head and tail are combined from the parts, but an md5 can't be, so the md5 of the whole
+    file must be provided. The parts' md5s are also combined into a multipart checksum, which
+    is the md5 of the concatenated binary md5s of the parts followed by a '-' and the number of
+    parts.
+    """
+
+    def __init__(self, parts: list, md5: str):
+        """
+        :param parts: the part digests from FileDigest.part() in order. The first part must
+            include its head and be at least as long as the head.
+        :param md5: the md5 of the whole file.
+        """
+        self._parts = parts
+        self._md5 = md5
+
+    def metadata(self) -> dict:
+        """
+        Returns the md5, lineCount, head, tail and partsMd5 metadata fields.
+        """
+        tail = b""
+        for part in reversed(self._parts):
+            tail = base64.b64decode(part["tail"]) + tail
+            if len(tail) >= _TAIL_BYTES:
+                break
+        md5s = b"".join(bytes.fromhex(p["md5"]) for p in self._parts)
+        data = _digest_metadata(
+            self._md5,
+            sum(p["newlines"] for p in self._parts),
+            base64.b64decode(self._parts[0].get("head", "")),
+            tail[-_TAIL_BYTES:],
+        )
+        data["partsMd5"] = f"{hashlib.md5(md5s).hexdigest()}-{len(self._parts)}"
+        return data
+
+
+def _digest_metadata(md5: str, newlines: int, head: bytes, tail: bytes) -> dict:
+    # a final line without a newline still counts as a line
+    lines = newlines + (1 if tail and not tail.endswith(b"\n") else 0)
     try:  # all things that expect a text file to decode output should be in this block
-        data["head"] = _file_read_from_head(path.full_path)
-        data["tail"] = _file_read_from_tail(path.full_path)
+        # decode as a text mode open() of the file would
+        head = io.TextIOWrapper(io.BytesIO(head)).read(_HEAD_CHARS)
+        tail = io.TextIOWrapper(io.BytesIO(tail)).read()
     except:
-        data["head"] = "not text file"
-        data["tail"] = "not text file"
-    async with aiofiles.open(path.metadata_path, mode="w") as f:
-        await f.writelines(encoder.encode(data))
+        head = "not text file"
+        tail = "not text file"
+    return {
+        "md5": md5,
+        "lineCount": str(lines),
+        "head": head,
+        "tail": tail,
+    }
+
+
+def md5_file(file_path: str) -> str:
+    """
+    blocks, so should only be called off the event loop
+    """
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(_READ_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _digest_file(file_path: str) -> FileDigest:
+    digest = FileDigest()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(_READ_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest
+
+
+def save_metadata(path: Path, source: str, digest) -> dict:
+    """
+    writes the metadata for a file whose contents have already been digested by a FileDigest
+    or PartsDigest, keeping any other fields in the existing metadata
+    blocks, so should only be called off the event loop
+    """
+    store = get_store()
+    extant = store.read(path)
+    data = extant[0] if extant else {}
+    if source:
+        data["source"] = source
+    data.update(digest.metadata())
+    store.write(path, data)
     return data
 
 
+async def write_metadata(path: Path, source: str, digest) -> dict:
+    """
+    writes the metadata for a file whose contents have already been digested by a FileDigest
+    or PartsDigest, keeping any other fields in the existing metadata
+    """
+    return await run_blocking(save_metadata, path, source, digest)
+
+
+async def _generate_metadata(path: Path, source: str):
+    return await write_metadata(path, source, await run_blocking(_digest_file, path.full_path))
+
+
 async def add_upa(path: Path, UPA: str):
-    if os.path.exists(path.metadata_path):
-        async with aiofiles.open(path.metadata_path, mode="r") as extant:
-            data = await extant.read()
-            data = decoder.decode(data)
+    extant = await run_blocking(get_store().read, path)
+    if extant:
+        data = extant[0]
     else:
-        data = await _generate_metadata(path)  # TODO performance optimization
+        # TODO performance optimization
+        data = await _generate_metadata(path, await run_blocking(_determine_source, path))
     data["UPA"] = UPA
-    os.makedirs(os.path.dirname(path.metadata_path), exist_ok=True)
-    async with aiofiles.open(path.metadata_path, mode="w") as update:
-        await update.writelines(encoder.encode(data))
+    await run_blocking(get_store().write, path, data)
+
+
+async def remove_metadata(path: Path):
+    """
+    removes the metadata of a deleted file, or of everything below a deleted folder
+    """
+    await run_blocking(get_store().remove, path)
+
+
+async def move_metadata(path: Path, new_path: Path):
+    """
+    moves the metadata of a moved file, or of everything below a moved folder
+    """
+    await run_blocking(get_store().move, path, new_path)
 
 
 def _determine_source(path: Path):
@@ -87,31 +222,58 @@ def _determine_source(path: Path):
     tries to determine the source of a file for which the source is unknown
     currently this works for JGI imported files only
     """
-    jgi_path = path.jgi_metadata
-    if os.path.exists(jgi_path) and os.path.isfile(jgi_path):
+    if os.path.isfile(path.jgi_metadata):
         return "JGI import"
     else:
         return "Unknown"
 
 
-async def _only_source(path: Path):
-    if os.path.exists(path.metadata_path):
-        async with aiofiles.open(path.metadata_path, mode="r") as extant:
-            try:
-                data = await extant.read()
-                data = decoder.decode(data)
-            except:
-                data = {}
-    else:
-        data = {}
-    if "source" in data:
-        return data["source"]
-    else:
-        data["source"] = _determine_source(path)
-    os.makedirs(os.path.dirname(path.metadata_path), exist_ok=True)
-    async with aiofiles.open(path.metadata_path, mode="w") as update:
-        await update.writelines(encoder.encode(data))
-    return data["source"]
+# sources determined while indexing files, by metadata path, which are written to the metadata
+# files by flush_sources rather than while the files are listed
+_pending_sources = {}
+_pending_sources_lock = threading.Lock()
+# past this many pending sources more are not kept, as they can be determined again
+_MAX_PENDING_SOURCES = 100000
+
+
+def _only_sources(paths: List[Path]) -> List[str]:
+    """
+    gets the sources of files from their metadata, or determines them, without writing anything.
+    Determined sources are saved to the metadata by the next flush_sources.
+    blocks, so should only be called off the event loop
+    """
+    sources = []
+    # unreadable metadata is replaced when the source is written
+    for path, extant in zip(paths, get_store().read_many(paths)):
+        if extant and "source" in extant:
+            sources.append(extant["source"])
+            continue
+        source = _determine_source(path)
+        with _pending_sources_lock:
+            if len(_pending_sources) < _MAX_PENDING_SOURCES:
+                _pending_sources[path.metadata_path] = (path, source)
+        sources.append(source)
+    return sources
+
+
+def flush_sources() -> int:
+    """
+    writes the sources determined while indexing files to their metadata, keeping any source
+    already in the metadata. Files that have since been deleted or moved are skipped.
+    blocks, so should only be called off the event loop
+    :return: the number of files whose sources were written.
+    """
+    global _pending_sources
+    with _pending_sources_lock:
+        pending, _pending_sources = _pending_sources, {}
+    sources = [(path, source) for path, source in pending.values()
+               if os.path.exists(path.full_path)]
+    get_store().add_sources(sources)
+    return len(sources)
+
+
+def _index_for(path: Path) -> DirIndex:
+    return DirIndex(path.user_path.split("/", 1)[0], _only_sources)
 
 
 async def dir_info(
@@ -120,26 +282,83 @@ async def dir_info(
     """
     only call this on a validated full path
     """
-    response = []
-    for entry in os.scandir(path.full_path):
-        specific_path = Path.from_full_path(entry.path)
-        # maybe should never show the special .globus_id file ever?
-        # or moving it somewhere outside the user directory would be better
-        if not show_hidden and entry.name.startswith('.'):
-            continue
-        if entry.is_dir():
-            if query == "" or specific_path.user_path.find(query) != -1:
-                response.append(await stat_data(specific_path))
-            if recurse:
-                response.extend(
-                    await dir_info(specific_path, show_hidden, query, recurse)
-                )
-        if entry.is_file():
-            if query == "" or specific_path.user_path.find(query) != -1:
-                data = await stat_data(specific_path)
-                data["source"] = await _only_source(specific_path)
-                response.append(data)
-    return response
+    return await run_blocking(_index_for(path).list, path, show_hidden, query, recurse)
+
+
+async def dir_page(
+    path: Path,
+    show_hidden: bool,
+    query: str = "",
+    depth: int = None,
+    sort: str = "path",
+    limit: int = None,
+    after: list = None,
+) -> tuple:
+    """
+    returns a page of the entries below a folder and the sort key of the last entry if there
+    are more entries. See DirIndex.page for the parameters.
+    only call this on a validated full path
+    """
+    return await run_blocking(
+        _index_for(path).page, path, show_hidden, query, depth, sort, limit, after)
+
+
+# the number of entries read from the index at a time by iter_dir_info
+_ITER_BATCH_SIZE = 1000
+
+
+async def iter_dir_info(
+    path: Path,
+    show_hidden: bool,
+    query: str = "",
+    depth: int = None,
+    sort: str = "path",
+):
+    """
+    an async generator version of dir_info that yields the entries below a folder as they are
+    read from the index rather than building a list of all of them. The entries are read off
+    the event loop a batch at a time. See DirIndex.iter_entries for the parameters.
+    only call this on a validated full path, and close the generator with aclose() if it isn't
+    exhausted
+    """
+    entries = _index_for(path).iter_entries(path, show_hidden, query, depth, sort)
+    try:
+        while True:
+            batch = await run_blocking(list, islice(entries, _ITER_BATCH_SIZE))
+            if not batch:
+                return
+            for entry in batch:
+                yield entry
+    finally:
+        await run_blocking(entries.close)
+
+
+def index_entries(entries: list):
+    """
+    adds files and folders to the directory index in one batch
+    :param entries: a list of (Path, source) tuples. The source of a folder is ignored.
+    blocks, so should only be called off the event loop
+    """
+    by_user = {}
+    for path, source in entries:
+        by_user.setdefault(path.user_path.split("/", 1)[0], []).append((path, source))
+    for user_entries in by_user.values():
+        _index_for(user_entries[0][0]).update_many(user_entries)
+
+
+async def update_index(path: Path, source: str = None):
+    """
+    updates the directory index after a file or folder is written or removed
+    """
+    await run_blocking(_index_for(path).update, path, source)
+
+
+async def remove_from_index(path: Path):
+    await run_blocking(_index_for(path).remove, path)
+
+
+async def move_in_index(path: Path, new_path: Path):
+    await run_blocking(_index_for(path).move, path, new_path)
 
 
 async def similar(file_name, comparing_file_name, similarity_cut_off):
@@ -162,25 +381,21 @@ async def some_metadata(path: Path, desired_fields=False, source=None):
     file_stats = await stat_data(path)
     if file_stats["isFolder"]:
         return file_stats
-    if (not os.path.exists(path.metadata_path)) or (
-        os.stat(path.metadata_path).st_mtime < file_stats["mtime"] / 1000
-    ):
+    extant = await run_blocking(get_store().read, path)
+    if extant is None or extant[1] < file_stats["mtime"] / 1000:
         # if metadata  does not exist or older than file: regenerate
         if source is None:  # TODO BUGFIX this will overwrite any source in the file
-            source = _determine_source(path)
+            source = await run_blocking(_determine_source, path)
         data = await _generate_metadata(path, source)
     else:  # metadata already exists and is up to date
-        async with aiofiles.open(path.metadata_path, mode="r") as f:
-            # make metadata fields local variables
-            data = await f.read()
-            data = decoder.decode(data)
+        data = extant[0]
         # due to legacy code, some file has corrupted metadata file
         # Also if a file is listed or checked for existence before the upload completes
         # this code block will be triggered
         expected_keys = ["source", "md5", "lineCount", "head", "tail"]
         if not set(expected_keys) <= set(data.keys()):
             if source is None and "source" not in data:
-                source = _determine_source(path)
+                source = await run_blocking(_determine_source, path)
             data = await _generate_metadata(path, source)
     data = {**data, **file_stats}
     if not desired_fields:
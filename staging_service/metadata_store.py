@@ -0,0 +1,304 @@
+"""
+Where the metadata of staged files (md5, lineCount, head, tail, source, UPA and so on) is kept.
+
+Two stores are available, chosen by the METADATA_STORE config key:
+
+sidecar - the default. One JSON file per staged file under META_DIR, at the file's user path.
+    The time a file's metadata was written is the mtime of its JSON file.
+sqlite - one SQLite database per user under META_DIR, with a row per file keyed by the file's
+    user path. This avoids an inode per staged file on the metadata volume, and deleting or
+    moving a folder is a single statement rather than a walk of its metadata tree.
+
+Existing sidecar files can be copied into the SQLite store with scripts/migrate_metadata.py.
+
+The time a file's metadata was written is kept so it can be compared with the file's mtime to
+tell whether the metadata is stale.
+
+All of the methods here block and should be run off the event loop.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import sqlite_db
+from .utils import Path
+
+_DB_DIR = ".staging_metadata"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    written REAL NOT NULL
+);
+"""
+
+_decoder = json.JSONDecoder()
+_encoder = json.JSONEncoder()
+
+
+def _username(user_path: str) -> str:
+    return user_path.split("/", 1)[0]
+
+
+class SidecarStore:
+    """
+    Keeps the metadata of each file in a JSON file under META_DIR.
+    """
+
+    def read(self, path: Path) -> Optional[Tuple[dict, float]]:
+        """
+        Get the metadata of a file.
+        :return: the metadata and the time it was written in seconds since the epoch, or None
+            if there is no metadata for the file.
+        :raises ValueError: if the metadata can't be decoded.
+        """
+        try:
+            with open(path.metadata_path) as f:
+                written = os.fstat(f.fileno()).st_mtime
+                return _decoder.decode(f.read()), written
+        except FileNotFoundError:
+            return None
+
+    def read_many(self, paths: List[Path]) -> List[Optional[dict]]:
+        """
+        Get the metadata of several files.
+        :return: the metadata of each file, or None if there is no metadata for the file or it
+            can't be decoded.
+        """
+        results = []
+        for path in paths:
+            try:
+                extant = self.read(path)
+            except ValueError:
+                extant = None
+            results.append(extant[0] if extant else None)
+        return results
+
+    def write(self, path: Path, data: dict):
+        """
+        Replace the metadata of a file.
+        """
+        os.makedirs(os.path.dirname(path.metadata_path), exist_ok=True)
+        with open(path.metadata_path, mode="w") as f:
+            f.write(_encoder.encode(data))
+
+    def add_sources(self, sources: Iterable[Tuple[Path, str]]):
+        """
+        Set the source of each file whose metadata has no source, creating its metadata if
+        there is none. Metadata that can't be decoded is replaced.
+        """
+        folders = set()
+        for path, source in sources:
+            folder = os.path.dirname(path.metadata_path)
+            if folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+            try:
+                with open(path.metadata_path) as f:
+                    data = _decoder.decode(f.read())
+            except (OSError, ValueError):
+                data = {}
+            if "source" in data:
+                continue
+            data["source"] = source
+            with open(path.metadata_path, mode="w") as f:
+                f.write(_encoder.encode(data))
+
+    def remove(self, path: Path):
+        """
+        Remove the metadata of a file, or of everything below a folder.
+        """
+        if os.path.isdir(path.metadata_path):
+            shutil.rmtree(path.metadata_path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path.metadata_path)
+            except FileNotFoundError:
+                pass
+
+    def move(self, path: Path, new_path: Path):
+        """
+        Move the metadata of a file, or of everything below a folder, to a new path, replacing
+        any metadata at the new path.
+        """
+        if os.path.exists(path.metadata_path):
+            self.remove(new_path)
+            os.makedirs(os.path.dirname(new_path.metadata_path), exist_ok=True)
+            shutil.move(path.metadata_path, new_path.metadata_path)
+
+
+class SQLiteStore:
+    """
+    Keeps the metadata of each user's files in a SQLite database under META_DIR.
+    """
+
+    def db_path(self, username: str) -> str:
+        """
+        Get the path of a user's database.
+        """
+        return os.path.join(Path._META_DIR, _DB_DIR, username + ".sqlite3")
+
+    def _connect(self, username: str) -> sqlite3.Connection:
+        return sqlite_db.connect(self.db_path(username), _SCHEMA)
+
+    def read(self, path: Path) -> Optional[Tuple[dict, float]]:
+        """
+        See SidecarStore.read.
+        """
+        conn = self._connect(_username(path.user_path))
+        try:
+            row = conn.execute(
+                "SELECT data, written FROM metadata WHERE path = ?",
+                (sqlite_db.normalize(path.user_path),),
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return _decoder.decode(row[0]), row[1]
+
+    def read_many(self, paths: List[Path]) -> List[Optional[dict]]:
+        """
+        See SidecarStore.read_many. Each user's metadata is read with one connection.
+        """
+        by_user: Dict[str, list] = {}
+        for i, path in enumerate(paths):
+            by_user.setdefault(_username(path.user_path), []).append(i)
+        results: List[Optional[dict]] = [None] * len(paths)
+        for username, indexes in by_user.items():
+            conn = self._connect(username)
+            try:
+                for i in indexes:
+                    row = conn.execute(
+                        "SELECT data FROM metadata WHERE path = ?",
+                        (sqlite_db.normalize(paths[i].user_path),),
+                    ).fetchone()
+                    if row is not None:
+                        try:
+                            results[i] = _decoder.decode(row[0])
+                        except ValueError:
+                            pass
+            finally:
+                conn.close()
+        return results
+
+    def write(self, path: Path, data: dict):
+        """
+        See SidecarStore.write.
+        """
+        self.import_many(
+            _username(path.user_path),
+            [(sqlite_db.normalize(path.user_path), data, time.time())])
+
+    def import_many(self, username: str, entries: Iterable[Tuple[str, dict, float]]):
+        """
+        Write the metadata of several of a user's files in one transaction, keeping any
+        metadata that was written later.
+        :param username: the user who owns the files.
+        :param entries: the user path, metadata and time the metadata was written of each file.
+        """
+        conn = self._connect(username)
+        try:
+            with sqlite_db.transaction(conn):
+                conn.executemany(
+                    "INSERT INTO metadata (path, data, written) VALUES (?, ?, ?) "
+                    + "ON CONFLICT (path) DO UPDATE SET data = excluded.data, "
+                    + "written = excluded.written WHERE excluded.written >= written",
+                    [(p, _encoder.encode(data), written) for p, data, written in entries],
+                )
+        finally:
+            conn.close()
+
+    def add_sources(self, sources: Iterable[Tuple[Path, str]]):
+        """
+        See SidecarStore.add_sources.
+        """
+        by_user: Dict[str, list] = {}
+        for path, source in sources:
+            by_user.setdefault(_username(path.user_path), []).append(
+                (sqlite_db.normalize(path.user_path), source))
+        now = time.time()
+        for username, user_sources in by_user.items():
+            conn = self._connect(username)
+            try:
+                with sqlite_db.transaction(conn):
+                    updates = []
+                    for user_path, source in user_sources:
+                        row = conn.execute(
+                            "SELECT data FROM metadata WHERE path = ?", (user_path,)
+                        ).fetchone()
+                        try:
+                            data = _decoder.decode(row[0]) if row else {}
+                        except ValueError:
+                            data = {}
+                        if "source" not in data:
+                            data["source"] = source
+                            updates.append((user_path, _encoder.encode(data), now))
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO metadata (path, data, written) VALUES (?, ?, ?)",
+                        updates,
+                    )
+            finally:
+                conn.close()
+
+    def remove(self, path: Path):
+        """
+        See SidecarStore.remove.
+        """
+        user_path = sqlite_db.normalize(path.user_path)
+        conn = self._connect(_username(user_path))
+        try:
+            conn.execute(
+                "DELETE FROM metadata WHERE path = ? OR (path > ? AND path < ?)",
+                (user_path,) + sqlite_db.subtree_bounds(user_path),
+            )
+        finally:
+            conn.close()
+
+    def move(self, path: Path, new_path: Path):
+        """
+        See SidecarStore.move. Both paths must belong to the same user.
+        """
+        old = sqlite_db.normalize(path.user_path)
+        new = sqlite_db.normalize(new_path.user_path)
+        conn = self._connect(_username(old))
+        try:
+            with sqlite_db.transaction(conn):
+                conn.execute(
+                    "DELETE FROM metadata WHERE path = ? OR (path > ? AND path < ?)",
+                    (new,) + sqlite_db.subtree_bounds(new),
+                )
+                conn.execute("UPDATE metadata SET path = ? WHERE path = ?", (new, old))
+                conn.execute(
+                    "UPDATE metadata SET path = ? || substr(path, ?) WHERE path > ? AND path < ?",
+                    (new, len(old) + 1) + sqlite_db.subtree_bounds(old),
+                )
+        finally:
+            conn.close()
+
+
+_STORES = {"sidecar": SidecarStore, "sqlite": SQLiteStore}
+
+_store = SidecarStore()
+
+
+def configure(name: str = "sidecar"):
+    """
+    Choose the store, either 'sidecar' or 'sqlite'.
+    """
+    global _store
+    if name not in _STORES:
+        raise ValueError(f"Unknown METADATA_STORE {name}")
+    if type(_store) is not _STORES[name]:
+        _store = _STORES[name]()
+
+
+def get_store():
+    """
+    Get the configured store.
+    """
+    return _store
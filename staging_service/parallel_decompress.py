@@ -0,0 +1,333 @@
+"""
+Parallel decompression of gzip and bzip2 files.
+
+A gzip or bzip2 stream is decompressed on a single core, but many large files are made of
+independent pieces that can be decompressed separately:
+
+- BGZF files, such as BAM files and fastq.gz files compressed with bgzip, are a series of gzip
+  members of at most 64 KiB, each of which records its own size in its header.
+- Files compressed with pbzip2 are a series of complete bzip2 streams of about 900 KB, each of
+  which starts with a byte aligned header.
+
+For these the file is read sequentially and split into groups of members, which are
+decompressed by a pool of threads. zlib and bz2 release the GIL while they decompress, so the
+groups are decompressed on as many cores as there are threads. The output is returned in order
+and at most two groups per thread are held at once, so memory use doesn't depend on the size of
+the file.
+
+Other gzip and bzip2 files are decompressed by pigz or lbzip2 if they are installed. lbzip2
+decompresses the blocks of a single bzip2 stream in parallel, which can't be done here as they
+aren't byte aligned, while pigz reads, decompresses, checks and writes on separate threads.
+
+The functions here block and should be run off the event loop.
+"""
+import bz2
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+
+from .decompress_jobs import Progress
+
+COMPRESSIONS = ("gz", "bz2")
+
+_READ_SIZE = 1024 * 1024
+# members are decompressed in groups of about this many compressed bytes
+_GROUP_SIZE = 1024 * 1024
+# enough of the start of a file to tell whether it can be split
+_PROBE_SIZE = 4 * 1024 * 1024
+# a bzip2 stream longer than this wasn't written by pbzip2, so the rest of the file is
+# decompressed sequentially rather than held in memory
+_MAX_BZ2_STREAM = 64 * 1024 * 1024
+
+_GZIP_FEXTRA_MAGIC = b"\x1f\x8b\x08\x04"
+_BZ2_BLOCK_MAGIC = b"1AY&SY"
+
+# compression -> parallel decompressor and the flag that sets its number of threads
+_COMMANDS = {
+    "gz": ("pigz", "-p"),
+    "bz2": ("lbzip2", "-n"),
+}
+
+
+def _bgzf_block_size(header: bytes) -> Optional[int]:
+    # the BC extra subfield holds the size of the block less one
+    if len(header) < 12 or header[:4] != _GZIP_FEXTRA_MAGIC:
+        return None
+    xlen = int.from_bytes(header[10:12], "little")
+    extra = header[12:12 + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = int.from_bytes(extra[pos + 2:pos + 4], "little")
+        if extra[pos:pos + 2] == b"BC" and slen == 2 and pos + 6 <= len(extra):
+            return int.from_bytes(extra[pos + 4:pos + 6], "little") + 1
+        pos += 4 + slen
+    return None
+
+
+def _is_bz2_stream_start(data, start: int) -> bool:
+    return (
+        data[start:start + 3] == b"BZh"
+        and 0x31 <= data[start + 3] <= 0x39
+        and data[start + 4:start + 10] == _BZ2_BLOCK_MAGIC
+    )
+
+
+def _last_bz2_stream_start(data, lo: int = 0) -> int:
+    """
+    Find the start of the last bzip2 stream in data, other than one at the very start, that
+    begins at or after lo. Returns 0 if there is none.
+    """
+    end = len(data)
+    lo = max(lo, 1) + 4
+    while True:
+        i = data.rfind(_BZ2_BLOCK_MAGIC, lo, end)
+        if i < 0:
+            return 0
+        if _is_bz2_stream_start(data, i - 4):
+            return i - 4
+        end = i + len(_BZ2_BLOCK_MAGIC) - 1
+
+
+def splittable(fd: int, compression: str) -> bool:
+    """
+    Determine whether a file is made of independent members that can be decompressed in
+    parallel in process.
+    :param fd: the file descriptor of the file. Its position is not changed.
+    :param compression: the compression of the file, one of COMPRESSIONS.
+    """
+    head = os.pread(fd, _PROBE_SIZE, 0)
+    if compression == "gz":
+        return _bgzf_block_size(head) is not None
+    if compression == "bz2":
+        return _is_bz2_stream_start(head, 0) and _last_bz2_stream_start(head) > 0
+    return False
+
+
+class _Prefixed(io.RawIOBase):
+    """
+    A reader that returns some bytes that have already been read from a file followed by the
+    rest of the file.
+    """
+
+    def __init__(self, prefix: bytes, f):
+        self._prefix = memoryview(prefix)
+        self._f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._prefix:
+            count = min(len(b), len(self._prefix))
+            b[:count] = self._prefix[:count]
+            self._prefix = self._prefix[count:]
+            return count
+        return self._f.readinto(b)
+
+
+def _bgzf_groups(reader) -> Iterator[List[bytes]]:
+    # returns the bytes read of a member that isn't a BGZF block, if there is one
+    group = []
+    size = 0
+    while True:
+        header = reader.read(12)
+        if len(header) == 12 and header[:4] == _GZIP_FEXTRA_MAGIC:
+            header += reader.read(int.from_bytes(header[10:12], "little"))
+        block_size = _bgzf_block_size(header)
+        if block_size is None or block_size < len(header):
+            if group:
+                yield group
+            return header
+        block = header + reader.read(block_size - len(header))
+        if len(block) < block_size:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        group.append(block)
+        size += block_size
+        if size >= _GROUP_SIZE:
+            yield group
+            group = []
+            size = 0
+
+
+def _decompress_bgzf(group: List[bytes]) -> bytes:
+    # wbits=31 reads the gzip header and checks the CRC and size in the trailer of each block
+    return b"".join(zlib.decompress(block, 31) for block in group)
+
+
+def _bz2_groups(reader) -> Iterator[bytes]:
+    # returns the bytes read of a stream that is too long to hold in memory, if there is one
+    buffer = bytearray()
+    scanned = 0
+    while True:
+        data = reader.read(_GROUP_SIZE)
+        if not data:
+            if buffer:
+                yield bytes(buffer)
+            return b""
+        buffer += data
+        # a stream is known to be complete once the start of the next one has been read
+        end = _last_bz2_stream_start(buffer, max(scanned - len(_BZ2_BLOCK_MAGIC) - 4, 0))
+        if end:
+            yield bytes(buffer[:end])
+            del buffer[:end]
+        elif len(buffer) > _MAX_BZ2_STREAM:
+            return bytes(buffer)
+        scanned = len(buffer)
+
+
+def _decompress_bz2(group: bytes) -> bytes:
+    try:
+        return bz2.decompress(group)
+    except ValueError as e:  # the group ended part way through a stream
+        raise EOFError(str(e)) from e
+
+
+# compression -> splitter, group decompressor, sequential decompressor for the rest of a file
+_SPLITTERS = {
+    "gz": (_bgzf_groups, _decompress_bgzf, lambda f: gzip.GzipFile(fileobj=f)),
+    "bz2": (_bz2_groups, _decompress_bz2, bz2.BZ2File),
+}
+
+
+def _decompressed_chunks(reader, compression: str, threads: int) -> Iterator[bytes]:
+    split, decompress, sequential = _SPLITTERS[compression]
+    pool = ThreadPoolExecutor(threads, thread_name_prefix="decompress-part")
+    try:
+        pending = deque()
+        groups = split(reader)
+        while True:
+            try:
+                group = next(groups)
+            except StopIteration as stop:
+                rest = stop.value
+                break
+            pending.append(pool.submit(decompress, group))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    if rest:
+        # the rest of the file can't be split, e.g. a plain gzip file appended to a BGZF file
+        with sequential(io.BufferedReader(_Prefixed(rest, reader), _READ_SIZE)) as rest_reader:
+            while True:
+                chunk = rest_reader.read(_READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A reader over an iterator of chunks of bytes.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        count = min(len(b), len(self._chunk))
+        b[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+    def close(self):
+        # stops the decompression threads
+        self._chunks.close()
+        super().close()
+
+
+def open_split(reader, compression: str, threads: int) -> io.BufferedReader:
+    """
+    Open a reader that decompresses a file that splittable() accepts on a pool of threads.
+    :param reader: the compressed file, positioned at its start.
+    :param compression: the compression of the file, one of COMPRESSIONS.
+    :param threads: the number of threads that decompress the file.
+    :return: a reader of the decompressed data, which must be closed to stop the threads.
+    """
+    return io.BufferedReader(
+        _ChunkReader(_decompressed_chunks(reader, compression, threads)), _READ_SIZE)
+
+
+def command(compression: str, threads: int) -> Optional[List[str]]:
+    """
+    Get the command line of an installed parallel decompressor that writes the decompressed
+    data of its standard input to its standard output.
+    :param compression: the compression of the file, one of COMPRESSIONS.
+    :param threads: the number of threads the decompressor uses.
+    :return: the command line or None if no parallel decompressor is installed.
+    """
+    name, threads_flag = _COMMANDS[compression]
+    executable = shutil.which(name)
+    if not executable:
+        return None
+    return [executable, "-d", "-c", threads_flag, str(threads)]
+
+
+class _CommandReader(io.RawIOBase):
+    """
+    A reader of the output of a decompressor reading a file. The progress is updated with the
+    position of the decompressor in the file.
+    """
+
+    def __init__(self, command_: List[str], f, progress: Progress):
+        self._name = os.path.basename(command_[0])
+        self._f = f
+        self._progress = progress
+        self._position = f.tell()
+        self._stderr = tempfile.TemporaryFile()
+        # the decompressor reads from the same open file, so its position is shared
+        self._process = subprocess.Popen(
+            command_, stdin=f, stdout=subprocess.PIPE, stderr=self._stderr)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        count = self._process.stdout.readinto(b)
+        position = os.lseek(self._f.fileno(), 0, os.SEEK_CUR)
+        if position > self._position:
+            self._progress.add_bytes(position - self._position)
+            self._position = position
+        if not count and self._process.wait() != 0:
+            self._stderr.seek(0)
+            error = self._stderr.read().decode(errors="replace").strip()
+            raise OSError(f"{self._name} failed: {error}")
+        return count
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._process.stdout.close()
+        self._stderr.close()
+        super().close()
+
+
+def open_command(command_: List[str], f, progress: Progress) -> io.BufferedReader:
+    """
+    Open a reader that decompresses a file with a command from command().
+    :param command_: the command line.
+    :param f: the compressed file, positioned at its start. It must not be read by anything
+        else while the reader is open.
+    :param progress: updated with the bytes of the file read by the command.
+    :return: a reader of the decompressed data, which must be closed to stop the command.
+    """
+    return io.BufferedReader(_CommandReader(command_, f, progress), _READ_SIZE)
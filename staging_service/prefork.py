@@ -0,0 +1,206 @@
+"""
+Serves the app from several worker processes that share a port.
+
+A single process runs every request on one event loop, so a CPU heavy request, such as parsing
+a large Excel file, holds up every other request. In prefork mode a master process starts a
+number of worker processes, each running its own copy of the app on a socket bound to the same
+port with SO_REUSEPORT, and the kernel spreads incoming connections across them.
+
+The master only supervises: a worker that exits unexpectedly is restarted, after a delay that
+grows while workers keep failing soon after they start. On SIGTERM or SIGINT the master asks
+every worker to stop, which lets them finish the requests in progress, and kills any that are
+still running after a timeout. A worker stops itself if the master goes away.
+
+Each worker has its own copy of the in memory state: the token cache, unless the SQLite token
+cache is configured, the file extension mappings, which each worker reloads when the mappings
+file changes, and the decompression job pool. State that must be shared, such as upload
+sessions, decompression job status and slots and the directory index, is kept on disk, so the
+decompression job limits hold across all the workers.
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict
+
+from aiohttp import web
+
+DEFAULT_SHUTDOWN_TIMEOUT_SEC = 60
+# a worker that exits sooner than this after it starts is considered to be failing
+_MIN_HEALTHY_SEC = 10
+_MAX_RESTART_DELAY_SEC = 30
+_BACKLOG = 1024
+_POLL_SEC = 0.2
+
+
+def _listen(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+async def _watch_master(master_pid: int):
+    # if the master is killed the worker is adopted by another process
+    while os.getppid() == master_pid:
+        await asyncio.sleep(1)
+    logging.error("The master process exited, stopping worker")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _run_worker(
+    make_app: Callable[[int], web.Application], index: int, port: int, shutdown_timeout: float
+):
+    master_pid = os.getppid()
+    app = make_app(index)
+
+    async def start_watch_master(app):
+        app["watch_master"] = asyncio.ensure_future(_watch_master(master_pid))
+
+    async def stop_watch_master(app):
+        app["watch_master"].cancel()
+
+    app.on_startup.append(start_watch_master)
+    app.on_cleanup.append(stop_watch_master)
+    logging.info(f"Worker {index} (pid {os.getpid()}) serving on port {port}")
+    web.run_app(app, sock=_listen(port), shutdown_timeout=shutdown_timeout, print=None)
+
+
+class Master:
+    """
+    Starts and supervises the worker processes.
+    """
+
+    def __init__(
+        self,
+        make_app: Callable[[int], web.Application],
+        workers: int,
+        port: int,
+        shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT_SEC,
+    ):
+        """
+        :param make_app: creates the app in a worker process given the index of the worker,
+            from 0 to workers - 1. It is called after the worker process starts, so nothing it
+            creates is shared between processes.
+        :param workers: the number of worker processes.
+        :param port: the port the workers serve on.
+        :param shutdown_timeout: how long the workers have to finish the requests in progress
+            when they are stopped.
+        """
+        if workers < 1:
+            raise ValueError("There must be at least one worker")
+        self._make_app = make_app
+        self._workers = workers
+        self._port = port
+        self._shutdown_timeout = shutdown_timeout
+        # pid -> (worker index, start time)
+        self._children: Dict[int, tuple] = {}
+        self._failures = 0
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # the master's handlers are replaced by the event loop's in the worker
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                _run_worker(self._make_app, index, self._port, self._shutdown_timeout)
+            except BaseException:
+                logging.exception(f"Worker {index} failed")
+                code = 1
+            finally:
+                # never return into the master's code
+                logging.shutdown()
+                os._exit(code)
+        self._children[pid] = (index, time.monotonic())
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _restart_delay(self, started: float) -> float:
+        if time.monotonic() - started >= _MIN_HEALTHY_SEC:
+            self._failures = 0
+            return 0
+        self._failures += 1
+        return min(2 ** (self._failures - 1), _MAX_RESTART_DELAY_SEC)
+
+    def run(self):
+        """
+        Start the workers and supervise them until the master is sent SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logging.info(f"Starting {self._workers} workers on port {self._port}")
+        for index in range(self._workers):
+            self._spawn(index)
+        while not self._stopping:
+            # polled, as a blocking wait is resumed after the signal handlers run
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                time.sleep(_POLL_SEC)
+                continue
+            index, started = self._children.pop(pid)
+            logging.error(
+                f"Worker {index} (pid {pid}) exited with status "
+                + f"{os.waitstatus_to_exitcode(status)}, restarting"
+            )
+            restart_at = time.monotonic() + self._restart_delay(started)
+            while not self._stopping and time.monotonic() < restart_at:
+                time.sleep(_POLL_SEC)
+            if not self._stopping:
+                self._spawn(index)
+        self._shutdown()
+
+    def _shutdown(self):
+        logging.info("Stopping workers")
+        for pid in self._children:
+            _kill(pid, signal.SIGTERM)
+        # allow for the workers' own shutdown timeout and their cleanup
+        deadline = time.monotonic() + self._shutdown_timeout + 5
+        while self._children and time.monotonic() < deadline:
+            for pid in list(self._children):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    del self._children[pid]
+            time.sleep(_POLL_SEC)
+        for pid in self._children:
+            logging.error(f"Worker pid {pid} didn't stop in time, killing it")
+            _kill(pid, signal.SIGKILL)
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._children.clear()
+
+
+def _kill(pid: int, signum: int):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def serve(
+    make_app: Callable[[int], web.Application],
+    workers: int,
+    port: int,
+    shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT_SEC,
+):
+    """
+    Serve the app, from a single process if there is one worker and from supervised worker
+    processes otherwise. See Master for the parameters.
+    """
+    if workers == 1:
+        web.run_app(make_app(0), port=port, shutdown_timeout=shutdown_timeout)
+    else:
+        Master(make_app, workers, port, shutdown_timeout).run()
@@ -0,0 +1,45 @@
+"""
+Coalesces concurrent calls for the same key into a single call.
+
+When a page loads, the browser sends a burst of requests with the same token at once. Without
+coalescing, each of them would miss the token cache and call the auth service. With it, the
+first request makes the call and the others wait for its result.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Runs at most one call at a time for each key. A call made while another call for the same
+    key is in progress waits for that call and gets its result or exception, so results should
+    not be objects that can only be used once.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self) -> int:
+        """
+        Get the number of calls in progress.
+        """
+        return len(self._calls)
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable], *args) -> Any:
+        """
+        Run func(*args), or wait for the call in progress for the key.
+        """
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func(*args))
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._done(key, f))
+        # a caller that is cancelled doesn't cancel the call for the others
+        return await asyncio.shield(fut)
+
+    def _done(self, key: Hashable, fut: asyncio.Future):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            # retrieved so it isn't reported as unhandled if every caller was cancelled
+            fut.exception()
@@ -0,0 +1,61 @@
+"""
+Helpers for the per user SQLite databases under META_DIR, the directory index and the SQLite
+metadata store, which both key their rows by user path.
+
+All of the functions here block and should be run off the event loop.
+"""
+import contextlib
+import os
+import sqlite3
+
+
+def connect(db_path: str, schema: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Open a database, creating it with its schema if needed. The database is in WAL mode so
+    reads aren't blocked by writes, and in autocommit mode, so writes should be made with
+    transaction().
+    :param db_path: the path of the database file.
+    :param schema: statements that create the tables and indexes if they don't exist.
+    :param check_same_thread: whether the connection can only be used by the thread that
+        opened it.
+    """
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(
+        db_path, timeout=60, isolation_level=None, check_same_thread=check_same_thread)
+    # checked on every connection, as the database may have been removed since the last one
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(schema)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn: sqlite3.Connection):
+    """
+    Run the statements in the block in a transaction, which is rolled back if the block raises.
+    """
+    # the write lock is taken up front so the transaction can't fail part way through on a
+    # lock held by another connection
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def normalize(user_path: str) -> str:
+    """
+    Get the key of a user path, without a trailing '/'.
+    """
+    return user_path.rstrip("/")
+
+
+def subtree_bounds(user_path: str):
+    """
+    Get the bounds of the keys of every path below a user path, exclusive, for a
+    'path > ? AND path < ?' range query.
+    """
+    # '0' is the character after '/', so this range covers every path below user_path
+    return user_path + "/", user_path + "0"
@@ -0,0 +1,400 @@
+"""
+Server side state for resumable uploads.
+
+A session is created for a file before any of its data is sent. The data is appended to a
+hidden temporary file beside the destination and the current offset is the size of that file,
+so after a dropped connection a client can ask where to resume. When the last byte arrives the
+temporary file is renamed over the destination.
+
+Session state is kept in a small JSON file under META_DIR so that any server process can
+continue an upload. Sessions that have seen no activity for longer than a time to live are
+removed along with their temporary files.
+
+A multipart session instead has a fixed part size and its temporary file is preallocated to the
+full size of the file. Each numbered part is written at its own position in the file, so parts
+can be sent concurrently, and a record of the part's digest is saved once it is written. The
+upload is completed once every part has been received.
+
+The functions here block and should be run off the event loop.
+"""
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+
+from .utils import Path
+
+_SESSION_DIR = ".upload_sessions"
+_SESSION_ID_REGEX = re.compile("^[0-9a-f]{32}$")
+_PARTS_SUFFIX = ".parts"
+
+MIN_PART_SIZE = 64 * 1024
+MAX_PARTS = 10000
+
+
+class UploadSessionException(Exception):
+    """
+    The base class for upload session errors.
+    """
+
+
+class OffsetMismatchException(UploadSessionException):
+    """
+    Thrown when data is sent for an offset other than the current offset of the upload.
+    """
+
+    def __init__(self, offset: int):
+        super().__init__(f"The current upload offset is {offset}")
+        self.offset = offset
+
+
+class SessionBusyException(UploadSessionException):
+    """
+    Thrown when another request is already writing to the upload.
+    """
+
+    def __init__(self):
+        super().__init__("Another request is currently writing to this upload")
+
+
+class SessionNotFoundException(UploadSessionException):
+    """
+    Thrown when an upload is completed or removed before its temporary file could be locked.
+    """
+
+    def __init__(self):
+        super().__init__("The upload has been completed or removed")
+
+
+class MissingPartsException(UploadSessionException):
+    """
+    Thrown when a multipart upload is completed before all of its parts have been received.
+    """
+
+    def __init__(self, missing: List[int]):
+        shown = ", ".join(str(p) for p in missing[:10]) + (", ..." if len(missing) > 10 else "")
+        super().__init__(f"Missing parts: {shown}")
+        self.missing = missing
+
+
+@dataclass(frozen=True)
+class UploadSession:
+    """
+    A resumable upload.
+
+    session_id - the ID of the session.
+    username - the user that owns the session.
+    user_path - the path of the destination file, starting with the username.
+    size - the total size of the file in bytes.
+    created - when the session was created in seconds since the epoch.
+    part_size - the size of each part of a multipart upload, other than the last, which may be
+        smaller. None for an upload that is sent in order.
+    """
+    session_id: str
+    username: str
+    user_path: str
+    size: int
+    created: float
+    part_size: Optional[int] = None
+
+    @property
+    def part_count(self) -> int:
+        return -(-self.size // self.part_size)
+
+    def part_range(self, part_number: int) -> Tuple[int, int]:
+        """
+        Get the offset and length of a part of a multipart upload. Parts are numbered from 1.
+        """
+        if part_number < 1 or part_number > self.part_count:
+            raise ValueError(f"Part number must be between 1 and {self.part_count}")
+        offset = (part_number - 1) * self.part_size
+        return offset, min(self.part_size, self.size - offset)
+
+    @property
+    def path(self) -> Path:
+        return Path.from_full_path(os.path.join(Path._DATA_DIR, self.user_path))
+
+    @property
+    def temp_path(self) -> str:
+        full_path = self.path.full_path
+        return os.path.join(
+            os.path.dirname(full_path),
+            f".{os.path.basename(full_path)}.{self.session_id}.part",
+        )
+
+
+def _session_dir() -> str:
+    return os.path.join(Path._META_DIR, _SESSION_DIR)
+
+
+def _state_path(session_id: str) -> str:
+    return os.path.join(_session_dir(), session_id + ".json")
+
+
+def _parts_dir(session_id: str) -> str:
+    return os.path.join(_session_dir(), session_id + _PARTS_SUFFIX)
+
+
+def _part_path(session_id: str, part_number: int) -> str:
+    return os.path.join(_parts_dir(session_id), f"{part_number}.json")
+
+
+def create_session(
+    username: str, path: Path, size: int, part_size: Optional[int] = None
+) -> UploadSession:
+    """
+    Create a new upload session and its temporary file.
+    :param username: the user uploading the file.
+    :param path: the destination of the file.
+    :param size: the size of the file in bytes.
+    :param part_size: the size of the parts of a multipart upload. If provided the temporary
+        file is preallocated to the size of the file.
+    """
+    if part_size is not None:
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"The part size must be at least {MIN_PART_SIZE} bytes")
+        if -(-size // part_size) > MAX_PARTS:
+            raise ValueError(f"An upload may have at most {MAX_PARTS} parts")
+    session = UploadSession(
+        uuid.uuid4().hex, username, path.user_path, size, time.time(), part_size)
+    os.makedirs(_session_dir(), exist_ok=True)
+    os.makedirs(os.path.dirname(path.full_path), exist_ok=True)
+    with open(session.temp_path, "wb") as f:
+        if part_size is not None:
+            _preallocate(f.fileno(), size)
+    if part_size is not None:
+        os.makedirs(_parts_dir(session.session_id))
+    with open(_state_path(session.session_id), "w") as f:
+        json.dump(asdict(session), f)
+    return session
+
+
+def get_session(session_id: str, username: str, ttl: float) -> Optional[UploadSession]:
+    """
+    Get an upload session.
+    :param session_id: the ID of the session.
+    :param username: the user requesting the session. Sessions belonging to other users are
+        treated as missing.
+    :param ttl: the time to live of the session in seconds. Expired sessions are removed and
+        treated as missing.
+    :return: the session or None if there is no such session.
+    """
+    if not _SESSION_ID_REGEX.match(session_id):
+        return None
+    try:
+        with open(_state_path(session_id)) as f:
+            session = UploadSession(**json.load(f))
+    except FileNotFoundError:
+        return None
+    if session.username != username:
+        return None
+    if _expired(session, ttl):
+        delete_session(session)
+        return None
+    return session
+
+
+def get_offset(session: UploadSession) -> int:
+    """
+    Get the number of bytes of the file that have been received.
+    """
+    return os.stat(session.temp_path).st_size
+
+
+def _open_locked(session: UploadSession, mode: str, operation: int):
+    try:
+        f = open(session.temp_path, mode)
+    except FileNotFoundError:
+        raise SessionNotFoundException()
+    try:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise SessionBusyException()
+        # the upload may have been completed, and the file moved to the destination, or
+        # removed between opening the file and locking it
+        try:
+            current = os.stat(session.temp_path)
+        except FileNotFoundError:
+            raise SessionNotFoundException()
+        opened = os.fstat(f.fileno())
+        if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            raise SessionNotFoundException()
+        return f
+    except BaseException:
+        f.close()
+        raise
+
+
+def open_for_append(session: UploadSession, offset: int):
+    """
+    Open the temporary file of an upload to write data at an offset. The file is locked until
+    it is closed, so the upload should be completed before the file is closed.
+    :param session: the upload session.
+    :param offset: the offset that the client is sending data for, which must be the current
+        offset of the upload.
+    :return: a binary file object positioned at the offset.
+    :raises SessionBusyException: if another request is writing to the upload.
+    :raises SessionNotFoundException: if the upload has been completed or removed.
+    """
+    f = _open_locked(session, "r+b", fcntl.LOCK_EX)
+    try:
+        current = os.fstat(f.fileno()).st_size
+        if current != offset:
+            raise OffsetMismatchException(current)
+        f.seek(offset)
+        return f
+    except BaseException:
+        f.close()
+        raise
+
+
+def _preallocate(fd: int, size: int):
+    os.ftruncate(fd, size)
+    try:
+        # reserve the blocks up front so the parts don't fragment the file or run out of space
+        # part way through the upload
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        pass  # not supported on this platform or file system, the file is sparse instead
+
+
+def open_part(session: UploadSession, part_number: int):
+    """
+    Open the temporary file of a multipart upload to write a part. Any number of parts may be
+    written at once, but not while the upload is being completed.
+    :param session: the upload session.
+    :param part_number: the number of the part, starting from 1.
+    :return: a binary file object. Write the part at its offset with os.pwrite.
+    :raises SessionBusyException: if the upload is being completed.
+    :raises SessionNotFoundException: if the upload has been completed or removed.
+    """
+    session.part_range(part_number)
+    return _open_locked(session, "r+b", fcntl.LOCK_SH)
+
+
+def save_part(session: UploadSession, part_number: int, part: dict):
+    """
+    Record that a part of a multipart upload has been written.
+    :param session: the upload session.
+    :param part_number: the number of the part.
+    :param part: the digest of the part. It must contain the part's size.
+    """
+    path = _part_path(session.session_id, part_number)
+    # write then rename so a concurrent reader never sees a partial record
+    temp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp, "w") as f:
+        json.dump(part, f)
+    os.replace(temp, path)
+
+
+def get_parts(session: UploadSession) -> Dict[int, dict]:
+    """
+    Get the records of the parts of a multipart upload that have been written, keyed by part
+    number.
+    """
+    parts = {}
+    try:
+        names = os.listdir(_parts_dir(session.session_id))
+    except FileNotFoundError:
+        return parts
+    for name in names:
+        number = name[: -len(".json")]
+        if not name.endswith(".json") or not number.isdigit():
+            continue
+        try:
+            with open(os.path.join(_parts_dir(session.session_id), name)) as f:
+                parts[int(number)] = json.load(f)
+        except FileNotFoundError:
+            pass  # the session was completed or deleted
+    return parts
+
+
+def lock_for_completion(session: UploadSession) -> Tuple[object, List[dict]]:
+    """
+    Lock a multipart upload so no more parts can be written, and check that all of its parts
+    have been received.
+    :param session: the upload session.
+    :return: the locked temporary file, which must be closed once the upload is completed,
+        and the part records in order.
+    :raises SessionBusyException: if parts are being written or the upload is being completed.
+    :raises SessionNotFoundException: if the upload has been completed or removed.
+    """
+    f = _open_locked(session, "rb", fcntl.LOCK_EX)
+    try:
+        parts = get_parts(session)
+        missing = [n for n in range(1, session.part_count + 1) if n not in parts]
+        if missing:
+            raise MissingPartsException(missing)
+        return f, [parts[n] for n in range(1, session.part_count + 1)]
+    except BaseException:
+        f.close()
+        raise
+
+
+def complete_session(session: UploadSession):
+    """
+    Move a fully received file to its destination and remove the session.
+    """
+    os.replace(session.temp_path, session.path.full_path)
+    _remove_state(session.session_id)
+
+
+def delete_session(session: UploadSession):
+    """
+    Remove a session and its temporary file.
+    """
+    try:
+        os.remove(session.temp_path)
+    except FileNotFoundError:
+        pass
+    _remove_state(session.session_id)
+
+
+def remove_expired_sessions(ttl: float) -> int:
+    """
+    Remove all sessions that have seen no activity for longer than the time to live.
+    :param ttl: the time to live of a session in seconds.
+    :return: the number of sessions removed.
+    """
+    try:
+        names = os.listdir(_session_dir())
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        session_id = name[: -len(".json")]
+        try:
+            with open(_state_path(session_id)) as f:
+                session = UploadSession(**json.load(f))
+        except (FileNotFoundError, ValueError, TypeError):
+            # another process is removing or writing the session
+            continue
+        if _expired(session, ttl):
+            delete_session(session)
+            removed += 1
+    return removed
+
+
+def _expired(session: UploadSession, ttl: float) -> bool:
+    # appending to the temporary file updates its mtime, so it records the last activity
+    try:
+        last_activity = max(session.created, os.stat(session.temp_path).st_mtime)
+    except FileNotFoundError:
+        last_activity = session.created
+    return time.time() - last_activity > ttl
+
+
+def _remove_state(session_id: str):
+    try:
+        os.remove(_state_path(session_id))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(_parts_dir(session_id), ignore_errors=True)
@@ -1,4 +1,5 @@
 import asyncio
+import atexit
 import configparser
 import hashlib
 import openpyxl
@@ -6,7 +7,10 @@ import os
 import pandas
 import shutil
 import string
+import tarfile
+import tempfile
 import time
+import zipfile
 from json import JSONDecoder
 from pathlib import Path
 from urllib.parse import urlencode,unquote
@@ -34,6 +38,13 @@ decoder = JSONDecoder()
 
 config = configparser.ConfigParser()
 config.read(os.environ["KB_DEPLOYMENT_CONFIG"])
+# the service's files, including the directory index and the upload and job state, are written
+# to a temporary directory rather than the repo's data directory
+_TEST_DIR = tempfile.mkdtemp(prefix="staging_service_test_")
+atexit.register(shutil.rmtree, _TEST_DIR, ignore_errors=True)
+config["staging_service"]["DATA_DIR"] = os.path.join(_TEST_DIR, "bulk")
+config["staging_service"]["META_DIR"] = os.path.join(_TEST_DIR, "metadata")
+config["staging_service"]["DECOMPRESS_SLOT_DIR"] = os.path.join(_TEST_DIR, "slots")
 
 DATA_DIR = config["staging_service"]["DATA_DIR"]
 META_DIR = config["staging_service"]["META_DIR"]
@@ -101,10 +112,13 @@ class FileUtil:
         os.makedirs(self.base_dir, exist_ok=True)
         shutil.rmtree(self.base_dir)
         os.makedirs(self.base_dir, exist_ok=False)
+        # the users' files are removed behind the service's back
+        globus._known_users.clear()
         return self
 
     def __exit__(self, *args):
         shutil.rmtree(self.base_dir)
+        globus._known_users.clear()
 
     def make_file(self, path, contents):
         path = os.path.join(self.base_dir, path)
@@ -215,6 +229,23 @@ async def test_service():
         assert "staging service version" in text
 
 
+async def test_blocking_io_stats():
+    async with AppClient(config) as cli:
+        resp = await cli.get("/blocking-io-stats", headers={"Authorization": ""})
+        assert resp.status == 200
+        stats = await resp.json()
+        assert set(stats.keys()) == {"threads", "active", "queued", "max_queued", "completed"}
+        assert stats["threads"] > 0
+
+
+async def test_token_cache_stats():
+    async with AppClient(config) as cli:
+        resp = await cli.get("/token-cache-stats", headers={"Authorization": ""})
+        assert resp.status == 200
+        stats = await resp.json()
+        assert set(stats.keys()) == {"size", "hits", "misses", "evictions"}
+
+
 async def test_jbi_metadata():
     txt = "testing text\n"
     username = "testuser"
@@ -654,6 +685,171 @@ async def test_download(txt):
             assert result_text == txt.encode()
 
 
+async def test_download_conditional():
+    username = "testuser"
+    txt = "testing text\n"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "test"))
+            fs.make_file(os.path.join(username, "test", "test_file_1"), txt)
+            url = os.path.join("download", "test", "test_file_1")
+
+            res = await cli.get(url, headers={"Authorization": ""})
+            assert res.status == 200
+            assert res.headers["Accept-Ranges"] == "bytes"
+            mtime_etag = res.headers["ETag"]
+            last_modified = res.headers["Last-Modified"]
+
+            for headers in [
+                {"If-None-Match": mtime_etag},
+                {"If-None-Match": '"other", W/' + mtime_etag},
+                {"If-None-Match": "*"},
+                {"If-Modified-Since": last_modified},
+            ]:
+                res = await cli.get(url, headers={"Authorization": "", **headers})
+                assert res.status == 304
+                assert res.headers["ETag"] == mtime_etag
+                assert await res.read() == b""
+
+            for headers in [
+                {"If-None-Match": '"other"'},
+                {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+                # If-None-Match takes precedence
+                {"If-None-Match": '"other"', "If-Modified-Since": last_modified},
+            ]:
+                res = await cli.get(url, headers={"Authorization": "", **headers})
+                assert res.status == 200
+                assert await res.text() == txt
+
+            # generating the metadata doesn't change the ETag, so a resumed download still
+            # matches
+            res = await cli.get(
+                os.path.join("metadata", "test", "test_file_1"), headers={"Authorization": ""}
+            )
+            assert res.status == 200
+            res = await cli.get(
+                url, headers={"Authorization": "", "Range": "bytes=2-", "If-Range": mtime_etag})
+            assert res.status == 206
+            assert res.headers["ETag"] == mtime_etag
+            assert await res.text() == txt[2:]
+
+
+async def test_download_ranges():
+    username = "testuser"
+    txt = "0123456789" * 10
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "test"))
+            fs.make_file(os.path.join(username, "test", "test_file_1"), txt)
+            url = os.path.join("download", "test", "test_file_1")
+
+            for range_, expected, content_range in [
+                ("bytes=10-19", txt[10:20], "bytes 10-19/100"),
+                ("bytes=95-", txt[95:], "bytes 95-99/100"),
+                ("bytes=-5", txt[95:], "bytes 95-99/100"),
+                ("bytes=90-1000", txt[90:], "bytes 90-99/100"),
+            ]:
+                res = await cli.get(url, headers={"Authorization": "", "Range": range_})
+                assert res.status == 206
+                assert res.headers["Content-Range"] == content_range
+                assert res.headers["Content-Type"] == "application/octet-stream"
+                assert await res.text() == expected
+
+            res = await cli.get(url, headers={"Authorization": "", "Range": "bytes=0-1,50-52"})
+            assert res.status == 206
+            ctype, boundary = res.headers["Content-Type"].split("; boundary=")
+            assert ctype == "multipart/byteranges"
+            body = await res.read()
+            assert len(body) == int(res.headers["Content-Length"])
+            assert body.decode() == (
+                f"--{boundary}\r\n"
+                + "Content-Type: application/octet-stream\r\n"
+                + "Content-Range: bytes 0-1/100\r\n\r\n"
+                + "01\r\n"
+                + f"--{boundary}\r\n"
+                + "Content-Type: application/octet-stream\r\n"
+                + "Content-Range: bytes 50-52/100\r\n\r\n"
+                + "012\r\n"
+                + f"--{boundary}--\r\n"
+            )
+
+            res = await cli.get(url, headers={"Authorization": "", "Range": "bytes=100-"})
+            assert res.status == 416
+            assert res.headers["Content-Range"] == "bytes */100"
+
+            res = await cli.head(url, headers={"Authorization": "", "Range": "bytes=0-9"})
+            assert res.status == 206
+            assert res.headers["Content-Length"] == "10"
+
+            # invalid ranges are ignored
+            res = await cli.get(url, headers={"Authorization": "", "Range": "bytes=5-1"})
+            assert res.status == 200
+            assert await res.text() == txt
+
+            res = await cli.get(url, headers={"Authorization": ""})
+            etag = res.headers["ETag"]
+            res = await cli.get(
+                url, headers={"Authorization": "", "Range": "bytes=10-19", "If-Range": etag}
+            )
+            assert res.status == 206
+            assert await res.text() == txt[10:20]
+            # the file changed since the client started downloading it
+            res = await cli.get(
+                url, headers={"Authorization": "", "Range": "bytes=10-19", "If-Range": '"old"'}
+            )
+            assert res.status == 200
+            assert await res.text() == txt
+
+
+async def test_download_archive():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "test", "sub"))
+            fs.make_file(os.path.join(username, "test", "a.txt"), "aaa")
+            fs.make_file(os.path.join(username, "test", ".hidden"), "hhh")
+            fs.make_file(os.path.join(username, "test", "sub", "b.txt"), "b" * 300000)
+            fs.make_file(os.path.join(username, "c.txt"), "ccc")
+
+            res = await cli.get("download-archive/test", headers={"Authorization": ""})
+            assert res.status == 200
+            assert res.headers["Content-Type"] == "application/zip"
+            assert res.headers["Content-Disposition"] == 'attachment; filename="test.zip"'
+            with zipfile.ZipFile(BytesIO(await res.read())) as zf:
+                assert zf.namelist() == ["test/", "test/a.txt", "test/sub/", "test/sub/b.txt"]
+                assert zf.read("test/sub/b.txt") == b"b" * 300000
+
+            res = await cli.get(
+                "download-archive/test?format=tar.gz&showHidden=true&files=.hidden,sub,a.txt",
+                headers={"Authorization": ""},
+            )
+            assert res.status == 200
+            assert res.headers["Content-Type"] == "application/gzip"
+            with tarfile.open(fileobj=BytesIO(await res.read()), mode="r:gz") as tf:
+                assert tf.getnames() == [".hidden", "sub", "sub/b.txt", "a.txt"]
+                assert tf.extractfile("a.txt").read() == b"aaa"
+
+            res = await cli.get(
+                "download-archive/?format=tar&files=c.txt", headers={"Authorization": ""})
+            assert res.status == 200
+            assert res.headers["Content-Disposition"] == 'attachment; filename="testuser.tar"'
+            with tarfile.open(fileobj=BytesIO(await res.read())) as tf:
+                assert tf.getnames() == ["c.txt"]
+
+            for url, status, err in [
+                ("download-archive/test?format=rar", 400,
+                 "format must be one of zip, tar, tar.gz"),
+                ("download-archive/test?files=../c.txt", 400,
+                 "../c.txt is not within testuser/test"),
+                ("download-archive/test?files=nope", 404,
+                 "path testuser/test/nope does not exist"),
+                ("download-archive/nope", 404, "path testuser/nope does not exist"),
+            ]:
+                res = await cli.get(url, headers={"Authorization": ""})
+                assert res.status == status
+                assert await res.text() == err
+
+
 async def test_download_errors():
     username = "testuser"
     async with AppClient(config, username) as cli:
@@ -801,6 +997,150 @@ async def test_search():
             assert len(json) == 2
 
 
+async def _pages(cli, url, limit):
+    pages = []
+    cursor = None
+    while True:
+        params = {"limit": str(limit)}
+        if cursor:
+            params["cursor"] = cursor
+        res = await cli.get(url, params=params, headers={"Authorization": ""})
+        assert res.status == 200
+        pages.append([e["path"] for e in await res.json()])
+        cursor = res.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pages
+
+
+async def test_list_and_search_pages():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "a", "b"))
+            for i, name in enumerate(["a/1", "a/b/2", "a/b/3", "c", "d"]):
+                f = fs.make_file(os.path.join(username, name), name)
+                os.utime(f, (1000 + i, 1000 + i))
+            os.utime(os.path.join(DATA_DIR, username, "a", "b"), (900, 900))
+            os.utime(os.path.join(DATA_DIR, username, "a"), (900, 900))
+            res = await cli.get("list/", headers={"Authorization": ""})
+            paths = [e["path"] for e in await res.json()]
+            assert paths == [
+                f"{username}/{p}" for p in ["a", "a/1", "a/b", "a/b/2", "a/b/3", "c", "d"]]
+            assert "X-Next-Cursor" not in res.headers
+
+            assert sum(await _pages(cli, "list/", 3), []) == paths
+            assert [len(p) for p in await _pages(cli, "list/", 3)] == [3, 3, 1]
+
+            res = await cli.get("list/", params={"depth": "1"}, headers={"Authorization": ""})
+            assert [e["path"] for e in await res.json()] == [
+                f"{username}/{p}" for p in ["a", "c", "d"]]
+            res = await cli.get("list/a", params={"depth": "1", "sort": "mtime"},
+                                headers={"Authorization": ""})
+            assert [e["path"] for e in await res.json()] == [
+                f"{username}/{p}" for p in ["a/1", "a/b"]]
+
+            # search is newest first, and entries modified at the same time are in path order
+            newest = [f"{username}/{p}" for p in ["d", "c", "a/b/3", "a/b/2", "a/1", "a", "a/b"]]
+            res = await cli.get("search/", headers={"Authorization": ""})
+            assert [e["path"] for e in await res.json()] == newest
+            assert await _pages(cli, "search/", 2) == [
+                newest[0:2], newest[2:4], newest[4:6], newest[6:]]
+            res = await cli.get("search/", params={"sort": "path"}, headers={"Authorization": ""})
+            assert [e["path"] for e in await res.json()] == paths
+
+            # a cursor carries on after the last entry of its page even if that entry is removed
+            res = await cli.get("search/", params={"limit": "2"}, headers={"Authorization": ""})
+            os.remove(os.path.join(DATA_DIR, username, "c"))
+            res = await cli.get(
+                "search/", params={"limit": "2", "cursor": res.headers["X-Next-Cursor"]},
+                headers={"Authorization": ""})
+            assert [e["path"] for e in await res.json()] == newest[2:4]
+
+            list_cursor = (await cli.get(
+                "list/", params={"limit": "1"}, headers={"Authorization": ""}
+            )).headers["X-Next-Cursor"]
+            for params in [
+                {"limit": "0"},
+                {"limit": "x"},
+                {"depth": "-1"},
+                {"sort": "size"},
+                {"cursor": "notacursor"},
+                # a cursor is only valid for the order it came from
+                {"cursor": list_cursor},
+            ]:
+                res = await cli.get("search/", params=params, headers={"Authorization": ""})
+                assert res.status == 400, params
+
+
+async def test_list_and_search_stream():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "a", "b"))
+            for name in ["a/1", "a/b/2", ".hidden", "c"]:
+                fs.make_file(os.path.join(username, name), name)
+            for url, params in [
+                ("list/", {}),
+                ("list/a", {"depth": "1"}),
+                ("list/", {"showHidden": "true", "sort": "mtime"}),
+                ("search/", {}),
+                ("search/b", {}),
+                ("search/nomatch", {}),
+            ]:
+                res = await cli.get(url, params=params, headers={"Authorization": ""})
+                expected = await res.json()
+                res = await cli.get(
+                    url, params=dict(params, stream="json"), headers={"Authorization": ""})
+                assert res.status == 200
+                assert res.headers["Content-Type"] == "application/json"
+                assert await res.json() == expected, (url, params)
+                res = await cli.get(
+                    url, params=dict(params, stream="ndjson"), headers={"Authorization": ""})
+                assert res.status == 200
+                assert res.headers["Content-Type"] == "application/x-ndjson"
+                lines = (await res.text()).splitlines()
+                assert [decoder.decode(line) for line in lines] == expected, (url, params)
+
+            for params in [{"stream": "csv"}, {"stream": "json", "limit": "2"}]:
+                res = await cli.get("list/", params=params, headers={"Authorization": ""})
+                assert res.status == 400, params
+
+
+async def test_list_default_depth():
+    username = "testuser"
+    config["staging_service"]["LIST_DEFAULT_DEPTH"] = "1"
+    try:
+        async with AppClient(config, username) as cli:
+            with FileUtil() as fs:
+                fs.make_dir(os.path.join(username, "depth", "b"))
+                fs.make_file(os.path.join(username, "depth", "1"), "1")
+                fs.make_file(os.path.join(username, "depth", "b", "2"), "22")
+                fs.make_file(os.path.join(username, "depth", ".3"), "333")
+                fs.make_file(os.path.join(username, "c"), "c")
+                res = await cli.get("list/", params={"depth": "0", "showHidden": "true"},
+                                    headers={"Authorization": ""})
+                json = await res.json()
+                # the .globus_id file is written for the user
+                assert len(json) == 7
+                assert not any("childCount" in e for e in json)
+
+                res = await cli.get("list/", headers={"Authorization": ""})
+                json = await res.json()
+                assert [e["path"] for e in json] == [f"{username}/c", f"{username}/depth"]
+                assert "childCount" not in json[0]
+                assert (json[1]["childCount"], json[1]["totalSize"]) == (2, 3)
+                res = await cli.get(
+                    "list/", params={"showHidden": "true"}, headers={"Authorization": ""})
+                depth = {e["path"]: e for e in await res.json()}[f"{username}/depth"]
+                assert (depth["childCount"], depth["totalSize"]) == (3, 6)
+                # search isn't limited by default
+                res = await cli.get("search/", headers={"Authorization": ""})
+                assert len(await res.json()) == 5
+    finally:
+        del config["staging_service"]["LIST_DEFAULT_DEPTH"]
+        app._list_default_depth = None
+
+
 async def test_upload():
     txt = "testing text\n"
     username = "testuser"
@@ -821,6 +1161,274 @@ async def test_upload():
 
             assert res2.status == 200
 
+            # the metadata is written during the upload
+            with open(os.path.join(META_DIR, username, "test_file_1")) as m:
+                metadata = decoder.decode(m.read())
+            assert metadata == {
+                "source": "KBase upload",
+                "md5": "e9018937ab54e6ce88b9e2dfe5053095",
+                "lineCount": "1",
+                "head": "testing text\n",
+                "tail": "testing text\n",
+            }
+
+
+async def test_upload_session():
+    username = "testuser"
+    txt = b"testing text\n" * 3
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            fs.make_dir(os.path.join(username, "test"))
+            res = await cli.post(
+                "upload-session",
+                headers={"Authorization": ""},
+                json={"destPath": "test", "filename": "resumed", "size": len(txt)},
+            )
+            assert res.status == 201
+            session = await res.json()
+            assert session["path"] == "testuser/test/resumed"
+            assert session["size"] == len(txt)
+            assert session["offset"] == 0
+            url = "upload-session/" + session["session_id"]
+            assert res.headers["Location"] == "/" + url
+
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "0"}, data=txt[:10]
+            )
+            assert res.status == 204
+            assert res.headers["Upload-Offset"] == "10"
+
+            res = await cli.head(url, headers={"Authorization": ""})
+            assert res.status == 200
+            assert res.headers["Upload-Offset"] == "10"
+            assert res.headers["Upload-Length"] == str(len(txt))
+
+            # the partial upload is hidden and the destination doesn't exist yet
+            assert not os.path.exists(os.path.join(DATA_DIR, username, "test", "resumed"))
+            res = await cli.get("list/test", headers={"Authorization": ""})
+            assert await res.json() == []
+
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "5"}, data=txt[5:]
+            )
+            assert res.status == 409
+            assert res.headers["Upload-Offset"] == "10"
+
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "10"}, data=txt[10:] + b"x"
+            )
+            assert res.status == 400
+
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "10"}, data=txt[10:]
+            )
+            assert res.status == 200
+            js = await res.json()
+            assert js[0]["path"] == "testuser/test/resumed"
+            assert js[0]["size"] == len(txt)
+            with open(os.path.join(DATA_DIR, username, "test", "resumed"), "rb") as f:
+                assert f.read() == txt
+            with open(os.path.join(META_DIR, username, "test", "resumed")) as m:
+                metadata = decoder.decode(m.read())
+            assert metadata["source"] == "KBase upload"
+            assert metadata["md5"] == hashlib.md5(txt).hexdigest()
+            assert metadata["lineCount"] == "3"
+            assert os.listdir(os.path.join(DATA_DIR, username, "test")) == ["resumed"]
+
+            res = await cli.head(url, headers={"Authorization": ""})
+            assert res.status == 404
+
+
+async def test_upload_session_delete():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            res = await cli.post(
+                "upload-session",
+                headers={"Authorization": ""},
+                json={"destPath": "/", "filename": "abandoned", "size": 100},
+            )
+            url = "upload-session/" + (await res.json())["session_id"]
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "0"}, data=b"12345"
+            )
+            assert res.status == 204
+            res = await cli.delete(url, headers={"Authorization": ""})
+            assert res.status == 200
+            assert os.listdir(os.path.join(DATA_DIR, username)) == [".globus_id"]
+            res = await cli.head(url, headers={"Authorization": ""})
+            assert res.status == 404
+
+
+async def test_upload_session_gone():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            res = await cli.post(
+                "upload-session",
+                headers={"Authorization": ""},
+                json={"destPath": "/", "filename": "gone", "size": 5},
+            )
+            session_id = (await res.json())["session_id"]
+            url = "upload-session/" + session_id
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "0"}, data=b"12")
+            assert res.status == 204
+            assert session_id in app._upload_session_digests
+            # the upload is completing in another process, which has moved the file into place
+            # but not yet removed the session
+            temp = [n for n in os.listdir(os.path.join(DATA_DIR, username)) if "gone" in n]
+            os.rename(os.path.join(DATA_DIR, username, temp[0]),
+                      os.path.join(DATA_DIR, username, "gone"))
+            res = await cli.patch(
+                url, headers={"Authorization": "", "Upload-Offset": "2"}, data=b"")
+            assert res.status == 404
+            assert session_id not in app._upload_session_digests
+
+
+def test_remove_expired_digests():
+    app._upload_session_digests["old"] = (1, None, time.time() - app._upload_session_ttl_sec - 1)
+    app._upload_session_digests["new"] = (1, None, time.time())
+    try:
+        app._remove_expired_digests()
+        assert "old" not in app._upload_session_digests
+        assert "new" in app._upload_session_digests
+    finally:
+        app._upload_session_digests.pop("old", None)
+        app._upload_session_digests.pop("new", None)
+
+
+async def test_upload_session_fail_bad_input():
+    async with AppClient(config) as cli:
+        for body, err in [
+            ([], "The top level JSON element must be a mapping"),
+            ({"filename": "f", "size": 1}, "destPath is required and must be a string"),
+            ({"destPath": "/", "size": 1}, "filename is required and must be a string"),
+            ({"destPath": "/", "filename": "f", "size": 0},
+             "size is required and must be a positive integer"),
+            ({"destPath": "/", "filename": "a/b", "size": 1}, "Invalid filename: a/b"),
+        ]:
+            res = await cli.post("upload-session", headers={"Authorization": ""}, json=body)
+            assert res.status == 400
+            assert await res.json() == {"error": err}
+        res = await cli.post(
+            "upload-session",
+            headers={"Authorization": ""},
+            json={"destPath": "/", "filename": ".hidden", "size": 1},
+        )
+        assert res.status == 403
+        res = await cli.head("upload-session/" + "0" * 32, headers={"Authorization": ""})
+        assert res.status == 404
+
+
+async def test_multipart_upload():
+    username = "testuser"
+    part_size = 64 * 1024
+    line = b"0123456789abcdef" * 8 + b"\n"
+    txt = (line * (2 * part_size // len(line) + 10))[: 2 * part_size + 100]
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            res = await cli.post(
+                "multipart-upload",
+                headers={"Authorization": ""},
+                json={"destPath": "test", "filename": "multi", "size": len(txt),
+                      "partSize": part_size},
+            )
+            assert res.status == 201
+            upload = await res.json()
+            assert upload["path"] == "testuser/test/multi"
+            assert upload["partSize"] == part_size
+            assert upload["partCount"] == 3
+            assert upload["parts"] == []
+            url = "multipart-upload/" + upload["session_id"]
+            assert res.headers["Location"] == "/" + url
+
+            # parts may arrive in any order and concurrently
+            res1, res3 = await asyncio.gather(
+                cli.put(url + "/1", headers={"Authorization": ""}, data=txt[:part_size]),
+                cli.put(url + "/3", headers={"Authorization": ""}, data=txt[2 * part_size:]),
+            )
+            assert res1.status == 200
+            assert await res1.json() == {
+                "partNumber": 1,
+                "size": part_size,
+                "md5": hashlib.md5(txt[:part_size]).hexdigest(),
+            }
+            assert res1.headers["ETag"] == f'"{hashlib.md5(txt[:part_size]).hexdigest()}"'
+            assert res3.status == 200
+
+            res = await cli.post(url + "/complete", headers={"Authorization": ""})
+            assert res.status == 400
+            assert await res.json() == {"error": "Missing parts: 2"}
+
+            res = await cli.get(url, headers={"Authorization": ""})
+            assert [p["partNumber"] for p in (await res.json())["parts"]] == [1, 3]
+
+            for part, err in [
+                ("2", "part 2 must be 65536 bytes"),
+                ("4", "part number must be an integer between 1 and 3"),
+                ("x", "part number must be an integer between 1 and 3"),
+            ]:
+                res = await cli.put(
+                    url + "/" + part, headers={"Authorization": ""}, data=txt[:100])
+                assert res.status == 400
+                assert await res.text() == err
+
+            res = await cli.put(
+                url + "/2", headers={"Authorization": ""}, data=txt[part_size: 2 * part_size])
+            assert res.status == 200
+            res = await cli.post(url + "/complete", headers={"Authorization": ""})
+            assert res.status == 200
+            js = await res.json()
+            assert js[0]["path"] == "testuser/test/multi"
+            assert js[0]["size"] == len(txt)
+
+            with open(os.path.join(DATA_DIR, username, "test", "multi"), "rb") as f:
+                assert f.read() == txt
+            assert os.listdir(os.path.join(DATA_DIR, username, "test")) == ["multi"]
+            with open(os.path.join(META_DIR, username, "test", "multi")) as m:
+                metadata = decoder.decode(m.read())
+            md5s = b"".join(hashlib.md5(txt[i: i + part_size]).digest()
+                            for i in range(0, len(txt), part_size))
+            assert metadata == {
+                "source": "KBase upload",
+                "md5": hashlib.md5(txt).hexdigest(),
+                "lineCount": str(txt.count(b"\n") + 1),
+                "head": txt[:1024].decode(),
+                "tail": txt[-1024:].decode(),
+                "partsMd5": hashlib.md5(md5s).hexdigest() + "-3",
+            }
+
+            res = await cli.get(url, headers={"Authorization": ""})
+            assert res.status == 404
+
+
+async def test_multipart_upload_fail_bad_input():
+    async with AppClient(config) as cli:
+        for body, err in [
+            ({"destPath": "/", "filename": "f", "size": 10},
+             "partSize is required and must be an integer"),
+            ({"destPath": "/", "filename": "f", "size": 10, "partSize": 1000},
+             "The part size must be at least 65536 bytes"),
+            ({"destPath": "/", "filename": "f", "size": 65536 * 10001, "partSize": 65536},
+             "An upload may have at most 10000 parts"),
+        ]:
+            res = await cli.post("multipart-upload", headers={"Authorization": ""}, json=body)
+            assert res.status == 400
+            assert await res.json() == {"error": err}
+
+        # resumable and multipart sessions can't be used in place of each other
+        res = await cli.post(
+            "upload-session",
+            headers={"Authorization": ""},
+            json={"destPath": "/", "filename": "f", "size": 10},
+        )
+        session_id = (await res.json())["session_id"]
+        res = await cli.get("multipart-upload/" + session_id, headers={"Authorization": ""})
+        assert res.status == 404
+        res = await cli.delete("upload-session/" + session_id, headers={"Authorization": ""})
+        assert res.status == 200
+
 
 async def _upload_file_fail_filename(filename: str, err: str):
     # Note two file uploads in a row causes a test error:
@@ -948,6 +1556,72 @@ async def test_file_decompression(contents):
                 assert os.path.exists(f1)
 
 
+async def test_decompress_background():
+    username = "testuser"
+    async with AppClient(config, username) as cli:
+        with FileUtil() as fs:
+            d = fs.make_dir(os.path.join(username, "dirname"))
+            fs.make_file(os.path.join(username, "dirname", "a.txt"), "a" * 1000)
+            fs.make_file(os.path.join(username, "dirname", "b.txt"), "b" * 1000)
+            compressed = shutil.make_archive(d, "gztar", d[: -len("dirname")], "dirname")
+            shutil.rmtree(d)
+            size = os.stat(compressed).st_size
+            with open(os.path.join(DATA_DIR, username, "broken.tar.gz"), "wb") as f:
+                f.write(b"not a tarball")
+
+            resp = await cli.patch(
+                "/decompress/dirname.tar.gz?background=true", headers={"Authorization": ""}
+            )
+            assert resp.status == 202
+            job = await resp.json()
+            assert job["path"] == "testuser/dirname.tar.gz"
+            assert job["state"] in ("queued", "running")
+            assert job["total_bytes"] == size
+            assert resp.headers["Location"] == "/decompress-jobs/" + job["job_id"]
+
+            job = await _wait_for_job(cli, job["job_id"])
+            assert job["state"] == "complete"
+            assert job["bytes_processed"] == size
+            assert job["files_extracted"] == 3  # the folder and two files
+            assert job["error"] is None
+            assert job["finished"] >= job["started"] >= job["created"]
+            with open(os.path.join(d, "b.txt")) as f:
+                assert f.read() == "b" * 1000
+
+            resp = await cli.patch(
+                "/decompress/broken.tar.gz?background=true", headers={"Authorization": ""}
+            )
+            failed = await _wait_for_job(cli, (await resp.json())["job_id"])
+            assert failed["state"] == "failed"
+            assert failed["error"].startswith("Failed to decompress testuser/broken.tar.gz: ")
+
+            resp = await cli.get("/decompress-jobs", headers={"Authorization": ""})
+            ids = [j["job_id"] for j in await resp.json()]
+            assert ids.index(job["job_id"]) < ids.index(failed["job_id"])
+
+            # without the background parameter failures are returned as before
+            resp = await cli.patch("/decompress/broken.tar.gz", headers={"Authorization": ""})
+            assert resp.status == 500
+            assert (await resp.text()).startswith(
+                "Failed to decompress testuser/broken.tar.gz: ")
+
+            resp = await cli.patch("/decompress/nope.tar.gz", headers={"Authorization": ""})
+            assert resp.status == 404
+            resp = await cli.get("/decompress-jobs/" + "0" * 32, headers={"Authorization": ""})
+            assert resp.status == 404
+
+
+async def _wait_for_job(cli, job_id):
+    for _ in range(500):
+        resp = await cli.get("/decompress-jobs/" + job_id, headers={"Authorization": ""})
+        assert resp.status == 200
+        job = await resp.json()
+        if job["state"] in ("complete", "failed"):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
 async def test_importer_mappings():
     """
     This tests calling with simple good cases, and some expected bad cases
@@ -1643,3 +2317,36 @@ async def test_importer_filetypes():
         assert f2e["SRA"] == ["sra"]
 
         assert resp.status == 200
+
+
+async def test_importer_filetypes_not_modified():
+    async with AppClient(config) as cli:
+        resp = await cli.get("importer_filetypes")
+        assert resp.status == 200
+        assert resp.headers["Content-Type"] == "application/json; charset=utf-8"
+        etag = resp.headers["ETag"]
+        body = await resp.read()
+
+        resp = await cli.get("importer_filetypes", headers={"If-None-Match": etag})
+        assert resp.status == 304
+        assert resp.headers["ETag"] == etag
+        resp = await cli.get("importer_filetypes", headers={"If-None-Match": '"other"'})
+        assert resp.status == 200
+        assert await resp.read() == body
+
+
+async def test_importer_mappings_not_modified():
+    qs = urlencode({"file_list": ["file1.txt", "file.tar.gz"]}, doseq=True)
+    other_qs = urlencode({"file_list": ["file1.txt"]}, doseq=True)
+    async with AppClient(config) as cli:
+        resp = await cli.get(f"importer_mappings/?{qs}")
+        assert resp.status == 200
+        etag = resp.headers["ETag"]
+        assert (await resp.json())["fileinfo"][1]["suffix"] == "tar.gz"
+
+        resp = await cli.get(f"importer_mappings/?{qs}", headers={"If-None-Match": etag})
+        assert resp.status == 304
+        # the ETag depends on the files
+        resp = await cli.get(f"importer_mappings/?{other_qs}", headers={"If-None-Match": etag})
+        assert resp.status == 200
+        assert resp.headers["ETag"] != etag
@@ -0,0 +1,170 @@
+""" Unit tests for the auth client and its token caches. """
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from pytest import raises
+
+from staging_service.auth2Client import (
+    KBaseAuth2,
+    SQLiteTokenCache,
+    TokenCache,
+    token_cache_from_config,
+)
+
+from tests.test_http_client import _auth_app
+
+
+def _later():
+    return time.time() + 3600
+
+
+def test_sqlite_token_cache_shared(tmp_path):
+    path = str(tmp_path / "cache" / "tokens.sqlite3")
+    # two caches on the same file stand in for two worker processes
+    cache1 = SQLiteTokenCache(path)
+    cache2 = SQLiteTokenCache(path)
+    assert cache1.get_user("token") is None
+    cache1.add_valid_token("token", "fakeuser", _later())
+    assert cache1.get_user("token") == "fakeuser"
+    assert cache2.get_user("token") == "fakeuser"
+    assert cache2.get_user("othertoken") is None
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    # the token itself isn't stored
+    with sqlite3.connect(path) as conn:
+        assert "token" not in {r[0] for r in conn.execute("SELECT token FROM tokens")}
+
+    with raises(web.HTTPBadRequest):
+        cache1.add_valid_token("", "fakeuser", _later())
+    with raises(web.HTTPBadRequest):
+        cache1.add_valid_token("token", "", _later())
+
+
+def test_sqlite_token_cache_expiry(tmp_path):
+    cache = SQLiteTokenCache(str(tmp_path / "tokens.sqlite3"))
+    cache.add_valid_token("expired", "fakeuser", time.time() - 1)
+    assert cache.get_user("expired") is None
+    cache._MAX_TIME_SEC = 0
+    cache.add_valid_token("stale", "fakeuser", _later())
+    time.sleep(0.01)
+    assert cache.get_user("stale") is None
+
+
+def test_sqlite_token_cache_maxsize(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteTokenCache, "_TRIM_INTERVAL", 10)
+    cache = SQLiteTokenCache(str(tmp_path / "tokens.sqlite3"), maxsize=5)
+    for i in range(20):
+        cache.add_valid_token(f"token{i}", f"user{i}", _later())
+    # trimmed on the 20th addition, keeping the newest
+    assert [cache.get_user(f"token{i}") for i in range(20)] == [None] * 15 + [
+        f"user{i}" for i in range(15, 20)
+    ]
+    assert cache.stats() == {"size": 5, "hits": 5, "misses": 15, "evictions": 15}
+
+
+def test_sqlite_token_cache_busy(tmp_path):
+    path = str(tmp_path / "tokens.sqlite3")
+    cache = SQLiteTokenCache(path)
+    cache.add_valid_token("token", "fakeuser", _later())
+    # while another process is writing, reads still succeed and a write is dropped rather than
+    # waited for
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        cache.add_valid_token("token2", "fakeuser2", _later())
+        assert SQLiteTokenCache(path).get_user("token") == "fakeuser"
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert cache.get_user("token") == "fakeuser"
+    assert cache.get_user("token2") is None
+
+
+def test_token_cache_from_config(tmp_path):
+    assert type(token_cache_from_config({})) is TokenCache
+    assert type(token_cache_from_config({"TOKEN_CACHE": "memory"})) is TokenCache
+    cache = token_cache_from_config(
+        {"TOKEN_CACHE": "sqlite", "TOKEN_CACHE_PATH": str(tmp_path / "t.sqlite3")})
+    assert type(cache) is SQLiteTokenCache
+    with raises(ValueError):
+        token_cache_from_config({"TOKEN_CACHE": "sqlite"})
+    with raises(ValueError):
+        token_cache_from_config({"TOKEN_CACHE": "redis"})
+
+
+def test_token_cache_lru():
+    cache = TokenCache(maxsize=3)
+    for i in range(3):
+        cache.add_valid_token(f"token{i}", f"user{i}", _later())
+    # token0 becomes the most recently used, so token1 is evicted next
+    assert cache.get_user("token0") == "user0"
+    cache.add_valid_token("token3", "user3", _later())
+    assert cache.get_user("token1") is None
+    assert [cache.get_user(f"token{i}") for i in (0, 2, 3)] == ["user0", "user2", "user3"]
+    assert cache.stats() == {"size": 3, "hits": 4, "misses": 1, "evictions": 1}
+
+    # adding a token again makes it the most recently used
+    cache.add_valid_token("token0", "user0", _later())
+    cache.add_valid_token("token4", "user4", _later())
+    assert cache.get_user("token2") is None
+    assert cache.get_user("token0") == "user0"
+
+    with raises(web.HTTPBadRequest):
+        cache.add_valid_token("", "fakeuser", _later())
+    with raises(web.HTTPBadRequest):
+        cache.add_valid_token("token", "", _later())
+
+
+def test_token_cache_expiry():
+    cache = TokenCache()
+    cache.add_valid_token("expired", "fakeuser", time.time() - 1)
+    assert cache.get_user("expired") is None
+    cache._MAX_TIME_SEC = 0
+    cache.add_valid_token("stale", "fakeuser", _later())
+    time.sleep(0.01)
+    assert cache.get_user("stale") is None
+    # expired tokens are removed when they're looked up
+    assert cache.stats() == {"size": 0, "hits": 0, "misses": 2, "evictions": 0}
+
+
+async def test_get_user_coalesced():
+    peers = []
+    async with TestServer(_auth_app(peers)) as server:
+        auth = KBaseAuth2(str(server.make_url("/services/auth/api/V2/token")))
+        users = await asyncio.gather(*[auth.get_user("token") for _ in range(10)])
+        assert users == ["user_token"] * 10
+        # one call to the auth service, then the cache
+        assert len(peers) == 1
+        assert await auth.get_user("token") == "user_token"
+        assert len(peers) == 1
+
+        with raises(web.HTTPUnauthorized) as got:
+            await asyncio.gather(*[auth.get_user("bad") for _ in range(3)])
+        assert "Invalid token" in got.value.text
+        assert len(peers) == 2
+
+
+async def test_get_user_sqlite_cache_off_loop(tmp_path):
+    cache = SQLiteTokenCache(str(tmp_path / "tokens.sqlite3"))
+    threads = []
+    get_user = cache.get_user
+
+    def record_thread(token):
+        threads.append(threading.current_thread())
+        return get_user(token)
+
+    cache.get_user = record_thread
+    peers = []
+    async with TestServer(_auth_app(peers)) as server:
+        auth = KBaseAuth2(str(server.make_url("/services/auth/api/V2/token")), cache)
+        assert await auth.get_user("token") == "user_token"
+        assert await auth.get_user("token") == "user_token"
+        assert len(peers) == 1
+        assert (await auth.cache_stats())["size"] == 1
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
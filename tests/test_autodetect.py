@@ -1,3 +1,6 @@
+import json
+import os
+
 import pytest
 from staging_service.autodetect.GenerateMappings import (
     file_format_to_extension_mapping,
@@ -5,12 +8,12 @@ from staging_service.autodetect.GenerateMappings import (
 )
 from staging_service.AutoDetectUtils import AutoDetectUtils
 from staging_service.app import inject_config_dependencies
-from tests.test_utils import bootstrap_config
+# the test config, with the service's files in a temporary directory
+from tests.test_app import config
 
 
 @pytest.fixture(autouse=True, scope="module")
 def run_before_tests():
-    config = bootstrap_config()
     inject_config_dependencies(config)
 
 
@@ -222,3 +225,89 @@ def test_get_mappings():
             {"prefix": "some.dots", "suffix": "gff3.gz", "file_ext_type": ['GFF']},
         ]
     }
+
+
+def test_set_mappings():
+    """
+    Test that the suffix lookup is rebuilt when the mappings change, and that the longest
+    matching suffix wins regardless of the order of the mappings.
+    """
+    original = AutoDetectUtils._MAPPINGS
+    try:
+        AutoDetectUtils.set_mappings({"types": {
+            "gz": {"mappings": [{"id": "gz"}], "file_ext_type": ["GZ"]},
+            "fq.gz": {"mappings": [{"id": "fq.gz"}], "file_ext_type": ["FQ"]},
+            "FQ": {"mappings": [{"id": "upper"}], "file_ext_type": ["UPPER"]},
+        }})
+        assert AutoDetectUtils.determine_possible_importers("a.b.Fq.GZ") == (
+            [{"id": "fq.gz"}], {"prefix": "a.b", "suffix": "Fq.GZ", "file_ext_type": ["FQ"]})
+        assert AutoDetectUtils.determine_possible_importers("a.fqq.gz") == (
+            [{"id": "gz"}], {"prefix": "a.fqq", "suffix": "gz", "file_ext_type": ["GZ"]})
+        # filenames are lower cased, so a suffix that isn't lower case never matches
+        assert AutoDetectUtils.determine_possible_importers("a.FQ")[0] is None
+
+        AutoDetectUtils.set_mappings(
+            {"types": {"fq": {"mappings": [{"id": "fq"}], "file_ext_type": ["FQ"]}}})
+        assert AutoDetectUtils.determine_possible_importers("a.b.Fq.GZ")[0] is None
+        assert AutoDetectUtils.determine_possible_importers("a.FQ")[0] == [{"id": "fq"}]
+    finally:
+        AutoDetectUtils.set_mappings(original)
+
+
+def test_get_mappings_json():
+    """
+    Test that the spliced JSON is the same as encoding the result of get_mappings.
+    """
+    file_list = [
+        "filename", "file.name.Gz", "some.dots.gff3.gz", 'quote".fasta', "üñí.FA", "tab\t.sra",
+        ".", "", "a.",
+    ]
+    assert AutoDetectUtils.get_mappings_json(file_list) == json.dumps(
+        AutoDetectUtils.get_mappings(file_list)).encode()
+    assert AutoDetectUtils.get_mappings_json([]) == b'{"mappings": [], "fileinfo": []}'
+
+
+def test_reload_mappings(tmp_path):
+    """
+    Test that the mappings are reloaded when the mappings file changes, and kept when it can't
+    be loaded.
+    """
+    original = AutoDetectUtils.get_snapshot()
+    original_file = AutoDetectUtils._MAPPINGS_FILE
+    path = tmp_path / "mappings.json"
+    types = {"fq": {"mappings": [{"id": "reads"}], "file_ext_type": ["FASTQ"]}}
+    try:
+        path.write_text(json.dumps({"types": types}))
+        AutoDetectUtils.load_mappings(str(path))
+        before = AutoDetectUtils.get_snapshot()
+        assert AutoDetectUtils.determine_possible_importers("a.fa")[0] is None
+        assert not AutoDetectUtils.reload_mappings_if_changed()
+
+        types["fa"] = {"mappings": [{"id": "assembly"}], "file_ext_type": ["FASTA"]}
+        # written to a new file and renamed, as an editor or deployment would
+        (tmp_path / "new.json").write_text(json.dumps({"types": types}))
+        os.replace(tmp_path / "new.json", path)
+        assert AutoDetectUtils.reload_mappings_if_changed()
+        after = AutoDetectUtils.get_snapshot()
+        assert after is not before
+        assert after.version != before.version
+        assert AutoDetectUtils.determine_possible_importers("a.fa")[0] == [{"id": "assembly"}]
+        assert after.datatype_mappings == {
+            "datatype_to_filetype": {"reads": ["FASTQ"], "assembly": ["FASTA"]},
+            "filetype_to_extensions": {"FASTQ": ["fq"], "FASTA": ["fa"]},
+        }
+        # the old snapshot is unchanged
+        assert before.longest_suffix("a.fa") is None
+        assert "FASTA" not in before.datatype_mappings["filetype_to_extensions"]
+
+        (tmp_path / "new.json").write_text("{not json")
+        os.replace(tmp_path / "new.json", path)
+        with pytest.raises(ValueError):
+            AutoDetectUtils.reload_mappings_if_changed()
+        assert AutoDetectUtils.get_snapshot() is after
+        # not retried until the file changes again
+        assert not AutoDetectUtils.reload_mappings_if_changed()
+    finally:
+        AutoDetectUtils._SNAPSHOT = original
+        AutoDetectUtils._MAPPINGS = original.mappings
+        AutoDetectUtils._MAPPINGS_FILE = original_file
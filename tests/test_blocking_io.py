@@ -0,0 +1,52 @@
+""" Unit tests for the blocking IO thread pool. """
+
+import asyncio
+import threading
+
+from staging_service import blocking_io
+
+
+async def test_run_blocking_runs_off_loop():
+    loop_thread = threading.current_thread()
+    thread = await blocking_io.run_blocking(threading.current_thread)
+    assert thread is not loop_thread
+    assert thread.name.startswith("blocking-io")
+    assert await blocking_io.run_blocking(divmod, 7, 2) == (3, 1)
+
+
+async def test_stats_report_queue_depth():
+    executor = blocking_io.BlockingIOExecutor(1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    loop = asyncio.get_event_loop()
+    futures = [loop.run_in_executor(executor, block) for _ in range(3)]
+    started.wait(5)
+    stats = executor.stats()
+    # the first task may have started before the others were submitted
+    assert stats.pop("max_queued") in (2, 3)
+    assert stats == {"threads": 1, "active": 1, "queued": 2, "completed": 0}
+    release.set()
+    await asyncio.gather(*futures)
+    stats = executor.stats()
+    del stats["max_queued"]
+    assert stats == {"threads": 1, "active": 0, "queued": 0, "completed": 3}
+    executor.shutdown()
+
+
+def test_configure_replaces_closed_or_resized_pool():
+    blocking_io.configure(4)
+    first = blocking_io.get_executor()
+    blocking_io.configure(4)
+    assert blocking_io.get_executor() is first
+    first.shutdown()
+    second = blocking_io.get_executor()
+    assert second is not first
+    assert second.stats()["threads"] == 4
+    blocking_io.configure(blocking_io.DEFAULT_THREADS)
+    assert blocking_io.get_executor().stats()["threads"] == blocking_io.DEFAULT_THREADS
+    assert second.closed
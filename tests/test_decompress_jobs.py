@@ -0,0 +1,180 @@
+""" Unit tests for the decompression job pool. """
+
+import asyncio
+import dataclasses
+import os
+import threading
+import time
+import uuid
+
+from pytest import fixture, raises
+
+from staging_service import decompress_jobs
+from staging_service.decompress_jobs import DecompressJobs
+from staging_service.utils import Path
+
+from tests.test_app import FileUtil
+
+
+@fixture
+def slot_dir(tmp_path, monkeypatch):
+    # the archives, job status and slot files are written to a temporary directory
+    monkeypatch.setattr(Path, "_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(Path, "_META_DIR", str(tmp_path / "meta"))
+    return str(tmp_path / "slots")
+
+
+def _archive(username, name):
+    path = Path.validate_path(username, name)
+    os.makedirs(os.path.dirname(path.full_path), exist_ok=True)
+    with open(path.full_path, "w") as f:
+        f.write("archive")
+    return path
+
+
+async def test_job_limits(slot_dir):
+    users = ["jobuser" + uuid.uuid4().hex for _ in range(2)]
+    running = {u: 0 for u in users}
+    max_running = {u: 0 for u in users}
+    max_total = 0
+    release = asyncio.Event()
+
+    async def extract(path, progress):
+        nonlocal max_total
+        user = path.user_path.split("/")[0]
+        running[user] += 1
+        max_running[user] = max(max_running[user], running[user])
+        max_total = max(max_total, sum(running.values()))
+        progress.add_bytes(7)
+        progress.add_file()
+        await release.wait()
+        running[user] -= 1
+
+    with FileUtil(Path._DATA_DIR):
+        jobs = DecompressJobs(jobs_per_node=3, jobs_per_user=2, slot_dir=slot_dir)
+        submitted = []
+        for user in users:
+            for i in range(3):
+                submitted.append(await jobs.submit(user, _archive(user, f"a{i}.zip"), extract))
+        await asyncio.sleep(0.1)
+        assert max_total == 3
+        assert sorted(max_running.values()) == [1, 2]
+        states = [decompress_jobs.get_job(j.username, j.job_id).state for j in submitted]
+        assert states.count("running") == 3
+        assert states.count("queued") == 3
+
+        release.set()
+        for job in submitted:
+            done = await jobs.wait(job)
+            assert done.state == "complete"
+            assert done.bytes_processed == 7
+            assert done.total_bytes == 7
+            assert done.files_extracted == 1
+        assert max(max_running.values()) == 2
+        assert max_total == 3
+        assert [j.job_id for j in decompress_jobs.list_jobs(users[0])] == [
+            j.job_id for j in submitted[:3]]
+        # other users' jobs can't be seen
+        assert decompress_jobs.get_job(users[1], submitted[0].job_id) is None
+
+
+
+async def test_job_limits_shared_between_processes(slot_dir, monkeypatch):
+    monkeypatch.setattr(decompress_jobs, "_SLOT_POLL_SEC", 0.01)
+    user = "jobuser" + uuid.uuid4().hex
+    running = 0
+    max_running = 0
+    release = asyncio.Event()
+
+    async def extract(path, progress):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await release.wait()
+        running -= 1
+
+    with FileUtil(Path._DATA_DIR):
+        # two pools stand in for two worker processes, which share the slots on the node
+        pools = [
+            DecompressJobs(jobs_per_node=3, jobs_per_user=2, slot_dir=slot_dir) for _ in range(2)]
+        submitted = []
+        for i in range(4):
+            pool = pools[i % 2]
+            submitted.append((pool, await pool.submit(user, _archive(user, f"a{i}.zip"), extract)))
+        await asyncio.sleep(0.1)
+        assert max_running == 2
+        states = [decompress_jobs.get_job(user, j.job_id).state for _, j in submitted]
+        assert states.count("running") == 2
+        assert states.count("queued") == 2
+
+        release.set()
+        for pool, job in submitted:
+            assert (await pool.wait(job)).state == "complete"
+        assert max_running == 2
+        # the slot files are removed when the slots are freed
+        assert os.listdir(slot_dir) == []
+        for pool in pools:
+            await pool.shutdown()
+
+
+async def test_slot_freed_when_cancelled_while_taken(slot_dir, monkeypatch):
+    taking = threading.Event()
+    proceed = threading.Event()
+    take = decompress_jobs._try_take_slot
+
+    def slow_take(*args):
+        taking.set()
+        proceed.wait()
+        return take(*args)
+
+    monkeypatch.setattr(decompress_jobs, "_try_take_slot", slow_take)
+
+    async def hold():
+        async with decompress_jobs._slot(slot_dir, "node", 1):
+            await asyncio.sleep(60)
+
+    task = asyncio.ensure_future(hold())
+    while not taking.is_set():
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with raises(asyncio.CancelledError):
+        await task
+    # the slot is taken by the thread after the job was cancelled, and then freed
+    proceed.set()
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        slot = take(slot_dir, "node", 1)
+        if slot is not None:
+            break
+    assert slot is not None
+    decompress_jobs._free_slot(slot)
+    assert os.listdir(slot_dir) == []
+
+
+async def test_job_failure_and_expiry(slot_dir):
+    user = "jobuser" + uuid.uuid4().hex
+
+    async def extract(path, progress):
+        raise ValueError("bad archive")
+
+    with FileUtil(Path._DATA_DIR):
+        jobs = DecompressJobs(slot_dir=slot_dir)
+        job = await jobs.submit(user, _archive(user, "a.zip"), extract)
+        done = await jobs.wait(job)
+        assert done.state == "failed"
+        assert done.error == "bad archive"
+        assert decompress_jobs.get_job(user, job.job_id) == done
+
+        # a running job that hasn't been updated in a while was interrupted
+        stale = dataclasses.replace(
+            done, job_id=uuid.uuid4().hex, state="running", finished=None, error=None,
+            updated=time.time() - 120)
+        decompress_jobs._save(stale)
+        interrupted = decompress_jobs.get_job(user, stale.job_id)
+        assert interrupted.state == "failed"
+        assert interrupted.error == "The job was interrupted by a server restart"
+
+        decompress_jobs.remove_expired_jobs(60)
+        assert decompress_jobs.list_jobs(user) == [done]
+        decompress_jobs.remove_expired_jobs(0)
+        assert decompress_jobs.list_jobs(user) == []
@@ -0,0 +1,350 @@
+""" Unit tests for the persistent directory index. """
+
+import os
+import shutil
+import sqlite3
+import uuid
+
+from pytest import fixture
+
+from staging_service import dir_index
+from staging_service.dir_index import DirIndex
+from staging_service.utils import Path
+
+from tests.test_app import FileUtil
+
+
+@fixture
+def user(tmp_path, monkeypatch):
+    # the files and the index databases are written to a temporary directory
+    monkeypatch.setattr(Path, "_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(Path, "_META_DIR", str(tmp_path / "meta"))
+    username = "indexuser" + uuid.uuid4().hex
+    with FileUtil(Path._DATA_DIR) as fu:
+        fu.make_dir(os.path.join(username, "sub", "subsub"))
+        fu.make_file(os.path.join(username, "a.txt"), "a")
+        fu.make_file(os.path.join(username, "sub", "b.txt"), "bb")
+        fu.make_file(os.path.join(username, "sub", ".hidden"), "h")
+        fu.make_file(os.path.join(username, "sub", "subsub", "c.txt"), "ccc")
+        yield username
+
+
+def _make_index(username, sources=None):
+    return DirIndex(
+        username, lambda paths: [(sources or {}).get(p.name, "Unknown") for p in paths])
+
+
+def _paths(entries):
+    return [e["path"] for e in entries]
+
+
+def test_list_recursive(user):
+    index = _make_index(user, {"b.txt": "JGI import"})
+    res = index.list(Path.validate_path(user), show_hidden=False)
+    assert _paths(res) == [
+        f"{user}/a.txt",
+        f"{user}/sub",
+        f"{user}/sub/b.txt",
+        f"{user}/sub/subsub",
+        f"{user}/sub/subsub/c.txt",
+    ]
+    b = res[2]
+    assert b["name"] == "b.txt"
+    assert b["size"] == 2
+    assert b["isFolder"] is False
+    assert b["source"] == "JGI import"
+    assert b["mtime"] == int(os.stat(Path.validate_path(user, "sub/b.txt").full_path).st_mtime
+                             * 1000)
+    assert res[1]["isFolder"] is True
+    assert "source" not in res[1]
+
+
+def test_list_hidden_query_and_no_recurse(user):
+    index = _make_index(user)
+    res = index.list(Path.validate_path(user, "sub"), show_hidden=True)
+    assert _paths(res) == [
+        f"{user}/sub/.hidden",
+        f"{user}/sub/b.txt",
+        f"{user}/sub/subsub",
+        f"{user}/sub/subsub/c.txt",
+    ]
+    res = index.list(Path.validate_path(user), show_hidden=False, query="c.t")
+    assert _paths(res) == [f"{user}/sub/subsub/c.txt"]
+    res = index.list(Path.validate_path(user), show_hidden=False, recurse=False)
+    assert _paths(res) == [f"{user}/a.txt", f"{user}/sub"]
+
+
+def test_reconcile_picks_up_changes(user, monkeypatch):
+    calls = []
+
+    def resolver(paths):
+        calls.extend(p.name for p in paths)
+        return ["Unknown"] * len(paths)
+
+    index = DirIndex(user, resolver)
+    root = Path.validate_path(user)
+    index.list(root, show_hidden=False)
+    assert sorted(calls) == [".hidden", "a.txt", "b.txt", "c.txt"]
+
+    # nothing changed, so sources are not resolved again
+    calls.clear()
+    index.list(root, show_hidden=False)
+    assert calls == []
+
+    os.remove(Path.validate_path(user, "sub/b.txt").full_path)
+    shutil.rmtree(Path.validate_path(user, "sub/subsub").full_path)
+    with open(Path.validate_path(user, "sub/d.txt").full_path, "w") as f:
+        f.write("dddd")
+    res = index.list(root, show_hidden=False)
+    assert _paths(res) == [f"{user}/a.txt", f"{user}/sub", f"{user}/sub/d.txt"]
+    assert res[2]["size"] == 4
+    assert calls == ["d.txt"]
+
+    # a file changed in place doesn't change its folder, but is picked up when the folder is
+    # scanned again, keeping its source
+    calls.clear()
+    monkeypatch.setattr(dir_index, "_rescan_sec", 0)
+    with open(Path.validate_path(user, "a.txt").full_path, "a") as f:
+        f.write("x" * 1000)
+    res = index.list(root, show_hidden=False)
+    assert res[0]["size"] == 1001
+    assert res[0]["source"] == "Unknown"
+    assert calls == []
+
+
+
+def test_unchanged_folders_not_read(user, monkeypatch):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    # a folder changed just before it is scanned is always scanned again, so these are made older
+    for folder in [root, Path.validate_path(user, "sub"), Path.validate_path(user, "sub/subsub")]:
+        os.utime(folder.full_path, (1000, 1000))
+    index.list(root, show_hidden=True)
+    read = []
+    scandir = os.scandir
+
+    def record_scandir(path):
+        read.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", record_scandir)
+    with open(Path.validate_path(user, "a.txt").full_path, "a") as f:
+        f.write("x" * 1000)
+    res = index.list(root, show_hidden=True)
+    assert read == []
+    # a file changed in place is listed as it was until its folder is scanned again
+    assert res[0]["size"] == 1
+
+    # adding a file changes its folder
+    with open(Path.validate_path(user, "sub/d.txt").full_path, "w") as f:
+        f.write("dddd")
+    res = index.list(root, show_hidden=True)
+    assert read == [Path.validate_path(user, "sub").full_path]
+    assert f"{user}/sub/d.txt" in _paths(res)
+
+    read.clear()
+    monkeypatch.setattr(dir_index, "_rescan_sec", 0)
+    res = index.list(root, show_hidden=True)
+    assert len(read) == 3
+    assert res[0]["size"] == 1001
+
+
+def test_sources_resolved_without_write_lock(user):
+    locked = []
+
+    def resolver(paths):
+        # another writer can take the lock while the folder is being indexed
+        conn = sqlite3.connect(index._db_path, timeout=0, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            locked.extend(p.name for p in paths)
+        finally:
+            conn.close()
+        return ["Unknown"] * len(paths)
+
+    index = DirIndex(user, resolver)
+    assert len(index.list(Path.validate_path(user), show_hidden=True)) == 6
+    assert locked == []
+
+
+def test_database_recreated(user):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    index.list(root, show_hidden=False)
+    os.remove(index._db_path)
+    assert len(index.list(root, show_hidden=False)) == 5
+
+
+def test_update_remove_and_move(user):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    index.list(root, show_hidden=False)
+
+    a = Path.validate_path(user, "a.txt")
+    with open(a.full_path, "w") as f:
+        f.write("a changed in place")
+    index.update(a, source="KBase upload")
+    res = index.list(root, show_hidden=False, recurse=False)
+    assert res[0]["size"] == 18
+    assert res[0]["source"] == "KBase upload"
+
+    # the source is kept when the file is updated without one
+    index.update(a)
+    assert index.list(root, show_hidden=False, recurse=False)[0]["source"] == "KBase upload"
+
+    sub = Path.validate_path(user, "sub")
+    moved = Path.validate_path(user, "moved")
+    os.rename(sub.full_path, moved.full_path)
+    index.move(sub, moved)
+    res = index.list(root, show_hidden=False)
+    assert _paths(res) == [
+        f"{user}/a.txt",
+        f"{user}/moved",
+        f"{user}/moved/b.txt",
+        f"{user}/moved/subsub",
+        f"{user}/moved/subsub/c.txt",
+    ]
+
+    shutil.rmtree(moved.full_path)
+    index.remove(moved)
+    assert _paths(index.list(root, show_hidden=False)) == [f"{user}/a.txt"]
+
+
+def test_page(user):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    everything = _paths(index.list(root, show_hidden=True))
+    res, after = index.page(root, show_hidden=True, limit=2)
+    assert _paths(res) == everything[:2]
+    pages = [res]
+    while after is not None:
+        res, after = index.page(root, show_hidden=True, limit=2, after=after)
+        pages.append(res)
+    assert [len(p) for p in pages] == [2, 2, 2]
+    assert sum([_paths(p) for p in pages], []) == everything
+
+    res, after = index.page(root, show_hidden=False, depth=2)
+    assert _paths(res) == [
+        f"{user}/a.txt", f"{user}/sub", f"{user}/sub/b.txt", f"{user}/sub/subsub"]
+    assert after is None
+
+    for name, mtime in [
+        ("a.txt", 3000), ("sub/b.txt", 1000), ("sub/subsub/c.txt", 2000),
+        ("sub/subsub", 1000), ("sub", 500),
+    ]:
+        os.utime(Path.validate_path(user, name).full_path, (mtime, mtime))
+    # newest first, with entries modified at the same time in path order
+    res, after = index.page(root, show_hidden=False, sort="mtime", limit=3)
+    assert _paths(res) == [f"{user}/a.txt", f"{user}/sub/subsub/c.txt", f"{user}/sub/b.txt"]
+    res, after = index.page(root, show_hidden=False, sort="mtime", limit=3, after=after)
+    assert _paths(res) == [f"{user}/sub/subsub", f"{user}/sub"]
+    assert after is None
+
+
+
+def test_path_page_scans_only_its_folders(user, monkeypatch):
+    # 'sub-x' comes before 'sub/b.txt' as a string, but after 'sub' and everything below it in
+    # path order
+    for name in ["sub-x/d.txt", "z/e.txt"]:
+        path = Path.validate_path(user, name)
+        os.makedirs(os.path.dirname(path.full_path))
+        with open(path.full_path, "w") as f:
+            f.write("d")
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    everything = _paths(index.list(root, show_hidden=False))
+    assert everything[5:] == [
+        f"{user}/sub-x", f"{user}/sub-x/d.txt", f"{user}/z", f"{user}/z/e.txt"]
+    scanned = []
+    scan = DirIndex._scan
+
+    def record_scan(self, conn, user_path, *args):
+        scanned.append(user_path)
+        return scan(self, conn, user_path, *args)
+
+    monkeypatch.setattr(DirIndex, "_scan", record_scan)
+    res, after = index.page(root, show_hidden=False, limit=3)
+    assert _paths(res) == everything[:3]
+    assert scanned == [user, f"{user}/sub", f"{user}/sub/subsub"]
+    scanned.clear()
+    res, after = index.page(root, show_hidden=False, limit=3, after=after)
+    assert _paths(res) == everything[3:6]
+    # the folders the cursor is in are scanned, but not the ones before them
+    assert scanned == [user, f"{user}/sub", f"{user}/sub/subsub", f"{user}/sub-x"]
+    scanned.clear()
+    res, after = index.page(root, show_hidden=False, limit=3, after=after)
+    assert _paths(res) == everything[6:]
+    assert after is None
+    assert scanned == [user, f"{user}/sub-x", f"{user}/z"]
+    # a cursor outside the folder is before or after all of its entries
+    sub = Path.validate_path(user, "sub")
+    assert index.page(sub, show_hidden=False, after=[user, "a.txt"])[0] == index.page(
+        sub, show_hidden=False)[0]
+    assert index.page(sub, show_hidden=False, after=[user, "z"]) == ([], None)
+
+
+def test_iter_entries(user):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    for show_hidden in [False, True]:
+        for sort in ["path", "mtime"]:
+            for depth in [None, 1, 2]:
+                for query in ["", "b", "sub"]:
+                    expected, _ = index.page(root, show_hidden, query, depth, sort)
+                    res = list(index.iter_entries(root, show_hidden, query, depth, sort))
+                    assert res == expected, (show_hidden, sort, depth, query)
+
+
+def test_iter_entries_reconciles_as_it_goes(user, monkeypatch):
+    index = _make_index(user)
+    scanned = []
+    scan = DirIndex._scan
+
+    def record_scan(self, conn, user_path, *args):
+        scanned.append(user_path)
+        return scan(self, conn, user_path, *args)
+
+    monkeypatch.setattr(DirIndex, "_scan", record_scan)
+    entries = index.iter_entries(Path.validate_path(user), show_hidden=False)
+    assert next(entries)["path"] == f"{user}/a.txt"
+    assert scanned == [user]
+    assert [e["path"] for e in entries] == [
+        f"{user}/sub", f"{user}/sub/b.txt", f"{user}/sub/subsub", f"{user}/sub/subsub/c.txt"]
+    assert scanned == [user, f"{user}/sub", f"{user}/sub/subsub"]
+
+
+def test_depth_summaries(user):
+    index = _make_index(user)
+    root = Path.validate_path(user)
+    index.list(root, show_hidden=True)
+    res, _ = index.page(root, show_hidden=False, depth=1)
+    assert [(e["path"], e.get("childCount"), e.get("totalSize")) for e in res] == [
+        (f"{user}/a.txt", None, None),
+        (f"{user}/sub", 2, 5),
+    ]
+    # the folders at the depth are scanned, so a change in one is counted
+    with open(Path.validate_path(user, "sub/d.txt").full_path, "w") as f:
+        f.write("dddd")
+    res, _ = index.page(root, show_hidden=True, depth=1)
+    assert (res[1]["childCount"], res[1]["totalSize"]) == (4, 10)
+    assert list(index.iter_entries(root, show_hidden=True, depth=1)) == res
+    res, _ = index.page(root, show_hidden=False, depth=1, sort="mtime")
+    assert {e["path"]: e.get("childCount") for e in res} == {
+        f"{user}/a.txt": None, f"{user}/sub": 3}
+    # folders below the depth are counted as of when they were last seen
+    with open(Path.validate_path(user, "sub/subsub/e.txt").full_path, "w") as f:
+        f.write("eeeee")
+    res, _ = index.page(root, show_hidden=False, depth=1)
+    assert res[1]["totalSize"] == 9
+    res, _ = index.page(root, show_hidden=False, depth=2)
+    assert [(e["path"], e.get("childCount"), e.get("totalSize")) for e in res] == [
+        (f"{user}/a.txt", None, None),
+        (f"{user}/sub", 3, 14),
+        (f"{user}/sub/b.txt", None, None),
+        (f"{user}/sub/d.txt", None, None),
+        (f"{user}/sub/subsub", 2, 8),
+    ]
+    # listings of every level don't include the summaries
+    assert "childCount" not in index.list(root, show_hidden=False)[1]
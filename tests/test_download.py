@@ -0,0 +1,77 @@
+""" Unit tests for the download conditional and range request handling. """
+
+from pytest import raises
+
+from staging_service.download import (
+    parse_range,
+    not_modified,
+    if_range_matches,
+    RangeNotSatisfiableException,
+)
+
+
+def test_parse_range():
+    for value, expected in [
+        ("bytes=0-0", [(0, 0)]),
+        ("bytes=0-499", [(0, 499)]),
+        ("bytes=500-", [(500, 999)]),
+        ("bytes=-500", [(500, 999)]),
+        ("bytes=-5000", [(0, 999)]),
+        ("bytes=990-5000", [(990, 999)]),
+        ("BYTES = 1-2 , 5-6,", [(1, 2), (5, 6)]),
+        # unsatisfiable ranges are dropped as long as one range is satisfiable
+        ("bytes=2000-3000,1-2", [(1, 2)]),
+        ("bytes=500-599,0-9", [(500, 599), (0, 9)]),
+    ]:
+        assert parse_range(value, 1000) == expected, value
+
+
+def test_parse_range_ignored():
+    for value in [
+        "items=0-1",
+        "bytes=",
+        "bytes=1",
+        "bytes=-",
+        "bytes=a-1",
+        "bytes=1-a",
+        "bytes=5-1",
+        "bytes=0-1,5-1",
+        "bytes=" + ",".join(["0-1"] * 101),
+    ]:
+        assert parse_range(value, 1000) is None, value
+
+
+def test_parse_range_not_satisfiable():
+    for value, size in [
+        ("bytes=1000-", 1000),
+        ("bytes=1000-2000,3000-", 1000),
+        ("bytes=-0", 1000),
+        ("bytes=0-", 0),
+        ("bytes=-1", 0),
+    ]:
+        with raises(RangeNotSatisfiableException):
+            parse_range(value, size)
+
+
+def test_not_modified():
+    date = "Wed, 21 Oct 2015 07:28:00 GMT"
+    mtime = 1445412480.5
+    assert not not_modified({}, '"a"', mtime)
+    assert not_modified({"If-None-Match": '"b", "a"'}, '"a"', mtime)
+    assert not_modified({"If-None-Match": 'W/"a"'}, '"a"', mtime)
+    assert not not_modified({"If-None-Match": '"b"'}, '"a"', mtime)
+    assert not_modified({"If-Modified-Since": date}, '"a"', mtime)
+    assert not not_modified({"If-Modified-Since": date}, '"a"', mtime + 1)
+    assert not not_modified({"If-Modified-Since": "not a date"}, '"a"', mtime)
+    assert not not_modified({"If-None-Match": '"b"', "If-Modified-Since": date}, '"a"', mtime)
+
+
+def test_if_range_matches():
+    date = "Wed, 21 Oct 2015 07:28:00 GMT"
+    mtime = 1445412480.5
+    assert if_range_matches({}, '"a"', mtime)
+    assert if_range_matches({"If-Range": '"a"'}, '"a"', mtime)
+    assert not if_range_matches({"If-Range": 'W/"a"'}, '"a"', mtime)
+    assert not if_range_matches({"If-Range": '"b"'}, '"a"', mtime)
+    assert if_range_matches({"If-Range": date}, '"a"', mtime)
+    assert not if_range_matches({"If-Range": date}, '"a"', mtime - 1)
@@ -0,0 +1,175 @@
+""" Unit tests for the streaming archive extractor. """
+
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import tarfile
+import uuid
+import zipfile
+
+from pytest import fixture, raises
+
+from staging_service import extraction
+from staging_service.decompress_jobs import Progress
+from staging_service.dir_index import DirIndex
+from staging_service.utils import Path
+
+from tests.test_app import FileUtil
+
+
+@fixture
+def user(tmp_path, monkeypatch):
+    # the archives, extracted files and their metadata are written to a temporary directory
+    monkeypatch.setattr(Path, "_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(Path, "_META_DIR", str(tmp_path / "meta"))
+    username = "extractuser" + uuid.uuid4().hex
+    with FileUtil(Path._DATA_DIR) as fu:
+        fu.make_dir(username)
+        yield username
+
+
+def _tar_info(name, data=b"", type_=tarfile.REGTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = type_
+    info.size = len(data)
+    info.mtime = 1500000000
+    return info
+
+
+def _make_tar(path, mode, entries):
+    with tarfile.open(path.full_path, mode) as tar:
+        for name, data, type_ in entries:
+            info = _tar_info(name, data, type_)
+            if type_ == tarfile.SYMTYPE:
+                info.linkname = "/etc/passwd"
+            tar.addfile(info, io.BytesIO(data) if data else None)
+
+
+def _metadata(path):
+    with open(path.metadata_path) as f:
+        return json.load(f)
+
+
+def test_extract_tar(user):
+    archive = Path.validate_path(user, "dir/archive.tar.gz")
+    os.makedirs(os.path.dirname(archive.full_path))
+    contents = b"line 1\nline 2\n" * 100000
+    _make_tar(archive, "w:gz", [
+        ("top", b"", tarfile.DIRTYPE),
+        ("top/a.txt", contents, tarfile.REGTYPE),
+        # the parent folders aren't in the archive
+        ("other/sub/b.txt", b"b", tarfile.REGTYPE),
+        ("../escape.txt", b"e", tarfile.REGTYPE),
+        ("/absolute.txt", b"abs", tarfile.REGTYPE),
+        ("link", b"", tarfile.SYMTYPE),
+    ])
+    progress = Progress()
+    extraction.extract(archive, progress)
+
+    assert progress.bytes_processed == os.stat(archive.full_path).st_size
+    # top, top/a.txt, other, other/sub, other/sub/b.txt, escape.txt, absolute.txt
+    assert progress.files_extracted == 7
+    dest = os.path.dirname(archive.full_path)
+    assert sorted(os.listdir(dest)) == [
+        "absolute.txt", "archive.tar.gz", "escape.txt", "other", "top"]
+    a = Path.validate_path(user, "dir/top/a.txt")
+    with open(a.full_path, "rb") as f:
+        assert f.read() == contents
+    assert os.stat(a.full_path).st_mtime == 1500000000
+    # the archive itself is kept
+    assert os.path.exists(archive.full_path)
+
+    metadata = _metadata(a)
+    assert metadata["md5"] == hashlib.md5(contents).hexdigest()
+    assert metadata["lineCount"] == "200000"
+    assert metadata["head"] == contents[:1024].decode()
+    assert metadata["source"] == "Unknown"
+
+    # the files are already indexed, so listing them doesn't need to determine their sources
+    calls = []
+    index = DirIndex(
+        user, lambda paths: calls.extend(p.name for p in paths) or ["Unknown"] * len(paths))
+    res = index.list(Path.validate_path(user, "dir"), show_hidden=False)
+    assert [e["path"][len(user) + 5:] for e in res] == [
+        "absolute.txt",
+        "archive.tar.gz",
+        "escape.txt",
+        "other",
+        "other/sub",
+        "other/sub/b.txt",
+        "top",
+        "top/a.txt",
+    ]
+    assert calls == ["archive.tar.gz"]
+
+
+def test_extract_zip(user):
+    archive = Path.validate_path(user, "archive.zip")
+    with zipfile.ZipFile(archive.full_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("z/", b"")
+        zf.writestr("z/a.txt", b"aaa\n")
+        zf.writestr("../../b.txt", b"bbb")
+    progress = Progress()
+    extraction.extract(archive, progress)
+    assert progress.bytes_processed == os.stat(archive.full_path).st_size
+    assert progress.files_extracted == 3
+    with open(Path.validate_path(user, "z/a.txt").full_path) as f:
+        assert f.read() == "aaa\n"
+    assert _metadata(Path.validate_path(user, "b.txt"))["md5"] == hashlib.md5(
+        b"bbb").hexdigest()
+
+
+def test_extract_single_file(user):
+    contents = b"x" * 100000
+    for suffix, compress in [(".gz", gzip.compress), (".xz", lzma.compress)]:
+        archive = Path.validate_path(user, "file.txt" + suffix)
+        with open(archive.full_path, "wb") as f:
+            f.write(compress(contents))
+        progress = Progress()
+        extraction.extract(archive, progress)
+        assert progress.files_extracted == 1
+        target = Path.validate_path(user, "file.txt")
+        with open(target.full_path, "rb") as f:
+            assert f.read() == contents
+        assert _metadata(target)["md5"] == hashlib.md5(contents).hexdigest()
+        # the compressed file is replaced
+        assert not os.path.exists(archive.full_path)
+
+        # an existing file isn't overwritten
+        with open(archive.full_path, "wb") as f:
+            f.write(compress(b"new"))
+        with raises(extraction.ExtractionException) as got:
+            extraction.extract(archive, Progress())
+        assert str(got.value) == f"{user}/file.txt already exists"
+        os.remove(target.full_path)
+        os.remove(archive.full_path)
+
+
+def test_extract_fail(user):
+    archive = Path.validate_path(user, "broken.gz")
+    with open(archive.full_path, "wb") as f:
+        f.write(gzip.compress(b"y" * 1000)[:-20])
+    with raises(extraction.ExtractionException) as got:
+        extraction.extract(archive, Progress())
+    assert str(got.value).startswith(f"Failed to decompress {user}/broken.gz: ")
+    # the partial output is removed
+    assert os.listdir(os.path.dirname(archive.full_path)) == ["broken.gz"]
+
+    with open(archive.full_path, "wb") as f:
+        f.write(gzip.compress(b"y" * 1000))
+    progress = Progress()
+    progress.cancel()
+    with raises(extraction.ExtractionCancelledException):
+        extraction.extract(archive, progress)
+    assert os.listdir(os.path.dirname(archive.full_path)) == ["broken.gz"]
+
+
+def test_can_extract():
+    for name in ["a.tar.gz", "a.tgz", "a.tar.bz", "a.tar.bz2", "a.tar", "a.zip", "a.ZIP",
+                 "a.gz", "a.bz2", "a.bzip2", "a.xz", "a.tar.xz", "a.txz"]:
+        assert extraction.can_extract(name), name
+    for name in ["a.txt", "a.rar", "a.Zip", "a"]:
+        assert not extraction.can_extract(name), name
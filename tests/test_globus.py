@@ -0,0 +1,76 @@
+""" Unit tests for writing users' Globus ids. """
+
+import asyncio
+import os
+from collections import OrderedDict
+
+from aiohttp import web
+from pytest import raises
+
+from staging_service import globus
+from staging_service.utils import Path
+
+from tests.test_extraction import user  # noqa: F401
+
+
+async def test_assert_globusid_exists(user, monkeypatch):  # noqa: F811
+    monkeypatch.setattr(globus, "_known_users", OrderedDict())
+    calls = []
+
+    async def get_globus_ids(token):
+        calls.append(token)
+        await asyncio.sleep(0.05)
+        if token == "bad":
+            raise web.HTTPUnauthorized(text="bad token")
+        return ["fake@globusid.org"]
+
+    monkeypatch.setattr(globus, "_get_globus_ids", get_globus_ids)
+    path = Path.validate_path(user, ".globus_id").full_path
+
+    # concurrent requests share a failed lookup, and each gets its own error
+    results = await asyncio.gather(
+        *[globus.assert_globusid_exists(user, "bad") for _ in range(3)], return_exceptions=True)
+    assert [type(r) for r in results] == [web.HTTPUnauthorized] * 3
+    assert len({id(r) for r in results}) == 3
+    assert results[0].text == "bad token"
+    assert not os.path.exists(path)
+
+    await asyncio.gather(*[globus.assert_globusid_exists(user, "token") for _ in range(5)])
+    assert calls == ["bad", "token"]
+    with open(path) as f:
+        assert f.read() == "fake@globusid.org"
+
+    # once the file is known to exist it isn't checked again
+    os.remove(path)
+    await globus.assert_globusid_exists(user, "token")
+    assert calls == ["bad", "token"]
+    assert not os.path.exists(path)
+
+    # until the user's files are deleted or moved
+    globus.forget_user(user)
+    await globus.assert_globusid_exists(user, "token")
+    assert calls == ["bad", "token", "token"]
+    assert os.path.exists(path)
+
+    # or it has been known for a while
+    os.remove(path)
+    monkeypatch.setattr(globus, "_KNOWN_USERS_TTL_SEC", 0)
+    with raises(web.HTTPUnauthorized):
+        await globus.assert_globusid_exists(user, "bad")
+    assert calls == ["bad", "token", "token", "bad"]
+
+
+def test_known_users_bounded(monkeypatch):
+    monkeypatch.setattr(globus, "_KNOWN_USERS_MAX", 3)
+    monkeypatch.setattr(globus, "_known_users", OrderedDict())
+    for i in range(5):
+        globus._add_known_user(f"user{i}")
+    assert list(globus._known_users) == ["user2", "user3", "user4"]
+    assert globus._is_known_user("user4")
+    assert not globus._is_known_user("user0")
+
+
+def test_authme_url(monkeypatch):
+    monkeypatch.setattr(globus, "_auth2_me_url", None)
+    globus.set_auth_url("https://kbase.us/services/auth/api/V2/token")
+    assert globus._get_authme_url() == "https://kbase.us/services/auth/api/V2/me"
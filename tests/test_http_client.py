@@ -0,0 +1,67 @@
+""" Tests for the shared HTTP client session. """
+
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from staging_service import http_client
+from staging_service.auth2Client import KBaseAuth2
+
+
+def _auth_app(peers):
+    async def token(request):
+        # the client's port identifies the connection the request came in on
+        peers.append(request.transport.get_extra_info("peername")[1])
+        await asyncio.sleep(0.01)
+        if request.headers["Authorization"] == "bad":
+            return web.json_response(
+                {"error": {"httpcode": 401, "message": "Invalid token"}},
+                status=401, reason="Unauthorized")
+        return web.json_response({
+            "user": "user_" + request.headers["Authorization"],
+            "cachefor": 300,
+            "expires": (time.time() + 3600) * 1000,
+        })
+
+    app = web.Application()
+    app.router.add_get("/services/auth/api/V2/token", token)
+    return app
+
+
+async def test_shared_session_reuses_connections():
+    peers = []
+    async with TestServer(_auth_app(peers)) as server:
+        await http_client.start()
+        try:
+            auth = KBaseAuth2(str(server.make_url("/services/auth/api/V2/token")))
+            users = [await auth.get_user(f"token{i}") for i in range(5)]
+        finally:
+            await http_client.close()
+    assert users == [f"user_token{i}" for i in range(5)]
+    assert len(peers) == 5
+    assert len(set(peers)) == 1
+
+
+async def test_session_without_shared_session():
+    peers = []
+    async with TestServer(_auth_app(peers)) as server:
+        auth = KBaseAuth2(str(server.make_url("/services/auth/api/V2/token")))
+        users = [await auth.get_user(f"token{i}") for i in range(2)]
+    assert users == ["user_token0", "user_token1"]
+    # each call has its own session and so its own connection
+    assert len(set(peers)) == 2
+
+
+async def test_close():
+    await http_client.start(connection_limit=5, dns_cache_ttl_sec=10)
+    session = http_client._session
+    await http_client.start()
+    # starting again replaces the session
+    assert session.closed
+    session = http_client._session
+    await http_client.close()
+    assert session.closed
+    assert http_client._session is None
+    await http_client.close()
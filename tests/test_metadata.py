@@ -1,14 +1,20 @@
 """ Unit tests for the metadata handling routines. """
 
+import hashlib
 import json
+import os
+import shutil
 import uuid
 
 from collections.abc import Generator
 from pathlib import Path as PyPath
+from hypothesis import given, settings
+from hypothesis import strategies as st
 from pytest import fixture
 
+from staging_service import metadata
 from staging_service.utils import Path
-from staging_service.metadata import some_metadata
+from staging_service.metadata import some_metadata, FileDigest, PartsDigest, _digest_file
 
 from tests.test_app import FileUtil
 
@@ -78,3 +84,113 @@ async def _incomplete_metadata_file_update(temp_dir, metadict, source):
 
 def make_test_lines(start, stop):
     return [str(i) + "a" * (256 - len(str(i)) - 1) + "\n" for i in range(start, stop)]
+
+
+def _read_whole_file_metadata(file_path):
+    """ How the metadata was computed before it was streamed. """
+    md5 = hashlib.md5(open(file_path, "rb").read()).hexdigest()
+    line_count = str(sum((1 for i in open(file_path, "rb"))))
+    try:
+        with open(file_path, "r") as f:
+            head = f.read(1024)
+        upper_bound = min(1024, os.stat(file_path).st_size)
+        with open(file_path, "r") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(f.tell() - upper_bound, os.SEEK_SET)
+            tail = f.read()
+    except (UnicodeDecodeError, ValueError):
+        head = "not text file"
+        tail = "not text file"
+    return {"md5": md5, "lineCount": line_count, "head": head, "tail": tail}
+
+
+@settings(deadline=None, max_examples=50)
+@given(
+    st.one_of(
+        st.binary(max_size=20000),
+        st.text(alphabet="ab\r\n\u00e9\u4e2d", max_size=10000).map(
+            lambda t: t.encode("utf-8")),
+    ),
+    st.integers(min_value=1, max_value=5000),
+)
+def test_file_digest_matches_whole_file_reads(temp_dir, contents, chunk_size):
+    target = temp_dir / "digest"
+    target.write_bytes(contents)
+    expected = _read_whole_file_metadata(target)
+
+    assert _digest_file(str(target)).metadata() == expected
+
+    digest = FileDigest()
+    for i in range(0, len(contents), chunk_size):
+        digest.update(contents[i: i + chunk_size])
+    assert digest.metadata() == expected
+
+
+@settings(deadline=None, max_examples=50)
+@given(
+    st.one_of(
+        st.binary(min_size=1, max_size=40000),
+        st.text(alphabet="ab\r\n\u00e9\u4e2d", min_size=1, max_size=20000).map(
+            lambda t: t.encode("utf-8")),
+    ),
+    # the first part must hold the whole head
+    st.integers(min_value=8192, max_value=20000),
+)
+def test_parts_digest_matches_file_digest(contents, part_size):
+    whole = FileDigest()
+    whole.update(contents)
+    parts = []
+    for i in range(0, len(contents), part_size):
+        digest = FileDigest()
+        digest.update(contents[i: i + part_size])
+        parts.append(digest.part(include_head=i == 0))
+    assert [p["size"] for p in parts] == [
+        len(contents[i: i + part_size]) for i in range(0, len(contents), part_size)]
+
+    md5s = b"".join(hashlib.md5(contents[i: i + part_size]).digest()
+                    for i in range(0, len(contents), part_size))
+    assert PartsDigest(parts, hashlib.md5(contents).hexdigest()).metadata() == {
+        **whole.metadata(),
+        "partsMd5": hashlib.md5(md5s).hexdigest() + f"-{len(parts)}",
+    }
+
+
+def test_listing_defers_source_writes(temp_dir, monkeypatch):
+    monkeypatch.setattr(metadata, "_pending_sources", {})
+    # temp_dir is the home directory of a user named by its folder
+    root = temp_dir / "sources"
+    user_root = f"{temp_dir.name}/sources"
+    os.makedirs(root / "sub")
+    for name in ["a.txt", "b.txt", "c.txt", "sub/d.txt", "sub/.d.txt.jgi"]:
+        (root / name).write_text(name)
+    known = Path.validate_path(user_root, "b.txt")
+    meta_root = os.path.dirname(known.metadata_path)
+    os.makedirs(meta_root, exist_ok=True)
+    with open(known.metadata_path, "w") as f:
+        json.dump({"source": "KBase upload", "md5": "x"}, f)
+    try:
+        res = metadata._index_for(known).list(Path.validate_path(user_root), show_hidden=False)
+        assert {e["path"][len(user_root) + 1:]: e.get("source") for e in res} == {
+            "a.txt": "Unknown",
+            "b.txt": "KBase upload",
+            "c.txt": "Unknown",
+            "sub": None,
+            "sub/d.txt": "JGI import",
+        }
+        # listing writes no metadata
+        assert os.listdir(meta_root) == ["b.txt"]
+
+        os.remove(root / "c.txt")
+        # a.txt, sub/d.txt and sub/.d.txt.jgi
+        assert metadata.flush_sources() == 3
+        assert metadata.flush_sources() == 0
+        assert sorted(os.listdir(meta_root)) == ["a.txt", "b.txt", "sub"]
+        for name, expected in [
+            ("a.txt", {"source": "Unknown"}),
+            ("b.txt", {"source": "KBase upload", "md5": "x"}),
+            ("sub/d.txt", {"source": "JGI import"}),
+        ]:
+            with open(Path.validate_path(user_root, name).metadata_path) as f:
+                assert json.load(f) == expected
+    finally:
+        shutil.rmtree(meta_root)
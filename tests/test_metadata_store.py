@@ -0,0 +1,162 @@
+""" Unit tests for the metadata stores. """
+
+import os
+import time
+
+from pytest import fixture, mark, raises
+
+from staging_service import metadata, metadata_store
+from staging_service.metadata_store import SidecarStore, SQLiteStore
+from staging_service.utils import Path
+
+from scripts import migrate_metadata
+
+
+@fixture
+def meta_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Path, "_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(Path, "_META_DIR", str(tmp_path / "meta"))
+    os.makedirs(tmp_path / "data" / "user" / "dir" / "sub")
+    os.makedirs(tmp_path / "meta")
+    return tmp_path / "meta"
+
+
+def _paths(*user_paths):
+    return [Path.validate_path("user", p) for p in user_paths]
+
+
+@mark.parametrize("store_type", [SidecarStore, SQLiteStore])
+def test_store(meta_dir, store_type):
+    store = store_type()
+    a, b, c, d = _paths("a.txt", "dir/b.txt", "dir/sub/c.txt", "dir2/b.txt")
+    assert store.read(a) is None
+    before = time.time()
+    store.write(a, {"md5": "1", "source": "KBase upload"})
+    store.write(b, {"md5": "2"})
+    store.write(c, {"md5": "3"})
+    data, written = store.read(a)
+    assert data == {"md5": "1", "source": "KBase upload"}
+    assert before - 1 <= written <= time.time() + 1
+
+    store.add_sources([(a, "Unknown"), (b, "JGI import"), (d, "Unknown")])
+    assert store.read(a)[0] == {"md5": "1", "source": "KBase upload"}
+    assert store.read(b)[0] == {"md5": "2", "source": "JGI import"}
+    assert store.read(d)[0] == {"source": "Unknown"}
+
+    # moving a folder moves everything below it, replacing anything at the new path
+    store.move(Path.validate_path("user", "dir"), Path.validate_path("user", "dir2"))
+    assert store.read(b) is None
+    assert store.read(d)[0] == {"md5": "2", "source": "JGI import"}
+    assert store.read(Path.validate_path("user", "dir2/sub/c.txt"))[0] == {"md5": "3"}
+    store.move(d, b)
+    assert store.read(b)[0] == {"md5": "2", "source": "JGI import"}
+    assert store.read(d) is None
+
+    store.remove(Path.validate_path("user", "dir2"))
+    assert store.read(Path.validate_path("user", "dir2/sub/c.txt")) is None
+    assert store.read(b)[0] == {"md5": "2", "source": "JGI import"}
+    store.remove(b)
+    store.remove(b)
+    assert store.read(b) is None
+    assert store.read(a)[0] == {"md5": "1", "source": "KBase upload"}
+
+
+@mark.parametrize("store_type", [SidecarStore, SQLiteStore])
+def test_read_many(meta_dir, store_type, monkeypatch):
+    store = store_type()
+    a, b, c = _paths("a.txt", "dir/b.txt", "dir/c.txt")
+    store.write(a, {"md5": "1"})
+    store.write(c, {"md5": "3"})
+    other = Path.validate_path("other", "d.txt")
+    os.makedirs(Path._DATA_DIR + "/other")
+    store.write(other, {"md5": "4"})
+    connects = []
+    if store_type is SQLiteStore:
+        connect = store._connect
+        monkeypatch.setattr(store, "_connect", lambda u: connects.append(u) or connect(u))
+    assert store.read_many([a, b, other, c]) == [
+        {"md5": "1"}, None, {"md5": "4"}, {"md5": "3"}]
+    if store_type is SQLiteStore:
+        # one connection for each user
+        assert sorted(connects) == ["other", "user"]
+
+
+def test_sidecar_store_corrupt(meta_dir):
+    store = SidecarStore()
+    (a,) = _paths("a.txt")
+    os.makedirs(os.path.dirname(a.metadata_path))
+    with open(a.metadata_path, "w") as f:
+        f.write("{not json")
+    with raises(ValueError):
+        store.read(a)
+    assert store.read_many([a]) == [None]
+    store.add_sources([(a, "Unknown")])
+    assert store.read(a)[0] == {"source": "Unknown"}
+
+
+def test_sqlite_store_import_many(meta_dir):
+    store = SQLiteStore()
+    (a,) = _paths("a.txt")
+    store.import_many("user", [("user/a.txt", {"md5": "new"}, 200)])
+    # older metadata doesn't replace newer metadata
+    store.import_many("user", [("user/a.txt", {"md5": "old"}, 100)])
+    assert store.read(a) == ({"md5": "new"}, 200)
+    assert os.path.exists(meta_dir / ".staging_metadata" / "user.sqlite3")
+
+
+async def test_some_metadata_sqlite(meta_dir, monkeypatch):
+    monkeypatch.setattr(metadata_store, "_store", SQLiteStore())
+    (a,) = _paths("a.txt")
+    with open(a.full_path, "w") as f:
+        f.write("line 1\nline 2\n")
+    data = await metadata.some_metadata(a, source="KBase upload")
+    assert data["lineCount"] == "2"
+    assert data["source"] == "KBase upload"
+    await metadata.add_upa(a, "1/2/3")
+    data = await metadata.some_metadata(a)
+    assert data["UPA"] == "1/2/3"
+    assert data["source"] == "KBase upload"
+    assert metadata_store.get_store().read(a)[0]["md5"] == data["md5"]
+    # nothing is written beside the files
+    assert not os.path.exists(a.metadata_path)
+
+
+def test_migrate(meta_dir, capsys):
+    sidecar = SidecarStore()
+    a, b, c = _paths("a.txt", "dir/b.txt", "dir/c.txt")
+    sidecar.write(a, {"md5": "1", "source": "KBase upload"})
+    sidecar.write(b, {"md5": "2", "UPA": "1/2/3"})
+    os.utime(b.metadata_path, (1000, 1000))
+    with open(c.metadata_path, "w") as f:
+        f.write("{not json")
+    # the service's own state isn't migrated
+    os.makedirs(meta_dir / ".upload_sessions")
+    (meta_dir / ".upload_sessions" / "s.json").write_text("{}")
+
+    assert migrate_metadata.migrate(str(meta_dir)) == (2, 1)
+    store = SQLiteStore()
+    assert store.read(a)[0] == {"md5": "1", "source": "KBase upload"}
+    assert store.read(b) == ({"md5": "2", "UPA": "1/2/3"}, 1000)
+    assert store.read(c) is None
+    assert os.path.exists(a.metadata_path)
+    assert "c.txt" in capsys.readouterr().err
+
+    # running again with --remove keeps newer metadata in the store and removes the sidecars
+    store.write(b, {"md5": "3"})
+    os.remove(c.metadata_path)
+    assert migrate_metadata.migrate(str(meta_dir), remove=True) == (2, 0)
+    assert store.read(b)[0] == {"md5": "3"}
+    assert sorted(os.listdir(meta_dir)) == [".staging_metadata", ".upload_sessions"]
+
+
+def test_configure(monkeypatch):
+    monkeypatch.setattr(metadata_store, "_store", SidecarStore())
+    metadata_store.configure("sqlite")
+    assert type(metadata_store.get_store()) is SQLiteStore
+    store = metadata_store.get_store()
+    metadata_store.configure("sqlite")
+    assert metadata_store.get_store() is store
+    metadata_store.configure()
+    assert type(metadata_store.get_store()) is SidecarStore
+    with raises(ValueError):
+        metadata_store.configure("lmdb")
@@ -0,0 +1,137 @@
+""" Unit tests for parallel gzip and bzip2 decompression. """
+
+import bz2
+import gzip
+import hashlib
+import os
+import shutil
+import zlib
+
+from pytest import raises
+
+from staging_service import extraction, parallel_decompress
+from staging_service.decompress_jobs import Progress
+from staging_service.utils import Path
+
+from tests.test_extraction import user, _metadata  # noqa: F401
+
+
+def bgzf_compress(data: bytes, block_size: int = 65280) -> bytes:
+    blocks = []
+    # the last block is the empty end of file marker
+    chunks = [data[i:i + block_size] for i in range(0, len(data), block_size)] + [b""]
+    for chunk in chunks:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        header = (
+            b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+            + (18 + len(deflated) + 8 - 1).to_bytes(2, "little")
+        )
+        trailer = zlib.crc32(chunk).to_bytes(4, "little") + len(chunk).to_bytes(4, "little")
+        blocks.append(header + deflated + trailer)
+    return b"".join(blocks)
+
+
+def bz2_streams_compress(data: bytes, stream_size: int = 100000) -> bytes:
+    # as pbzip2 writes
+    return b"".join(
+        bz2.compress(data[i:i + stream_size]) for i in range(0, len(data), stream_size))
+
+
+def _contents(lines=20000):
+    return b"".join(b"@read%d\nACGTTGCA%d\n+\nIIIIIIII\n" % (i, i * 7) for i in range(lines))
+
+
+def _open(tmp_path, data):
+    path = tmp_path / hashlib.md5(data).hexdigest()
+    path.write_bytes(data)
+    return open(path, "rb")
+
+
+def _decompress(tmp_path, compressed, compression, threads=4):
+    with _open(tmp_path, compressed) as f:
+        assert parallel_decompress.splittable(f.fileno(), compression)
+        with parallel_decompress.open_split(f, compression, threads) as reader:
+            return reader.read()
+
+
+def test_bgzf(tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel_decompress, "_GROUP_SIZE", 50000)
+    contents = _contents()
+    compressed = bgzf_compress(contents)
+    assert _decompress(tmp_path, compressed, "gz") == contents
+    assert _decompress(tmp_path, compressed, "gz", threads=1) == contents
+    # a plain gzip member after the BGZF blocks is decompressed sequentially
+    compressed += gzip.compress(b"tail\n")
+    assert _decompress(tmp_path, compressed, "gz") == contents + b"tail\n"
+
+
+def test_bgzf_corrupt(tmp_path):
+    compressed = bytearray(bgzf_compress(_contents()))
+    compressed[100] ^= 0xff
+    with raises((zlib.error, EOFError)):
+        _decompress(tmp_path, bytes(compressed), "gz")
+    with raises(EOFError):
+        _decompress(tmp_path, bgzf_compress(_contents())[:-1000], "gz")
+
+
+def test_bz2_streams(tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel_decompress, "_GROUP_SIZE", 20000)
+    contents = _contents()
+    compressed = bz2_streams_compress(contents)
+    assert _decompress(tmp_path, compressed, "bz2") == contents
+
+    # a stream that is too long to hold in memory is decompressed sequentially
+    monkeypatch.setattr(parallel_decompress, "_MAX_BZ2_STREAM", 50000)
+    compressed += bz2.compress(contents)
+    assert _decompress(tmp_path, compressed, "bz2") == contents * 2
+
+
+def test_not_splittable(tmp_path):
+    contents = _contents(1000)
+    for compression, data in [("gz", gzip.compress(contents)), ("bz2", bz2.compress(contents))]:
+        with _open(tmp_path, data) as f:
+            assert not parallel_decompress.splittable(f.fileno(), compression)
+
+
+def test_command(monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+    assert parallel_decompress.command("gz", 4) is None
+    monkeypatch.setattr(shutil, "which", lambda name: "/usr/bin/" + name)
+    assert parallel_decompress.command("gz", 4) == ["/usr/bin/pigz", "-d", "-c", "-p", "4"]
+    assert parallel_decompress.command("bz2", 2) == ["/usr/bin/lbzip2", "-d", "-c", "-n", "2"]
+
+
+def test_open_command(tmp_path):
+    contents = _contents()
+    compressed = gzip.compress(contents)
+    with _open(tmp_path, compressed) as f:
+        progress = Progress()
+        with parallel_decompress.open_command(["gzip", "-d", "-c"], f, progress) as reader:
+            assert reader.read() == contents
+        assert progress.bytes_processed == len(compressed)
+
+    with _open(tmp_path, compressed[:-20]) as f:
+        with parallel_decompress.open_command(["gzip", "-d", "-c"], f, Progress()) as reader:
+            with raises(OSError) as got:
+                reader.read()
+            assert str(got.value).startswith("gzip failed: ")
+
+
+def test_extract_parallel(user):  # noqa: F811
+    contents = _contents()
+    for suffix, compress in [(".gz", bgzf_compress), (".bz2", bz2_streams_compress)]:
+        archive = Path.validate_path(user, "reads.fastq" + suffix)
+        compressed = compress(contents)
+        with open(archive.full_path, "wb") as f:
+            f.write(compressed)
+        progress = Progress()
+        extraction.extract(archive, progress, threads=4)
+        assert progress.bytes_processed == len(compressed)
+        assert progress.files_extracted == 1
+        target = Path.validate_path(user, "reads.fastq")
+        with open(target.full_path, "rb") as f:
+            assert f.read() == contents
+        assert _metadata(target)["md5"] == hashlib.md5(contents).hexdigest()
+        assert not os.path.exists(archive.full_path)
+        os.remove(target.full_path)
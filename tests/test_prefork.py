@@ -0,0 +1,108 @@
+""" Tests for serving from several worker processes. """
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from aiohttp import web
+from pytest import fixture, raises
+
+from staging_service import prefork
+
+
+def _app(worker_index):
+    async def pid(request):
+        return web.Response(text=f"{worker_index} {os.getpid()}")
+
+    app = web.Application()
+    app.router.add_get("/pid", pid)
+    return app
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _get(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/pid", timeout=5) as resp:
+        index, pid = resp.read().decode().split()
+        return int(index), int(pid)
+
+
+def _wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise AssertionError("Timed out")
+
+
+def _children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return {int(p) for p in f.read().split()}
+
+
+@fixture
+def master():
+    port = _free_port()
+    proc = subprocess.Popen([
+        sys.executable, "-c",
+        "from staging_service import prefork; from tests.test_prefork import _app; "
+        + f"prefork.serve(_app, 3, {port}, shutdown_timeout=2)"
+    ])
+    try:
+        _wait_for(lambda: len(_children(proc.pid)) == 3)
+        _wait_for(lambda: _get(port))
+        yield proc, port
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def test_workers(master):
+    proc, port = master
+    workers = _children(proc.pid)
+    # each request is a new connection, which the kernel assigns to any of the workers
+    seen = set()
+    for _ in range(100):
+        seen.add(_get(port))
+        if len(seen) == 3:
+            break
+    assert {pid for _, pid in seen} <= workers
+    assert {index for index, _ in seen} <= {0, 1, 2}
+
+    # a worker that dies is replaced
+    killed = workers.pop()
+    os.kill(killed, signal.SIGKILL)
+    _wait_for(lambda: len(_children(proc.pid)) == 3 and killed not in _children(proc.pid))
+    _wait_for(lambda: _get(port))
+
+    # the master stops the workers and exits
+    workers = _children(proc.pid)
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait(timeout=20) == 0
+    for pid in workers:
+        with raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+def test_restart_delay():
+    master = prefork.Master(_app, 2, 0)
+    now = time.monotonic()
+    assert master._restart_delay(now - 60) == 0
+    assert [master._restart_delay(now) for _ in range(7)] == [1, 2, 4, 8, 16, 30, 30]
+    assert master._restart_delay(now - 60) == 0
+    assert master._restart_delay(now) == 1
+    with raises(ValueError):
+        prefork.Master(_app, 0, 0)
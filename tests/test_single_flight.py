@@ -0,0 +1,59 @@
+""" Unit tests for coalescing concurrent calls. """
+
+import asyncio
+
+from pytest import raises
+
+from staging_service.single_flight import SingleFlight
+
+
+async def test_single_flight():
+    sf = SingleFlight()
+    calls = []
+
+    async def call(x):
+        calls.append(x)
+        await asyncio.sleep(0.05)
+        return x * 2
+
+    results = await asyncio.gather(
+        *[sf.run("a", call, 1) for _ in range(5)], sf.run("b", call, 2))
+    assert results == [2] * 5 + [4]
+    assert calls == [1, 2]
+    assert sf.in_flight() == 0
+
+    # once a call is done the next call for the key runs again
+    assert await sf.run("a", call, 3) == 6
+    assert calls == [1, 2, 3]
+
+
+async def test_single_flight_exception():
+    sf = SingleFlight()
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise ValueError("fail")
+
+    results = await asyncio.gather(*[sf.run("a", call) for _ in range(3)], return_exceptions=True)
+    assert [type(r) for r in results] == [ValueError] * 3
+    assert calls == [1]
+    assert sf.in_flight() == 0
+
+
+async def test_single_flight_cancel():
+    sf = SingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    first = asyncio.ensure_future(sf.run("a", call))
+    second = asyncio.ensure_future(sf.run("a", call))
+    await asyncio.sleep(0)
+    # the caller that started the call is cancelled, but the call continues for the other
+    first.cancel()
+    with raises(asyncio.CancelledError):
+        await first
+    assert await second == "done"
@@ -0,0 +1,127 @@
+""" Unit tests for the resumable upload session state. """
+
+import fcntl
+import os
+import time
+import uuid
+
+from pytest import raises
+
+from staging_service import upload_sessions
+from staging_service.utils import Path
+
+from tests.test_app import FileUtil
+
+
+def test_session_lifecycle():
+    username = "sessionuser" + uuid.uuid4().hex
+    with FileUtil():
+        path = Path.validate_path(username, "dir/file.txt")
+        session = upload_sessions.create_session(username, path, 8)
+        assert session.path.user_path == path.user_path
+        assert os.path.dirname(session.temp_path) == os.path.dirname(path.full_path)
+        assert os.path.basename(session.temp_path).startswith(".file.txt.")
+        assert upload_sessions.get_offset(session) == 0
+
+        assert upload_sessions.get_session(session.session_id, username, 60) == session
+        assert upload_sessions.get_session(session.session_id, "someoneelse", 60) is None
+        assert upload_sessions.get_session("../../etc/passwd", username, 60) is None
+
+        with upload_sessions.open_for_append(session, 0) as f:
+            with raises(upload_sessions.SessionBusyException):
+                upload_sessions.open_for_append(session, 0)
+            f.write(b"1234")
+        with raises(upload_sessions.OffsetMismatchException) as got:
+            upload_sessions.open_for_append(session, 2)
+        assert got.value.offset == 4
+        with upload_sessions.open_for_append(session, 4) as f:
+            f.write(b"5678")
+
+        upload_sessions.complete_session(session)
+        with open(path.full_path, "rb") as f:
+            assert f.read() == b"12345678"
+        assert not os.path.exists(session.temp_path)
+        assert upload_sessions.get_session(session.session_id, username, 60) is None
+        with raises(upload_sessions.SessionNotFoundException):
+            upload_sessions.open_for_append(session, 8)
+
+
+def test_session_completed_before_lock(monkeypatch):
+    username = "sessionuser" + uuid.uuid4().hex
+    with FileUtil():
+        path = Path.validate_path(username, "file.txt")
+        session = upload_sessions.create_session(username, path, 4)
+        with upload_sessions.open_for_append(session, 0) as f:
+            f.write(b"1234")
+        flock = fcntl.flock
+
+        def complete_then_flock(f, operation):
+            # another request completes the upload after this one opened the file
+            upload_sessions.complete_session(session)
+            flock(f, operation)
+
+        monkeypatch.setattr(fcntl, "flock", complete_then_flock)
+        with raises(upload_sessions.SessionNotFoundException):
+            upload_sessions.open_for_append(session, 4)
+        monkeypatch.setattr(fcntl, "flock", flock)
+        with open(path.full_path, "rb") as f:
+            assert f.read() == b"1234"
+
+
+def test_remove_expired_sessions():
+    username = "sessionuser" + uuid.uuid4().hex
+    with FileUtil():
+        upload_sessions.remove_expired_sessions(0)
+        old = upload_sessions.create_session(
+            username, Path.validate_path(username, "old"), 10)
+        new = upload_sessions.create_session(
+            username, Path.validate_path(username, "new"), 10)
+        past = time.time() - 100
+        os.utime(old.temp_path, (past, past))
+        # the session creation time also counts as activity
+        os.utime(new.temp_path, (past, past))
+        object.__setattr__(old, "created", past)
+        with open(upload_sessions._state_path(old.session_id), "w") as f:
+            f.write('{"session_id": "%s", "username": "%s", "user_path": "%s", '
+                    '"size": 10, "created": %s}' % (
+                        old.session_id, username, old.user_path, past))
+
+        assert upload_sessions.remove_expired_sessions(50) == 1
+        assert not os.path.exists(old.temp_path)
+        assert upload_sessions.get_session(old.session_id, username, 50) is None
+        assert upload_sessions.get_session(new.session_id, username, 50) == new
+        assert upload_sessions.get_session(new.session_id, username, 0) is None
+        assert not os.path.exists(new.temp_path)
+
+
+def test_multipart_session():
+    username = "sessionuser" + uuid.uuid4().hex
+    part_size = upload_sessions.MIN_PART_SIZE
+    with FileUtil():
+        path = Path.validate_path(username, "multi")
+        session = upload_sessions.create_session(username, path, part_size + 10, part_size)
+        assert session.part_count == 2
+        assert session.part_range(2) == (part_size, 10)
+        # preallocated to the full size
+        assert os.stat(session.temp_path).st_size == part_size + 10
+
+        with upload_sessions.open_part(session, 2) as f:
+            os.pwrite(f.fileno(), b"x" * 10, part_size)
+            # parts can be written concurrently
+            upload_sessions.open_part(session, 1).close()
+            with raises(upload_sessions.SessionBusyException):
+                upload_sessions.lock_for_completion(session)
+        upload_sessions.save_part(session, 2, {"size": 10})
+        with raises(upload_sessions.MissingPartsException) as got:
+            upload_sessions.lock_for_completion(session)
+        assert got.value.missing == [1]
+
+        upload_sessions.save_part(session, 1, {"size": part_size})
+        f, parts = upload_sessions.lock_for_completion(session)
+        with f:
+            assert parts == [{"size": part_size}, {"size": 10}]
+            with raises(upload_sessions.SessionBusyException):
+                upload_sessions.open_part(session, 1)
+            upload_sessions.complete_session(session)
+        assert os.stat(path.full_path).st_size == part_size + 10
+        assert upload_sessions.get_parts(session) == {}